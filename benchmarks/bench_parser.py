@@ -0,0 +1,284 @@
+"""
+Parser throughput benchmark over a synthetic chart.
+
+    python benchmarks/bench_parser.py --measures 999 --ln lntype -o results.json
+    python benchmarks/bench_parser.py --compare before.json after.json
+
+Each parse mode runs in a fresh process so its peak RSS is its own. Reported
+per mode: best wall time, lines/s, notes/s, peak RSS and traced peak bytes.
+Within a mode, every ParseStats phase (tokenize, line_loop, headers,
+count_notes, expand, timing, ...) reports its best wall time, lines/s, notes/s
+and the tracemalloc block count and size allocated by the phase's functions,
+taken when the phase ends.
+"""
+
+import argparse
+import ast
+import bisect
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+Root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, Root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bmsparser
+import synth
+
+Modes = ("tokenize", "header", "stats", "full", "arrays")
+
+# parser functions (or whole classes) whose allocations belong to a phase;
+# anything else in bmsparser.py is "other"
+PhaseFunctions = {
+    "BmsTokenizer": "tokenize",
+    "detect_encoding": "headers",
+    "BmsParser.parse_header": "headers",
+    "BmsParser.decode": "headers",
+    "BmsParser.parse_int": "headers",
+    "BmsParser.control_flow": "control_flow",
+    "BmsParser.control_value": "control_flow",
+    "BmsParser.choose_random": "control_flow",
+    "BmsParser.collect_tokens": "line_loop",
+    "BmsParser.drop_bad_lines": "line_loop",
+    "BmsParser.fingerprint_notes": "fingerprint",
+    "BmsParser.update_key_modes": "key_mode",
+    "BmsParser.update_key_mode": "key_mode",
+    "BmsParser.count_notes": "count_notes",
+    "BmsParser.count_measure": "count_notes",
+    "BmsParser.expand_measure": "expand",
+    "BmsParser.decode_ids": "expand",
+    "Note": "expand",
+    "LongNote": "expand",
+    "LandmineNote": "expand",
+    "TimeLine": "expand",
+    "Measure": "expand",
+    "BmsParser.time_measure": "timing",
+    "TimingIndex": "timing_index",
+    "Chart.to_arrays": "to_arrays",
+}
+
+def function_spans(path: str):
+    # sorted (first line, last line, qualified name) of every function in path
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    spans = []
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.ClassDef)):
+                name = prefix + child.name
+                if isinstance(child, ast.FunctionDef):
+                    spans.append((child.lineno, child.end_lineno, name))
+                visit(child, name + ".")
+    visit(tree, "")
+    spans.sort()
+    return spans
+
+class PhaseAttribution:
+    # maps bmsparser.py line numbers to the phase whose function contains them
+    def __init__(self):
+        self.filename = bmsparser.__file__
+        self.spans = function_spans(self.filename)
+        self.starts = [span[0] for span in self.spans]
+        self.cache: dict[int, str] = {}
+    def phase_of_line(self, lineno: int):
+        phase = self.cache.get(lineno)
+        if phase is None:
+            phase = "other"
+            i = bisect.bisect_right(self.starts, lineno) - 1
+            # innermost enclosing function is the last one starting before lineno that still covers it
+            while i >= 0:
+                first, last, name = self.spans[i]
+                if first <= lineno <= last:
+                    if name.startswith("BmsParser.header_"):
+                        name = "BmsParser.parse_header"
+                    phase = PhaseFunctions.get(name) or PhaseFunctions.get(name.rsplit(".", 1)[0], "other")
+                    break
+                i -= 1
+            self.cache[lineno] = phase
+        return phase
+    def phase_of(self, traceback):
+        # most recent parser frame decides
+        for frame in reversed(traceback):
+            if frame.filename == self.filename:
+                return self.phase_of_line(frame.lineno)
+        return None
+    def count(self, snapshot: tracemalloc.Snapshot):
+        blocks: dict[str, list[int]] = {}
+        for statistic in snapshot.statistics("traceback"):
+            phase = self.phase_of(statistic.traceback)
+            if phase is not None:
+                counts = blocks.setdefault(phase, [0, 0])
+                counts[0] += statistic.count
+                counts[1] += statistic.size
+        return blocks
+
+class TracedStats(bmsparser.ParseStats):
+    # ParseStats that snapshots tracemalloc whenever a phase ends and keeps, per
+    # phase, the most blocks its functions had allocated at any of those points.
+    # headers and control_flow are timed per call inside line_loop, so they are
+    # counted at line_loop's snapshot instead of their own.
+    def __init__(self, attribution: PhaseAttribution):
+        super().__init__()
+        self.attribution = attribution
+        self.blocks: dict[str, list[int]] = {}
+    def add_time(self, phase: str, seconds: float):
+        super().add_time(phase, seconds)
+        if tracemalloc.is_tracing() and phase not in ("headers", "control_flow"):
+            self.snapshot()
+    def snapshot(self):
+        for phase, counts in self.attribution.count(tracemalloc.take_snapshot()).items():
+            best = self.blocks.setdefault(phase, [0, 0])
+            if counts[0] > best[0]:
+                best[:] = counts
+
+def run_mode(mode: str, path: str, stats: bmsparser.ParseStats):
+    if mode == "tokenize":
+        started = time.perf_counter()
+        tokenizer = bmsparser.BmsTokenizer(path)
+        tokens = list(tokenizer)
+        stats.add_time("tokenize", time.perf_counter() - started - tokenizer.hash_seconds)
+        stats.add_time("hash", tokenizer.hash_seconds)
+        return tokens
+    if mode == "header":
+        return bmsparser.BmsParser(path, seed=0, stats=stats).parse(bmsparser.ParseHeaderOnly)
+    if mode == "stats":
+        return bmsparser.BmsParser(path, seed=0, stats=stats).parse(bmsparser.ParseNoteStats)
+    if mode == "full":
+        return bmsparser.BmsParser(path, seed=0, stats=stats).parse()
+    if mode == "arrays":
+        chart = bmsparser.BmsParser(path, seed=0, stats=stats).parse()
+        started = time.perf_counter()
+        arrays = chart.to_arrays()
+        stats.add_time("to_arrays", time.perf_counter() - started)
+        return arrays
+    raise ValueError(f"Unknown mode {mode}")
+
+def max_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+def measure_mode(mode: str, path: str, repeat: int, lines: int, notes: int, queue):
+    best = float("inf")
+    phases: dict[str, float] = {}
+    for _ in range(repeat):
+        stats = bmsparser.ParseStats()
+        started = time.perf_counter()
+        result = run_mode(mode, path, stats)
+        best = min(best, time.perf_counter() - started)
+        for phase, seconds in stats.phases.items():
+            phases[phase] = min(phases.get(phase, float("inf")), seconds)
+        del result
+    gc.collect()
+    # one more parse under tracemalloc (with a traceback deep enough to reach
+    # the parser frame) for the traced peak and the per-phase block counts
+    traced = TracedStats(PhaseAttribution())
+    tracemalloc.start(8)
+    result = run_mode(mode, path, traced)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    queue.put({
+        "seconds": best,
+        "lines_per_sec": lines / best,
+        "notes_per_sec": notes / best,
+        "peak_rss_kb": max_rss_kb(),
+        "traced_peak_bytes": peak,
+        "phases": {phase: {
+            "seconds": seconds,
+            "lines_per_sec": lines / seconds if seconds > 0 else None,
+            "notes_per_sec": notes / seconds if seconds > 0 else None,
+            "allocated_blocks": traced.blocks.get(phase, [0, 0])[0],
+            "allocated_bytes": traced.blocks.get(phase, [0, 0])[1],
+        } for phase, seconds in phases.items()},
+    })
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=Root, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(spec: synth.ChartSpec, modes: tuple, repeat: int):
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "bench.bms")
+        synth.write_chart(path, spec)
+        with open(path, "rb") as f:
+            lines = f.read().count(b"\n")
+        notes = bmsparser.BmsParser(path, seed=0).parse(bmsparser.ParseNoteStats).meta.total_notes
+        results = {}
+        for mode in modes:
+            queue = context.Queue()
+            process = context.Process(target=measure_mode, args=(mode, path, repeat, lines, notes, queue))
+            process.start()
+            results[mode] = queue.get()
+            process.join()
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "chart": dict(vars(spec), lines=lines, notes=notes),
+        "modes": results,
+    }
+
+def print_report(report: dict):
+    chart = report["chart"]
+    print(f"revision {report['revision']}, {chart['lines']} lines, {chart['notes']} notes")
+    print(f"{'mode/phase':16} {'ms':>9} {'lines/s':>12} {'notes/s':>12} {'rss KiB':>9} {'traced KiB':>11} {'blocks':>9}")
+    for mode, r in report["modes"].items():
+        print(f"{mode:16} {r['seconds'] * 1000:9.2f} {r['lines_per_sec']:12,.0f} {r['notes_per_sec']:12,.0f} "
+              f"{r['peak_rss_kb'] or 0:9} {r['traced_peak_bytes'] // 1024:11}")
+        for phase, p in r["phases"].items():
+            print(f"  {phase:14} {p['seconds'] * 1000:9.2f} {p['lines_per_sec'] or 0:12,.0f} {p['notes_per_sec'] or 0:12,.0f} "
+                  f"{'':9} {p['allocated_bytes'] // 1024:11} {p['allocated_blocks']:9}")
+
+def compare(before_path: str, after_path: str):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before['revision']} -> {after['revision']}")
+    for mode, r in after["modes"].items():
+        if mode not in before["modes"]:
+            continue
+        b = before["modes"][mode]
+        print(f"{mode:16} time x{r['seconds'] / b['seconds']:.3f}  traced peak x{r['traced_peak_bytes'] / max(b['traced_peak_bytes'], 1):.3f}")
+        for phase, p in r["phases"].items():
+            if phase not in b["phases"]:
+                continue
+            q = b["phases"][phase]
+            blocks = f"x{p['allocated_blocks'] / q['allocated_blocks']:.3f}" if q["allocated_blocks"] > 0 else "-"
+            print(f"  {phase:14} time x{p['seconds'] / max(q['seconds'], 1e-9):.3f}  blocks {blocks}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BmsParser modes and phases on a synthetic chart")
+    synth.add_arguments(parser)
+    parser.add_argument("--modes", default=",".join(Modes), help="comma separated subset of " + ",".join(Modes))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", help="write the JSON report here")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON reports and exit")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = benchmark(synth.spec_from_args(args), tuple(args.modes.split(",")), args.repeat)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
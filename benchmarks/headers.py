@@ -0,0 +1,45 @@
+"""
+Parse time of a header-heavy chart (thousands of #WAV/#BMP definitions).
+
+    python benchmarks/headers.py [definitions] [repeat]
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bmsparser import BmsParser, ParseFull, ParseHeaderOnly
+
+def base36(n: int):
+    digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return digits[n // 36] + digits[n % 36]
+
+def write_chart(path: str, definitions: int):
+    lines = ["#PLAYER 1", "#GENRE bench", "#TITLE headers", "#ARTIST bench", "#BPM 150",
+             "#PLAYLEVEL 12", "#RANK 2", "#TOTAL 300", "#STAGEFILE stage.png"]
+    for i in range(definitions):
+        index = base36(i % 1295 + 1)
+        lines.append(f"#WAV{index} sound_{i}.wav")
+        lines.append(f"#BMP{index} image_{i}.bmp")
+        lines.append(f"#BPM{index} {100 + i % 100}")
+        lines.append(f"#STOP{index} {i % 192}")
+    for m in range(64):
+        lines.append(f"#{m:03d}11:" + "01" * 16)
+        lines.append(f"#{m:03d}01:" + "02" * 8)
+    with open(path, "w") as f:
+        f.write("\r\n".join(lines) + "\r\n")
+
+def main():
+    definitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "headers.bms")
+        write_chart(path, definitions)
+        for name, mode in (("header-only", ParseHeaderOnly), ("full", ParseFull)):
+            best = min(timeit.repeat(lambda: BmsParser(path).parse(mode), number=1, repeat=repeat))
+            print(f"{name:12} {best * 1000:8.2f} ms  ({definitions * 4 / best:,.0f} header lines/s)")
+
+if __name__ == "__main__":
+    main()
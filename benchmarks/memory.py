@@ -0,0 +1,66 @@
+"""
+Bytes-per-note of a parsed chart.
+
+    python benchmarks/memory.py [measures]
+"""
+
+import gc
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bmsparser import BmsParser
+
+def base36(n: int):
+    digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return digits[n // 36] + digits[n % 36]
+
+def write_chart(path: str, measures: int):
+    prng = random.Random(0)
+    lines = ["#PLAYER 1", "#TITLE memory", "#BPM 150", "#LNTYPE 1"]
+    lines += [f"#WAV{base36(i)} {i}.wav" for i in range(1, 1296)]
+    for m in range(measures):
+        for channel in ("11", "12", "13", "14", "15", "16", "18", "19"):
+            objects = (base36(prng.randint(1, 1295)) if prng.random() < 0.4 else "00" for _ in range(16))
+            lines.append(f"#{m:03d}{channel}:" + "".join(objects))
+        lines.append(f"#{m:03d}01:" + "".join(base36(prng.randint(1, 1295)) for _ in range(8)))
+        if m % 2 == 0:
+            lines.append(f"#{m:03d}51:0100000000000000000000000000000000000000000000000000000000000001")
+    with open(path, "w") as f:
+        f.write("\r\n".join(lines) + "\r\n")
+
+def count_notes(chart):
+    count = 0
+    for measure in chart.measures:
+        for timeline in measure.timelines:
+            count += len(timeline.background_notes)
+            for lanes in (timeline.notes, timeline.invisible_notes, timeline.landmine_notes):
+                count += sum(1 for note in lanes if note is not None)
+    return count
+
+def main():
+    measures = int(sys.argv[1]) if len(sys.argv) > 1 else 999
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "memory.bms")
+        write_chart(path, measures)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        chart = BmsParser(path).parse()
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    notes = count_notes(chart)
+    timelines = sum(len(measure.timelines) for measure in chart.measures)
+    print(f"measures:       {len(chart.measures)}")
+    print(f"timelines:      {timelines}")
+    print(f"notes:          {notes}")
+    print(f"chart bytes:    {size}")
+    print(f"bytes per note: {size / notes:.1f}")
+
+if __name__ == "__main__":
+    main()
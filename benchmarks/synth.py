@@ -0,0 +1,164 @@
+"""
+Synthetic BMS chart generator for benchmarks.
+
+    python benchmarks/synth.py out.bms --measures 999 --density 0.4 --ln lntype --random-depth 2
+"""
+
+import argparse
+import random
+
+Base36Digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+Base62Digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+KeyChannels = ("11", "12", "13", "14", "15", "18", "19", "16")
+P2KeyChannels = ("21", "22", "23", "24", "25", "28", "29", "26")
+
+class ChartSpec:
+    def __init__(self, measures: int = 200, density: float = 0.3, divisions: int = 16,
+                 wav_count: int = 1295, bmp_count: int = 0, base62: bool = False,
+                 ln: str = "none", ln_rate: float = 0.05, double: bool = False,
+                 random_depth: int = 0, random_range: int = 2, stops: int = 0,
+                 scrolls: int = 0, bpm_changes: int = 0, bgm_lines: int = 1, seed: int = 0):
+        self.measures = measures
+        self.density = density
+        self.divisions = divisions
+        self.wav_count = wav_count
+        self.bmp_count = bmp_count
+        self.base62 = base62
+        # "none", "lntype" (#LNTYPE 1, channels 5x) or "lnobj" (#LNOBJ ZZ / zz)
+        self.ln = ln
+        self.ln_rate = ln_rate
+        self.double = double
+        self.random_depth = random_depth
+        self.random_range = random_range
+        self.stops = stops
+        self.scrolls = scrolls
+        self.bpm_changes = bpm_changes
+        self.bgm_lines = bgm_lines
+        self.seed = seed
+
+def encode(n: int, base62: bool):
+    digits = Base62Digits if base62 else Base36Digits
+    base = len(digits)
+    return digits[n // base] + digits[n % base]
+
+def generate(spec: ChartSpec) -> str:
+    prng = random.Random(spec.seed)
+    max_id = 62 * 62 - 1 if spec.base62 else 36 * 36 - 1
+    wav_count = min(spec.wav_count, max_id - 1)
+    lnobj = max_id
+    def obj():
+        return encode(prng.randint(1, wav_count), spec.base62)
+    lines = ["*---------------------- HEADER FIELD", "#PLAYER 3" if spec.double else "#PLAYER 1",
+             "#GENRE Synthetic", "#TITLE synthetic chart", "#ARTIST bench", "#BPM 150",
+             "#PLAYLEVEL 12", "#RANK 2", "#TOTAL 300"]
+    if spec.base62:
+        lines.append("#BASE 62")
+    if spec.ln == "lntype":
+        lines.append("#LNTYPE 1")
+    elif spec.ln == "lnobj":
+        lines.append(f"#LNOBJ {encode(lnobj, spec.base62)}")
+    lines += [f"#WAV{encode(i, spec.base62)} sound_{i:04d}.wav" for i in range(1, wav_count + 1)]
+    lines += [f"#BMP{encode(i, spec.base62)} image_{i:04d}.bmp" for i in range(1, min(spec.bmp_count, max_id) + 1)]
+    for i in range(1, spec.bpm_changes + 1):
+        lines.append(f"#BPM{encode(i, spec.base62)} {prng.choice((75, 120, 180, 222.5, 300))}")
+    for i in range(1, spec.stops + 1):
+        lines.append(f"#STOP{encode(i, spec.base62)} {prng.choice((48, 96, 192))}")
+    for i in range(1, spec.scrolls + 1):
+        lines.append(f"#SCROLL{encode(i, spec.base62)} {prng.choice((0.5, 1.0, 2.0))}")
+    lines.append("*---------------------- MAIN DATA FIELD")
+
+    channels = KeyChannels + (P2KeyChannels if spec.double else ())
+    ln_channels = {channel: "5" + channel[1] if channel[0] == "1" else "6" + channel[1] for channel in channels}
+    def measure_lines(m: int):
+        out = []
+        events = {"08": spec.bpm_changes, "09": spec.stops, "SC": spec.scrolls}
+        for channel, count in events.items():
+            if count > 0 and prng.random() < 0.25:
+                out.append(f"#{m:03d}{channel}:" + "00" * 3 + encode(prng.randint(1, count), spec.base62))
+        for _ in range(spec.bgm_lines):
+            out.append(f"#{m:03d}01:" + "".join(obj() if prng.random() < 0.5 else "00" for _ in range(8)))
+        for channel in channels:
+            objects = []
+            lns = []
+            for j in range(spec.divisions):
+                if prng.random() >= spec.density or (len(lns) > 0 and lns[-1] == j - 1):
+                    # the slot under a long note's tail stays empty
+                    objects.append("00")
+                elif spec.ln == "lntype" and prng.random() < spec.ln_rate and j + 1 < spec.divisions:
+                    objects.append("00")
+                    lns.append(j)
+                else:
+                    objects.append(obj())
+            if spec.ln == "lnobj" and prng.random() < spec.ln_rate:
+                # close the last note of the line as a long note
+                for j in range(spec.divisions - 1, 0, -1):
+                    if objects[j - 1] != "00" and objects[j] == "00":
+                        objects[j] = encode(lnobj, spec.base62)
+                        break
+            out.append(f"#{m:03d}{channel}:" + "".join(objects))
+            if len(lns) > 0:
+                ln_objects = ["00"] * spec.divisions
+                for j in lns:
+                    if ln_objects[j] == "00" and ln_objects[j + 1] == "00":
+                        ln_objects[j] = obj()
+                        ln_objects[j + 1] = obj()
+                out.append(f"#{m:03d}{ln_channels[channel]}:" + "".join(ln_objects))
+        return out
+
+    def random_block(m: int, depth: int):
+        out = [f"#RANDOM {spec.random_range}"]
+        for branch in range(1, spec.random_range + 1):
+            out.append(f"#IF {branch}")
+            if depth > 1:
+                out += random_block(m, depth - 1)
+            else:
+                out += measure_lines(m)
+            out.append("#ENDIF")
+        out.append("#ENDRANDOM")
+        return out
+
+    for m in range(spec.measures):
+        if spec.random_depth > 0 and m % 8 == 7:
+            lines += random_block(m, spec.random_depth)
+        else:
+            lines += measure_lines(m)
+    return "\r\n".join(lines) + "\r\n"
+
+def write_chart(path: str, spec: ChartSpec):
+    with open(path, "w", encoding="ascii", newline="") as f:
+        f.write(generate(spec))
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = ChartSpec()
+    parser.add_argument("--measures", type=int, default=defaults.measures, help="at most 1000")
+    parser.add_argument("--density", type=float, default=defaults.density, help="chance of a note per key slot")
+    parser.add_argument("--divisions", type=int, default=defaults.divisions, help="slots per key channel line")
+    parser.add_argument("--wav-count", type=int, default=defaults.wav_count)
+    parser.add_argument("--bmp-count", type=int, default=defaults.bmp_count)
+    parser.add_argument("--base62", action="store_true")
+    parser.add_argument("--ln", choices=("none", "lntype", "lnobj"), default=defaults.ln)
+    parser.add_argument("--ln-rate", type=float, default=defaults.ln_rate)
+    parser.add_argument("--double", action="store_true", help="add 2P key channels")
+    parser.add_argument("--random-depth", type=int, default=defaults.random_depth, help="nesting of #RANDOM blocks on every 8th measure")
+    parser.add_argument("--random-range", type=int, default=defaults.random_range)
+    parser.add_argument("--stops", type=int, default=defaults.stops, help="#STOP definitions")
+    parser.add_argument("--scrolls", type=int, default=defaults.scrolls, help="#SCROLL definitions")
+    parser.add_argument("--bpm-changes", type=int, default=defaults.bpm_changes, help="#BPMxx definitions")
+    parser.add_argument("--bgm-lines", type=int, default=defaults.bgm_lines)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+def spec_from_args(args: argparse.Namespace) -> ChartSpec:
+    return ChartSpec(args.measures, args.density, args.divisions, args.wav_count, args.bmp_count,
+                     args.base62, args.ln, args.ln_rate, args.double, args.random_depth, args.random_range,
+                     args.stops, args.scrolls, args.bpm_changes, args.bgm_lines, args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic BMS chart")
+    parser.add_argument("output")
+    add_arguments(parser)
+    args = parser.parse_args()
+    write_chart(args.output, spec_from_args(args))
+
+if __name__ == "__main__":
+    main()
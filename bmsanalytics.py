@@ -0,0 +1,217 @@
+"""
+ * Copyright (C) 2024 VioletXF, khoeun03
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+from typing import Union
+from bmsparser import Chart, ChartArrays, NoteKindNormal, NoteKindLongHead, numpy
+
+ScratchLanes = (7, 15)
+
+# order of ChartFeatures.as_vector()
+FeatureNames = (
+    "notes", "scratch_notes", "long_notes", "scratch_long_notes", "duration", "average_nps", "peak_nps", "p90_nps",
+    "chords", "max_chord", "chord_ratio", "jacks", "min_jack_gap", "scratch_ratio",
+    "ln_coverage", "ln_hold_time",
+)
+
+class ChartFeatures:
+    # Per-chart difficulty features. Times are in seconds; notes counts note
+    # heads (normal notes and long note heads) on the timelines, which matches
+    # ChartMeta.total_notes unless two objects landed on the same lane and slot.
+    # The other counts are heads too, so they differ from ChartMeta's, which
+    # leave scratch long notes out of total_long_notes and, with #LNOBJ, count
+    # a scratch long note twice in total_scratch_notes (head and end):
+    #   meta.total_long_notes    == long_notes - scratch_long_notes
+    #   meta.total_scratch_notes == scratch_notes (+ scratch_long_notes with #LNOBJ)
+    def __init__(self):
+        self.notes = 0
+        # heads on the scratch lanes, long note heads included
+        self.scratch_notes = 0
+        # long note heads on every lane, and those on the scratch lanes
+        self.long_notes = 0
+        self.scratch_long_notes = 0
+        # first to last note head
+        self.duration = 0.0
+        self.average_nps = 0.0
+        # most note heads inside any window-long span
+        self.peak_nps = 0.0
+        self.p90_nps = 0.0
+        # note heads in windows starting every step seconds, divided by window
+        self.nps_curve: list[float] = []
+        # timings with two or more note heads
+        self.chords = 0
+        self.max_chord = 0
+        self.chord_ratio = 0.0
+        # same-lane note heads at most jack_gap apart
+        self.jacks = 0
+        self.min_jack_gap = 0.0
+        self.scratch_ratio = 0.0
+        # share of duration with at least one long note held, and total hold time
+        self.ln_coverage = 0.0
+        self.ln_hold_time = 0.0
+    def as_vector(self) -> list[float]:
+        return [float(getattr(self, name)) for name in FeatureNames]
+    def as_dict(self):
+        return {name: getattr(self, name) for name in FeatureNames}
+    def __str__(self):
+        return " ".join(f"{name}={getattr(self, name):.4g}" for name in FeatureNames)
+
+def _nearest_rank(values: list[float], fraction: float):
+    if len(values) == 0:
+        return 0.0
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def _features_numpy(arrays: ChartArrays, window: float, step: float, jack_gap: float, features: ChartFeatures):
+    np = numpy
+    timing = np.asarray(arrays.timing)
+    lane = np.asarray(arrays.lane)
+    kind = np.asarray(arrays.kind)
+    pair = np.asarray(arrays.pair)
+    playable = lane >= 0
+    head = playable & ((kind == NoteKindNormal) | (kind == NoteKindLongHead))
+    times = timing[head] / 1000000.0
+    lanes = lane[head]
+    scratch = (lanes == ScratchLanes[0]) | (lanes == ScratchLanes[1])
+    features.notes = int(len(times))
+    features.scratch_notes = int(scratch.sum())
+    long_heads = kind[head] == NoteKindLongHead
+    features.long_notes = int(long_heads.sum())
+    features.scratch_long_notes = int((long_heads & scratch).sum())
+    if len(times) == 0:
+        return
+    features.duration = float(times[-1] - times[0])
+    # sliding window: notes in [t_i, t_i + window) for every note head t_i
+    features.peak_nps = float((np.searchsorted(times, times + window) - np.arange(len(times))).max()) / window
+    starts = times[0] + np.arange(0.0, max(features.duration, 0.0) + step / 2, step)
+    curve = (np.searchsorted(times, starts + window) - np.searchsorted(times, starts)) / window
+    features.nps_curve = curve.tolist()
+    features.p90_nps = float(_nearest_rank(np.sort(curve).tolist(), 0.9))
+    _, chord_sizes = np.unique(times, return_counts=True)
+    chords = chord_sizes[chord_sizes >= 2]
+    features.chords = int(len(chords))
+    features.max_chord = int(chord_sizes.max())
+    # same-lane gaps: order by (lane, time) and diff neighbours within a lane
+    order = np.lexsort((times, lanes))
+    by_lane = lanes[order]
+    gaps = np.diff(times[order])[by_lane[1:] == by_lane[:-1]]
+    jacks = gaps[gaps <= jack_gap]
+    features.jacks = int(len(jacks))
+    features.min_jack_gap = float(jacks.min()) if len(jacks) > 0 else 0.0
+    # long notes: every paired head ends at its tail
+    ln_heads = np.nonzero(playable & (kind == NoteKindLongHead) & (pair >= 0))[0]
+    if len(ln_heads) > 0:
+        ln_starts = timing[ln_heads] / 1000000.0
+        ln_ends = timing[pair[ln_heads]] / 1000000.0
+        features.ln_hold_time = float((ln_ends - ln_starts).sum())
+        order = np.argsort(ln_starts, kind="stable")
+        ln_starts = ln_starts[order]
+        reach = np.maximum.accumulate(ln_ends[order])
+        gap = ln_starts[1:] > reach[:-1]
+        block_starts = ln_starts[np.concatenate(([True], gap))]
+        block_ends = reach[np.concatenate((gap, [True]))]
+        covered = float((block_ends - block_starts).sum())
+        features.ln_coverage = covered / features.duration if features.duration > 0 else 0.0
+
+def _features_python(arrays: ChartArrays, window: float, step: float, jack_gap: float, features: ChartFeatures):
+    times: list[float] = []
+    lanes: list[int] = []
+    holds: list[tuple[float, float]] = []
+    long_notes = 0
+    scratch_long_notes = 0
+    timing = arrays.timing
+    for t, note_lane, note_kind, other in zip(timing, arrays.lane, arrays.kind, arrays.pair):
+        if note_lane < 0:
+            continue
+        if note_kind == NoteKindNormal or note_kind == NoteKindLongHead:
+            times.append(t / 1000000.0)
+            lanes.append(note_lane)
+            if note_kind == NoteKindLongHead:
+                long_notes += 1
+                if note_lane in ScratchLanes:
+                    scratch_long_notes += 1
+                if other >= 0:
+                    holds.append((t / 1000000.0, timing[other] / 1000000.0))
+    features.notes = len(times)
+    features.scratch_notes = sum(1 for note_lane in lanes if note_lane in ScratchLanes)
+    features.long_notes = long_notes
+    features.scratch_long_notes = scratch_long_notes
+    if len(times) == 0:
+        return
+    features.duration = times[-1] - times[0]
+    peak = 0
+    end = 0
+    for i, t in enumerate(times):
+        while end < len(times) and times[end] < t + window:
+            end += 1
+        peak = max(peak, end - i)
+    features.peak_nps = peak / window
+    curve = []
+    n = 0
+    while n * step < features.duration + step / 2:
+        start = times[0] + n * step
+        curve.append((bisect.bisect_left(times, start + window) - bisect.bisect_left(times, start)) / window)
+        n += 1
+    features.nps_curve = curve
+    features.p90_nps = _nearest_rank(sorted(curve), 0.9)
+    chord_sizes: dict[float, int] = {}
+    for t in times:
+        chord_sizes[t] = chord_sizes.get(t, 0) + 1
+    features.chords = sum(1 for size in chord_sizes.values() if size >= 2)
+    features.max_chord = max(chord_sizes.values())
+    last: dict[int, float] = {}
+    jacks = []
+    for t, note_lane in zip(times, lanes):
+        previous = last.get(note_lane)
+        if previous is not None and t - previous <= jack_gap:
+            jacks.append(t - previous)
+        last[note_lane] = t
+    features.jacks = len(jacks)
+    features.min_jack_gap = min(jacks) if len(jacks) > 0 else 0.0
+    if len(holds) > 0:
+        features.ln_hold_time = sum(end - start for start, end in holds)
+        holds.sort(key=lambda hold: hold[0])
+        covered = 0.0
+        block_start, reach = holds[0]
+        for start, end in holds[1:]:
+            if start > reach:
+                covered += reach - block_start
+                block_start = start
+            reach = max(reach, end)
+        covered += reach - block_start
+        features.ln_coverage = covered / features.duration if features.duration > 0 else 0.0
+
+def analyze(chart: Union[Chart, ChartArrays], window: float = 1.0, step: Union[float, None] = None,
+            jack_gap: float = 0.25, use_numpy: Union[bool, None] = None) -> ChartFeatures:
+    # window and step are in seconds (step defaults to window); jack_gap is the
+    # largest same-lane gap counted as a jack. use_numpy=None picks numpy when
+    # it is installed.
+    if step is None:
+        step = window
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ImportError("numpy is required for use_numpy=True")
+    arrays = chart.to_arrays(use_numpy=use_numpy) if isinstance(chart, Chart) else chart
+    features = ChartFeatures()
+    if use_numpy:
+        _features_numpy(arrays, window, step, jack_gap, features)
+    else:
+        _features_python(arrays, window, step, jack_gap, features)
+    if features.notes > 0:
+        features.average_nps = features.notes / features.duration if features.duration > 0 else float(features.notes)
+        features.chord_ratio = features.chords / features.notes
+        features.scratch_ratio = features.scratch_notes / features.notes
+    return features
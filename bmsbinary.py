@@ -0,0 +1,176 @@
+"""
+ * Copyright (C) 2024 VioletXF, khoeun03
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import array
+import hashlib
+import json
+import mmap
+import struct
+import sys
+from typing import Union
+from bmsparser import Chart, ChartMeta, TimingIndex, numpy
+
+# Compiled chart layout (little-endian):
+#   header     magic "BMSC", version u16, reserved u16, source sha256 (32 bytes), column count u32
+#   directory  per column: name (16 bytes, NUL padded), typecode (1 byte), 7 bytes padding, offset u64, count u64
+#   data       column payloads, each starting on an 8-byte boundary
+# Columns with typecode 'B' named meta/wav_table/bmp_table hold UTF-8 JSON.
+Magic = b"BMSC"
+FormatVersion = 1
+HeaderFormat = struct.Struct("<4sHH32sI")
+EntryFormat = struct.Struct("<16sc7xQQ")
+
+class StaleChartError(ValueError):
+    pass
+
+def _json_column(value):
+    return array.array('B', json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+def chart_columns(chart: Chart) -> dict[str, array.array]:
+    arrays = chart.to_arrays(use_numpy=False)
+    index = chart.timing_index if chart.timing_index is not None else TimingIndex(chart)
+    return {
+        "meta": _json_column(vars(chart.meta)),
+        "wav_table": _json_column(chart.wav_table),
+        "bmp_table": _json_column(chart.bmp_table),
+        "note_timing": arrays.timing,
+        "note_lane": arrays.lane,
+        "note_kind": arrays.kind,
+        "note_wav": arrays.wav,
+        "note_measure": arrays.measure,
+        "note_pair": arrays.pair,
+        "bpm_timing": arrays.bpm_timing,
+        "bpm": arrays.bpm,
+        "stop_timing": arrays.stop_timing,
+        "stop_duration": arrays.stop_duration,
+        "scroll_timing": arrays.scroll_timing,
+        "scroll": arrays.scroll,
+        "measure_timing": array.array('q', (measure.timing for measure in chart.measures)),
+        "measure_scale": array.array('d', (measure.scale for measure in chart.measures)),
+        "point_beat": array.array('d', index.point_beat),
+        "point_time": array.array('d', index.point_time),
+        "point_bpm": array.array('d', index.point_bpm),
+        "point_stop": array.array('d', index.point_stop),
+    }
+
+def compile_chart(chart: Chart) -> bytes:
+    columns = chart_columns(chart)
+    offset = HeaderFormat.size + EntryFormat.size * len(columns)
+    entries = []
+    payloads = []
+    for name, column in columns.items():
+        offset += -offset % 8
+        if sys.byteorder != "little":
+            column = array.array(column.typecode, column)
+            column.byteswap()
+        entries.append(EntryFormat.pack(name.encode("ascii"), column.typecode.encode("ascii"), offset, len(column)))
+        payloads.append((offset, column.tobytes()))
+        offset += len(payloads[-1][1])
+    out = bytearray(offset)
+    HeaderFormat.pack_into(out, 0, Magic, FormatVersion, 0, bytes.fromhex(chart.meta.sha256), len(columns))
+    out[HeaderFormat.size:HeaderFormat.size + EntryFormat.size * len(entries)] = b"".join(entries)
+    for start, payload in payloads:
+        out[start:start + len(payload)] = payload
+    return bytes(out)
+
+def save_compiled(chart: Chart, path: str):
+    with open(path, "wb") as f:
+        f.write(compile_chart(chart))
+
+def file_sha256(path: str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class CompiledChart:
+    # Read-only view over a compiled chart held in any buffer (bytes, mmap,
+    # shared memory). Columns are memoryviews, or numpy arrays with
+    # as_numpy=True, that point straight into the buffer; nothing is copied.
+    def __init__(self, buffer, as_numpy: bool = False):
+        self.buffer = memoryview(buffer).toreadonly()
+        magic, version, _, sha256, count = HeaderFormat.unpack_from(self.buffer, 0)
+        if magic != Magic:
+            raise ValueError("Not a compiled chart")
+        if version != FormatVersion:
+            raise ValueError(f"Unsupported compiled chart version {version}")
+        self.sha256 = sha256.hex()
+        self.as_numpy = as_numpy
+        self.entries: dict[str, tuple[str, int, int]] = {}
+        for i in range(count):
+            name, typecode, offset, length = EntryFormat.unpack_from(self.buffer, HeaderFormat.size + EntryFormat.size * i)
+            self.entries[name.rstrip(b"\0").decode("ascii")] = (typecode.decode("ascii"), offset, length)
+        self._meta: Union[ChartMeta, None] = None
+    def column(self, name: str):
+        typecode, offset, length = self.entries[name]
+        size = array.array(typecode).itemsize
+        view = self.buffer[offset:offset + size * length]
+        if sys.byteorder != "little" and size > 1:
+            swapped = array.array(typecode, view.tobytes())
+            swapped.byteswap()
+            return numpy.frombuffer(swapped, dtype=typecode) if self.as_numpy else memoryview(swapped).toreadonly()
+        if self.as_numpy:
+            return numpy.frombuffer(view, dtype=typecode)
+        return view.cast(typecode)
+    def _json(self, name: str):
+        return json.loads(bytes(self.column(name)).decode("utf-8"))
+    @property
+    def meta(self) -> ChartMeta:
+        if self._meta is None:
+            self._meta = ChartMeta()
+            self._meta.__dict__.update(self._json("meta"))
+        return self._meta
+    @property
+    def wav_table(self) -> dict[int, str]:
+        return {int(k): v for k, v in self._json("wav_table").items()}
+    @property
+    def bmp_table(self) -> dict[int, str]:
+        return {int(k): v for k, v in self._json("bmp_table").items()}
+    def __len__(self):
+        return self.entries["note_timing"][2]
+    def __getattr__(self, name: str):
+        # note_timing, note_lane, bpm, point_beat, ... resolve to columns
+        entries = self.__dict__.get("entries")
+        if entries is not None and name in entries:
+            return self.column(name)
+        raise AttributeError(name)
+    def is_stale(self, source_path: str):
+        return file_sha256(source_path) != self.sha256
+    def release(self):
+        self.buffer.release()
+
+class MappedChart(CompiledChart):
+    # column views must be dropped before close(), mmap refuses to close while they exist
+    def __init__(self, path: str, as_numpy: bool = False):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        super().__init__(self.mmap, as_numpy)
+    def close(self):
+        self.release()
+        self.mmap.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+def load_compiled(path: str, source_path: Union[str, None] = None, as_numpy: bool = False) -> MappedChart:
+    # with source_path, raise StaleChartError if the source changed since compiling
+    chart = MappedChart(path, as_numpy)
+    if source_path is not None and chart.is_stale(source_path):
+        chart.close()
+        raise StaleChartError(f"{path} was compiled from a different version of {source_path}")
+    return chart
@@ -0,0 +1,174 @@
+"""
+ * Copyright (C) 2024 VioletXF, khoeun03
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+from typing import Union
+from bmsparser import BmsParser, Chart, ChartMeta, ParseFull, ParseHeaderOnly, ParseLazy, ParseNoteStats
+
+# which stored parse modes can answer a request for a given mode; ParseLazy
+# fills the same meta as ParseNoteStats and is stored as that
+ModeCovers = {
+    ParseHeaderOnly: (ParseHeaderOnly, ParseNoteStats, ParseFull),
+    ParseNoteStats: (ParseNoteStats, ParseFull),
+    ParseLazy: (ParseNoteStats, ParseFull),
+    ParseFull: (ParseFull,),
+}
+
+# On-disk cache of parse results in a single SQLite file. Entries are keyed by
+# path and stay valid while the file's mtime and size are unchanged; once
+# max_entries or max_bytes is exceeded the least recently used ones are evicted.
+class ParseCache:
+    def __init__(self, db_path: str, max_entries: Union[int, None] = None, max_bytes: Union[int, None] = None):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS charts (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                mode INTEGER NOT NULL,
+                meta TEXT NOT NULL,
+                chart BLOB,
+                bytes INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS charts_last_access ON charts (last_access)")
+        self.db.commit()
+    def close(self):
+        self.commit()
+        self.db.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM charts").fetchone()[0]
+    def _lookup(self, path: str, mode: int, column: str):
+        covers = ModeCovers.get(mode)
+        if covers is None:
+            raise ValueError(f"Unknown parse mode {mode}")
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        row = self.db.execute(
+            f"SELECT {column} FROM charts WHERE path = ? AND mtime_ns = ? AND size = ? AND mode IN ({','.join('?' * len(covers))})",
+            (path, st.st_mtime_ns, st.st_size, *covers)).fetchone()
+        if row is None or row[0] is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE charts SET last_access = ? WHERE path = ?", (time.time(), path))
+        return row[0]
+    def get_meta(self, path: str, mode: int = ParseNoteStats) -> Union[ChartMeta, None]:
+        data = self._lookup(path, mode, "meta")
+        if data is None:
+            return None
+        meta = ChartMeta()
+        meta.__dict__.update(json.loads(data))
+        return meta
+    def get_chart(self, path: str) -> Union[Chart, None]:
+        data = self._lookup(path, ParseFull, "chart")
+        if data is None:
+            return None
+        return pickle.loads(data)
+    def put(self, path: str, meta: ChartMeta, mode: int = ParseNoteStats, chart: Union[Chart, None] = None,
+            stat: Union[tuple[int, int], None] = None):
+        # stat is the (mtime_ns, size) the file had when it was parsed
+        if stat is None:
+            st = os.stat(path)
+            stat = (st.st_mtime_ns, st.st_size)
+        if mode == ParseLazy:
+            mode = ParseNoteStats
+        data = json.dumps(vars(meta), ensure_ascii=False)
+        blob = None
+        if chart is not None and mode == ParseFull:
+            try:
+                blob = pickle.dumps(chart, protocol=pickle.HIGHEST_PROTOCOL)
+            except RecursionError:
+                # very long LN chains nest too deep for pickle; keep the meta only
+                blob = None
+        size = len(data) + (len(blob) if blob is not None else 0)
+        self.db.execute(
+            "INSERT OR REPLACE INTO charts (path, mtime_ns, size, sha256, mode, meta, chart, bytes, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, stat[0], stat[1], meta.sha256, mode, data, blob, size, time.time()))
+    def parse(self, path: str, mode: int = ParseNoteStats, store_chart: bool = False) -> Chart:
+        if mode == ParseFull:
+            cached_chart = self.get_chart(path)
+            if cached_chart is not None:
+                return cached_chart
+        elif mode == ParseLazy:
+            # the measures are built from the file on access, so it is read
+            # anyway; only the meta is stored
+            pass
+        else:
+            cached_meta = self.get_meta(path, mode)
+            if cached_meta is not None:
+                chart = Chart()
+                chart.meta = cached_meta
+                return chart
+        st = os.stat(path)
+        chart = BmsParser(path).parse(mode)
+        self.put(path, chart.meta, mode, chart if store_chart else None, (st.st_mtime_ns, st.st_size))
+        self.commit()
+        return chart
+    def evict(self):
+        if self.max_entries is not None:
+            self.db.execute(
+                "DELETE FROM charts WHERE path IN (SELECT path FROM charts ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+        if self.max_bytes is not None:
+            total = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM charts").fetchone()[0]
+            if total > self.max_bytes:
+                evicted = []
+                for path, size in self.db.execute("SELECT path, bytes FROM charts ORDER BY last_access"):
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((path,))
+                    total -= size
+                self.db.executemany("DELETE FROM charts WHERE path = ?", evicted)
+    def invalidate(self, path: str):
+        self.db.execute("DELETE FROM charts WHERE path = ?", (path,))
+    def verify(self, remove: bool = True) -> list[str]:
+        # re-hash every cached file and report (and by default drop) entries whose
+        # file is gone or whose content no longer matches the stored sha256
+        stale = []
+        for path, sha256 in self.db.execute("SELECT path, sha256 FROM charts").fetchall():
+            try:
+                with open(path, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                digest = None
+            if digest != sha256:
+                stale.append(path)
+        if remove:
+            self.db.executemany("DELETE FROM charts WHERE path = ?", [(path,) for path in stale])
+            self.db.commit()
+        return stale
+    def commit(self):
+        # eviction runs here rather than on every put so bulk inserts stay cheap
+        self.evict()
+        self.db.commit()
@@ -0,0 +1,171 @@
+"""
+ * Copyright (C) 2024 VioletXF, khoeun03
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import array
+import json
+import sys
+from typing import Iterable, Union
+from bmsparser import ChartMeta, MinHashSize
+
+def similarity(a: Iterable[int], b: Iterable[int]) -> float:
+    # share of MinHash slots that agree, an estimate of the Jaccard similarity
+    # of the two charts' (measure, lane) groups
+    a = list(a)
+    b = list(b)
+    if len(a) == 0 or len(a) != len(b):
+        return 0.0
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+class DuplicateGroup:
+    def __init__(self, keys: list, exact: bool):
+        self.keys = keys
+        # every chart in the group has the same fingerprint
+        self.exact = exact
+    def __len__(self):
+        return len(self.keys)
+    def __str__(self):
+        return f"DuplicateGroup({'exact' if self.exact else 'near'}, {len(self.keys)} charts)"
+
+class DuplicateIndex:
+    # Groups charts by ChartMeta.fingerprint (exact duplicates) and by MinHash
+    # (near duplicates). A signature is cut into bands; charts that agree on a
+    # whole band land in the same bucket and are compared with the chart that
+    # opened the bucket only, so adding a chart costs O(bands) whatever the
+    # size of the library. Groups are merged transitively.
+    def __init__(self, threshold: float = 0.8, bands: int = 16):
+        if MinHashSize % bands != 0:
+            raise ValueError(f"bands must divide {MinHashSize}")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = MinHashSize // bands
+        self.keys: list = []
+        self.fingerprints: list[str] = []
+        self.signatures: list[Union[array.array, None]] = []
+        # union-find over chart numbers; members is kept for roots only
+        self.parent = array.array('i')
+        self.members: dict[int, list[int]] = {}
+        # fingerprint -> first chart with it
+        self.by_fingerprint: dict[str, int] = {}
+        # per band: hash of the band's values -> chart that opened the bucket
+        self.buckets: list[dict[int, int]] = [{} for _ in range(bands)]
+    def __len__(self):
+        return len(self.keys)
+    def find(self, i: int):
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+    def union(self, a: int, b: int):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if len(self.members[a]) < len(self.members[b]):
+            a, b = b, a
+        self.parent[b] = a
+        self.members[a] += self.members.pop(b)
+    def band_keys(self, signature: array.array):
+        rows = self.rows
+        return [hash(signature[band*rows:(band+1)*rows].tobytes()) for band in range(self.bands)]
+    def add(self, key, fingerprint: str, minhash: Iterable[int]) -> int:
+        # key is anything that identifies the chart (a path, a ChartMeta, ...);
+        # charts without a fingerprint (ParseHeaderOnly) are kept but never grouped
+        i = len(self.keys)
+        self.keys.append(key)
+        self.fingerprints.append(fingerprint)
+        self.parent.append(i)
+        self.members[i] = [i]
+        signature = array.array('I', minhash)
+        self.signatures.append(signature if len(signature) == MinHashSize else None)
+        if len(fingerprint) == 0:
+            return i
+        first = self.by_fingerprint.get(fingerprint)
+        if first is not None:
+            # same notes and timing; the first chart already sits in the buckets
+            self.union(first, i)
+            return i
+        self.by_fingerprint[fingerprint] = i
+        if self.signatures[i] is None:
+            return i
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            head = bucket.get(band_key)
+            if head is None:
+                bucket[band_key] = i
+            elif self.find(head) != self.find(i) and self.similar(head, i):
+                self.union(head, i)
+        return i
+    def add_meta(self, key, meta: ChartMeta) -> int:
+        return self.add(key, meta.fingerprint, meta.minhash)
+    def similar(self, a: int, b: int):
+        return similarity(self.signatures[a], self.signatures[b]) >= self.threshold # type: ignore
+    def query(self, fingerprint: str, minhash: Iterable[int]) -> list:
+        # keys of every indexed chart grouped with a chart like this one,
+        # without adding it
+        found: set[int] = set()
+        first = self.by_fingerprint.get(fingerprint) if len(fingerprint) > 0 else None
+        if first is not None:
+            found.add(self.find(first))
+        signature = array.array('I', minhash)
+        if len(signature) == MinHashSize:
+            for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+                head = bucket.get(band_key)
+                if head is not None and similarity(self.signatures[head], signature) >= self.threshold: # type: ignore
+                    found.add(self.find(head))
+        return [self.keys[i] for root in sorted(found) for i in self.members[root]]
+    def groups(self, min_size: int = 2) -> list[DuplicateGroup]:
+        groups = []
+        for root, members in self.members.items():
+            if len(members) < min_size:
+                continue
+            fingerprint = self.fingerprints[root]
+            exact = all(self.fingerprints[i] == fingerprint for i in members)
+            groups.append(DuplicateGroup([self.keys[i] for i in sorted(members)], exact))
+        groups.sort(key=lambda group: -len(group))
+        return groups
+
+def index_scan(lines: Iterable[str], threshold: float = 0.8, bands: int = 16) -> DuplicateIndex:
+    # build an index from the JSON lines written by bmsscan; failed charts are skipped
+    index = DuplicateIndex(threshold, bands)
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        result = json.loads(line)
+        meta = result.get("meta")
+        if meta is None:
+            continue
+        index.add(result["path"], meta.get("fingerprint", ""), meta.get("minhash", []))
+    return index
+
+def main(argv: Union[list[str], None] = None):
+    parser = argparse.ArgumentParser(description="Group duplicate charts of a bmsscan JSON lines file")
+    parser.add_argument("scan", help="output of bmsscan.py --fingerprint (-m stats or full)")
+    parser.add_argument("-t", "--threshold", type=float, default=0.8, help="estimated similarity for near duplicates")
+    parser.add_argument("--bands", type=int, default=16, help=f"LSH bands; must divide {MinHashSize}")
+    args = parser.parse_args(argv)
+    with open(args.scan, encoding="utf-8") as f:
+        index = index_scan(f, args.threshold, args.bands)
+    if len(index) > 0 and all(len(fingerprint) == 0 for fingerprint in index.fingerprints):
+        print(f"{args.scan} has no fingerprints; scan with bmsscan.py --fingerprint", file=sys.stderr)
+    for group in index.groups():
+        print(json.dumps({"exact": group.exact, "paths": group.keys}, ensure_ascii=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,12 +14,23 @@
  * along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import array
+import bisect
+import codecs
+import copy
 import hashlib
+import math
 import random
 import re
+import time
 from collections import OrderedDict
+from fractions import Fraction
 import os
-from typing import Union
+from typing import Iterable, Union
+try:
+    import numpy
+except ImportError:
+    numpy = None
 LaneAutoplay = 1
 SectionRate = 2
 BpmChange = 3
@@ -40,9 +51,55 @@ P2MineKeyBase = 14 * 36 + 1
 
 Scroll = 1020
 
+ParseFull = 0
+ParseHeaderOnly = 1
+ParseNoteStats = 2
+ParseLazy = 3
+
+# what lenient parses time a chart without a usable #BPM with
+DefaultBpm = 130.0
+
+SeverityInfo = 0
+SeverityWarning = 1
+SeverityError = 2
+SeverityNames = ("info", "warning", "error")
+
+# measures at most this fine are grouped into timelines by a tick-indexed list
+MaxBucketResolution = 4096
+
+# slots of ChartMeta.minhash
+MinHashSize = 64
+
+NoteKindNormal = 0
+NoteKindLongHead = 1
+NoteKindLongTail = 2
+NoteKindLandmine = 3
+NoteKindInvisible = 4
+NoteKindBackground = 5
+
+# EventStream.type; events of one timeline are kept in this order
+EventBpm = 0
+EventScroll = 1
+EventBgaBase = 2
+EventBgaLayer = 3
+EventBgaPoor = 4
+EventNote = 5
+EventLongHead = 6
+EventLongTail = 7
+EventInvisible = 8
+EventLandmine = 9
+EventBgm = 10
+EventStop = 11
+
 Beat7 = [0, 1, 2, 3, 4, 7, -1, 5, 6, 8, 9, 10, 11, 12, 15, -1, 13, 14]
 
+# shared placeholders for lanes that never received a note; TimeLine swaps in a
+# real list on first write, so most timelines only ever allocate `notes`
+EmptyLanes: tuple = (None,) * 16
+EmptyNotes: tuple = ()
+
 class Note:
+    __slots__ = ('lane', 'wav', 'timeline', 'is_played', 'is_dead', 'played_time')
     def __init__(self, wav: int):
         self.lane = 0
         self.wav = wav
@@ -64,15 +121,17 @@ class Note:
         self.is_dead = False
         self.played_time = 0
 class LandmineNote(Note):
+    __slots__ = ('damage',)
     def __init__(self, damage: float):
+        super().__init__(-1)
         self.lane = -1
-        self.timeline = None
         self.damage = damage
     def is_long_note(self):
         return False
     def is_landmine_note(self):
         return True
 class LongNote(Note):
+    __slots__ = ('tail', 'head', 'is_holding', 'release_time')
     def __init__(self, wav: int):
         super().__init__(wav)
         self.tail: Union[LongNote, None] = None
@@ -101,11 +160,15 @@ class LongNote(Note):
         self.is_holding = False
         self.release_time = 0
 class TimeLine:
+    __slots__ = ('background_notes', 'invisible_notes', 'notes', 'landmine_notes', 'bpm', 'bpm_change',
+                 'bpm_change_applied', 'bga_base', 'bga_layer', 'bga_poor', 'stop_length', 'scroll',
+                 'scroll_change', 'timing', 'position', 'tick', 'visual')
     def __init__(self):
-        self.background_notes: list[Note] = []
-        self.invisible_notes: list[Union[Note, None]] = [None for _ in range(16)]
-        self.notes: list[Union[Note, None]] = [None for _ in range(16)]
-        self.landmine_notes: list[Union[LandmineNote, None]] = [None for _ in range(16)]
+        # lane lists start as shared read-only placeholders; write through set_*/add_*
+        self.background_notes: list[Note] = EmptyNotes # type: ignore
+        self.invisible_notes: list[Union[Note, None]] = EmptyLanes # type: ignore
+        self.notes: list[Union[Note, None]] = EmptyLanes # type: ignore
+        self.landmine_notes: list[Union[LandmineNote, None]] = EmptyLanes # type: ignore
         self.bpm = 0.0
         self.bpm_change = False
         self.bpm_change_applied = False
@@ -114,33 +177,52 @@ class TimeLine:
         self.bga_poor = -1
         self.stop_length = 0.0
         self.scroll = 1.0
+        self.scroll_change = False
         self.timing = 0
+        # fraction of the measure, 0 <= position < 1
+        self.position = 0.0
+        # position in ticks of the measure's resolution
+        self.tick = 0
+        # visual beats from the chart start: beats scaled by the scroll speed in
+        # effect, the coordinate the highway is drawn in (stops do not move it)
+        self.visual = 0.0
     def set_note(self, lane: int, note: Note):
+        if self.notes is EmptyLanes:
+            self.notes = [None] * 16
         self.notes[lane] = note
         note.lane = lane
         note.timeline = self
         return self
     def set_invisible_note(self, lane: int, note: Note):
+        if self.invisible_notes is EmptyLanes:
+            self.invisible_notes = [None] * 16
         self.invisible_notes[lane] = note
         note.lane = lane
         note.timeline = self
         return self
     def set_landmine_note(self, lane: int, note: LandmineNote):
+        if self.landmine_notes is EmptyLanes:
+            self.landmine_notes = [None] * 16
         self.landmine_notes[lane] = note
         note.lane = lane
         note.timeline = self
         return self
     def add_background_note(self, note: Note):
+        if self.background_notes is EmptyNotes:
+            self.background_notes = []
         self.background_notes.append(note)
         note.timeline = self
         return self
     def get_stop_duration(self):
         return 1250000.0 * self.stop_length / self.bpm
 class Measure:
+    __slots__ = ('scale', 'timing', 'timelines', 'resolution')
     def __init__(self):
         self.scale = 1.0
         self.timing = 0
         self.timelines: list[TimeLine] = []
+        # ticks per measure: the lcm of the lengths of its channel lines
+        self.resolution = 1
 
 class ChartMeta:
     def __init__(self):
@@ -175,6 +257,13 @@ class ChartMeta:
         self.total_scratch_notes = 0
         self.total_backspin_notes = 0
         self.lnmode = 0
+        # codec header strings were decoded with; "ascii" when there was nothing to detect
+        self.encoding = ""
+        # sha256 of the normalized note and timing stream; filled by
+        # BmsParser(fingerprint=True) in any mode but ParseHeaderOnly
+        self.fingerprint = ""
+        # MinHash signature of the same stream, MinHashSize values or empty
+        self.minhash: list[int] = []
     def get_key_lane_count(self):
         return self.key_mode
     def get_scratch_lane_count(self):
@@ -221,19 +310,789 @@ class ChartMeta:
         Total Backspin Notes: {self.total_backspin_notes}
         LN Mode: {self.lnmode}
         """
+class ChartArrays:
+    # Columnar view of a chart. Note columns share one index and are ordered by
+    # timing; lane is -1 for background notes and wav is -1 for landmines.
+    # Columns are numpy arrays when numpy is installed, array.array otherwise.
+    def __init__(self):
+        self.timing = array.array('q')
+        self.lane = array.array('b')
+        self.kind = array.array('b')
+        self.wav = array.array('i')
+        self.measure = array.array('i')
+        # row of the other end of a long note, -1 for everything else
+        self.pair = array.array('i')
+        self.bpm_timing = array.array('q')
+        self.bpm = array.array('d')
+        self.stop_timing = array.array('q')
+        self.stop_duration = array.array('d')
+        self.scroll_timing = array.array('q')
+        self.scroll = array.array('d')
+    def __len__(self):
+        return len(self.timing)
+    def to_numpy(self):
+        if numpy is None:
+            raise ImportError("numpy is required for use_numpy=True")
+        for name, column in vars(self).items():
+            if isinstance(column, array.array):
+                setattr(self, name, numpy.frombuffer(column, dtype=column.typecode))
+        return self
+class EventStream:
+    # Every playback event of a chart in one flat buffer ordered by timing (us):
+    # keysounds, BGM, BGA switches, BPM changes, stops and scroll changes.
+    # id is the wav or bmp id (-1 if none), lane is -1 for events that are not
+    # on a lane, value is the BPM, scroll, landmine damage or stop duration (us)
+    # and pair the row of the other end of a long note.
+    def __init__(self, bpm: float = 0.0):
+        self.timing = array.array('q')
+        self.type = array.array('b')
+        self.lane = array.array('b')
+        self.id = array.array('i')
+        self.value = array.array('d')
+        self.pair = array.array('i')
+        # state before the first event
+        self.initial_bpm = bpm
+        # type -> rows of that type, for restoring state on seek
+        self.changes: dict[int, array.array] = {kind: array.array('i') for kind in EventCursor.StateTypes}
+    def __len__(self):
+        return len(self.timing)
+    def append(self, timing: int, kind: int, lane: int = -1, id: int = -1, value: float = 0.0):
+        changes = self.changes.get(kind)
+        if changes is not None:
+            changes.append(len(self.timing))
+        self.timing.append(timing)
+        self.type.append(kind)
+        self.lane.append(lane)
+        self.id.append(id)
+        self.value.append(value)
+    def event(self, i: int):
+        # (timing, type, lane, id, value)
+        return self.timing[i], self.type[i], self.lane[i], self.id[i], self.value[i]
+    def index_at(self, time: int):
+        # first event at or after time
+        return bisect.bisect_left(self.timing, time)
+    def iter_events(self, start: int = 0, end: Union[int, None] = None):
+        # event tuples with start <= timing < end
+        last = len(self.timing) if end is None else bisect.bisect_left(self.timing, end)
+        for i in range(self.index_at(start), last):
+            yield self.event(i)
+    def __iter__(self):
+        return self.iter_events()
+    def cursor(self, time: int = 0) -> 'EventCursor':
+        return EventCursor(self, time)
+class EventCursor:
+    # Playback position in an EventStream. poll() hands out the rows that came
+    # due since the last call and keeps the current BPM, scroll and BGA layers;
+    # seek() jumps anywhere and restores them with a bisect per state type.
+    StateTypes = (EventBpm, EventScroll, EventBgaBase, EventBgaLayer, EventBgaPoor)
+    def __init__(self, stream: EventStream, time: int = 0):
+        self.stream = stream
+        self.index = 0
+        self.time = time
+        self.bpm = stream.initial_bpm
+        self.scroll = 1.0
+        self.bga_base = -1
+        self.bga_layer = -1
+        self.bga_poor = -1
+        self.seek(time)
+    def seek(self, time: int):
+        # events before time count as played; the one at time comes next
+        stream = self.stream
+        self.time = time
+        self.index = index = stream.index_at(time)
+        for kind in self.StateTypes:
+            rows = stream.changes[kind]
+            k = bisect.bisect_left(rows, index)
+            if k > 0:
+                self.apply(rows[k - 1])
+            elif kind == EventBpm:
+                self.bpm = stream.initial_bpm
+            elif kind == EventScroll:
+                self.scroll = 1.0
+            elif kind == EventBgaBase:
+                self.bga_base = -1
+            elif kind == EventBgaLayer:
+                self.bga_layer = -1
+            else:
+                self.bga_poor = -1
+    def apply(self, row: int):
+        stream = self.stream
+        kind = stream.type[row]
+        if kind == EventBpm:
+            self.bpm = stream.value[row]
+        elif kind == EventScroll:
+            self.scroll = stream.value[row]
+        elif kind == EventBgaBase:
+            self.bga_base = stream.id[row]
+        elif kind == EventBgaLayer:
+            self.bga_layer = stream.id[row]
+        elif kind == EventBgaPoor:
+            self.bga_poor = stream.id[row]
+    def poll(self, now: int) -> range:
+        # rows with timing <= now that were not handed out yet
+        timing = self.stream.timing
+        start = end = self.index
+        count = len(timing)
+        while end < count and timing[end] <= now:
+            if self.stream.type[end] <= EventBgaPoor:
+                self.apply(end)
+            end += 1
+        self.index = end
+        self.time = now
+        return range(start, end)
+    def lookahead(self, window: int) -> range:
+        # upcoming rows within window us after the last poll, not consumed
+        return range(self.index, bisect.bisect_right(self.stream.timing, self.time + window))
+    def finished(self):
+        return self.index >= len(self.stream.timing)
+class TimingIndex:
+    # Sorted timing breakpoints of a parsed chart for bisect lookups between time
+    # (us), beat (quarter notes from the start) and measure position. A point is
+    # kept at the chart start and at every timeline that changes BPM or stops;
+    # point_time is the time the point is reached, before its stop.
+    def __init__(self, chart: 'Chart'):
+        self.measure_beat: list[float] = []
+        self.measure_length: list[float] = []
+        self.point_beat: list[float] = [0.0]
+        self.point_time: list[float] = [0.0]
+        self.point_bpm: list[float] = [chart.meta.bpm]
+        self.point_stop: list[float] = [0.0]
+        self.scroll_time: list[int] = []
+        self.scroll_value: list[float] = []
+        # scroll changes by beat, with the visual position they happen at
+        self.scroll_beat: list[float] = [0.0]
+        self.scroll_visual: list[float] = [0.0]
+        self.scroll_speed: list[float] = [1.0]
+        self.note_time: list[int] = []
+        self.notes: list[Note] = []
+        # notes ordered by TimeLine.visual, for notes_in_view
+        self.view_visual: list[float] = []
+        self.view_notes: list[Note] = []
+        # long note heads ordered the same way, with the visual position of their tail
+        self.long_visual: list[float] = []
+        self.long_end: list[float] = []
+        self.long_notes: list[Note] = []
+        # longest head to tail distance, how far below the view a head can be
+        self.long_span = 0.0
+        beat = 0.0
+        for measure in chart.measures:
+            length = 4.0 * measure.scale
+            self.measure_beat.append(beat)
+            self.measure_length.append(length)
+            for timeline in measure.timelines:
+                if timeline.bpm_change or timeline.stop_length > 0:
+                    self.point_beat.append(beat + length * timeline.position)
+                    self.point_time.append(float(timeline.timing))
+                    self.point_bpm.append(timeline.bpm)
+                    self.point_stop.append(timeline.get_stop_duration())
+                if timeline.scroll_change:
+                    self.scroll_time.append(timeline.timing)
+                    self.scroll_value.append(timeline.scroll)
+                    self.scroll_beat.append(beat + length * timeline.position)
+                    self.scroll_visual.append(timeline.visual)
+                    self.scroll_speed.append(timeline.scroll)
+                for note in timeline.notes:
+                    if note is not None:
+                        self.note_time.append(timeline.timing)
+                        self.notes.append(note)
+                        self.view_visual.append(timeline.visual)
+                        tail = note.tail if isinstance(note, LongNote) else None
+                        if tail is not None and tail.timeline is not None:
+                            self.long_visual.append(timeline.visual)
+                            self.long_end.append(tail.timeline.visual)
+                            self.long_notes.append(note)
+                            self.long_span = max(self.long_span, tail.timeline.visual - timeline.visual)
+            beat += length
+        self.total_beats = beat
+        self.view_notes = self.notes
+        if any(a > b for a, b in zip(self.view_visual, self.view_visual[1:])):
+            # a negative scroll runs the highway backwards; order by position instead
+            order = sorted(range(len(self.view_visual)), key=self.view_visual.__getitem__)
+            self.view_visual = [self.view_visual[k] for k in order]
+            self.view_notes = [self.notes[k] for k in order]
+            order = sorted(range(len(self.long_visual)), key=self.long_visual.__getitem__)
+            self.long_visual = [self.long_visual[k] for k in order]
+            self.long_end = [self.long_end[k] for k in order]
+            self.long_notes = [self.long_notes[k] for k in order]
+    def time_at_beat(self, beat: float):
+        k = max(bisect.bisect_right(self.point_beat, beat) - 1, 0)
+        if beat == self.point_beat[k]:
+            return int(self.point_time[k])
+        return int(self.point_time[k] + self.point_stop[k] + (beat - self.point_beat[k]) * 60000000.0 / self.point_bpm[k])
+    def beat_at(self, time: float):
+        k = max(bisect.bisect_right(self.point_time, time) - 1, 0)
+        elapsed = time - self.point_time[k] - self.point_stop[k]
+        if elapsed <= 0:
+            return self.point_beat[k]
+        return self.point_beat[k] + elapsed * self.point_bpm[k] / 60000000.0
+    def time_at(self, measure: int, fraction: float = 0.0):
+        return self.time_at_beat(self.measure_beat[measure] + self.measure_length[measure] * fraction)
+    def position_at(self, time: float):
+        # (measure index, fraction of that measure); past the last measure the fraction exceeds 1
+        beat = self.beat_at(time)
+        measure = max(bisect.bisect_right(self.measure_beat, beat) - 1, 0)
+        return measure, (beat - self.measure_beat[measure]) / self.measure_length[measure]
+    def bpm_at(self, time: float):
+        return self.point_bpm[max(bisect.bisect_right(self.point_time, time) - 1, 0)]
+    def scroll_at(self, time: float):
+        k = bisect.bisect_right(self.scroll_time, time) - 1
+        return self.scroll_value[k] if k >= 0 else 1.0
+    def notes_in_window(self, start: float, end: float, lanes: Union[Iterable[int], None] = None):
+        # playable notes with start <= timing < end
+        notes = self.notes[bisect.bisect_left(self.note_time, start):bisect.bisect_left(self.note_time, end)]
+        if lanes is None:
+            return notes
+        lanes = set(lanes)
+        return [note for note in notes if note.lane in lanes]
+    def visual_at(self, time: float):
+        # position of the judge line; it holds still during stops
+        beat = self.beat_at(time)
+        k = max(bisect.bisect_right(self.scroll_beat, beat) - 1, 0)
+        return self.scroll_visual[k] + (beat - self.scroll_beat[k]) * self.scroll_speed[k]
+    def notes_in_view(self, time: float, hispeed: float = 1.0, length: float = 4.0,
+                      lanes: Union[Iterable[int], None] = None):
+        # Notes on screen at time, judge line first: those with
+        # visual_at(time) <= timeline.visual < visual_at(time) + length / hispeed,
+        # length being the visual beats the lane shows at hispeed 1. Long note
+        # heads below the view come first when their tail is in or above it.
+        # A note is drawn (timeline.visual - visual_at(time)) * hispeed beats up.
+        start = self.visual_at(time)
+        end = start + length / hispeed
+        notes = self.view_notes[bisect.bisect_left(self.view_visual, start):bisect.bisect_left(self.view_visual, end)]
+        first = bisect.bisect_left(self.long_visual, start - self.long_span)
+        last = bisect.bisect_left(self.long_visual, start)
+        held = [self.long_notes[k] for k in range(first, last) if self.long_end[k] >= start]
+        if len(held) > 0:
+            notes = held + notes
+        if lanes is None:
+            return notes
+        lanes = set(lanes)
+        return [note for note in notes if note.lane in lanes]
+class Diagnostic:
+    __slots__ = ('severity', 'line', 'code', 'message')
+    def __init__(self, severity: int, line: int, code: str, message: str):
+        self.severity = severity
+        # 1-based, 0 when not tied to a line
+        self.line = line
+        self.code = code
+        self.message = message
+    def __str__(self):
+        return f"{SeverityNames[self.severity]} line {self.line}: {self.message} [{self.code}]"
+class Diagnostics:
+    # Problems found while parsing one chart. Every add() is counted per code,
+    # but only the first limit_per_code of a code and limit in total are kept,
+    # so a chart with thousands of bad lines costs a few counters, not a log.
+    def __init__(self, limit: int = 200, limit_per_code: int = 20):
+        self.limit = limit
+        self.limit_per_code = limit_per_code
+        self.entries: list[Diagnostic] = []
+        self.counts: dict[str, int] = {}
+        # added but not kept
+        self.suppressed = 0
+        # highest Severity* added, -1 while empty
+        self.max_severity = -1
+    def add(self, severity: int, line: int, code: str, message: str):
+        n = self.counts.get(code, 0) + 1
+        self.counts[code] = n
+        if severity > self.max_severity:
+            self.max_severity = severity
+        if n > self.limit_per_code or len(self.entries) >= self.limit:
+            self.suppressed += 1
+            return
+        self.entries.append(Diagnostic(severity, line, code, message))
+    def __len__(self):
+        return len(self.entries) + self.suppressed
+    def __iter__(self):
+        return iter(self.entries)
+    def has_errors(self):
+        return self.max_severity >= SeverityError
+    def as_dict(self):
+        return {
+            "counts": dict(self.counts),
+            "suppressed": self.suppressed,
+            "entries": [[SeverityNames[d.severity], d.line, d.code, d.message] for d in self.entries],
+        }
+    def __str__(self):
+        lines = [str(d) for d in self.entries]
+        if self.suppressed > 0:
+            lines.append(f"... {self.suppressed} more")
+        return "\n".join(lines)
 class Chart:
     def __init__(self):
         self.meta = ChartMeta()
         self.measures: list[Measure] = []
         self.wav_table: dict[int, str] = {}
         self.bmp_table: dict[int, str] = {}
+        # built by a full parse
+        self.timing_index: Union[TimingIndex, None] = None
+        # filled by the parser that built the chart
+        self.diagnostics = Diagnostics()
+    def to_arrays(self, use_numpy: Union[bool, None] = None):
+        # use_numpy=None picks numpy when it is available
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ImportError("numpy is required for use_numpy=True")
+        arrays = ChartArrays()
+        timing = arrays.timing
+        lane = arrays.lane
+        kind = arrays.kind
+        wav = arrays.wav
+        measure_index = arrays.measure
+        # id(long note) -> (note, row)
+        long_rows: dict[int, tuple] = {}
+        def add(note: Note, note_lane: int, note_kind: int, timeline_timing: int, i: int):
+            if note.is_landmine_note():
+                note_kind = NoteKindLandmine
+            elif note.is_long_note():
+                note_kind = NoteKindLongTail if note.is_tail() else NoteKindLongHead
+                long_rows[id(note)] = (note, len(timing))
+            timing.append(timeline_timing)
+            lane.append(note_lane)
+            kind.append(note_kind)
+            wav.append(note.wav)
+            measure_index.append(i)
+        for i, measure in enumerate(self.measures):
+            for timeline in measure.timelines:
+                t = timeline.timing
+                if timeline.bpm_change:
+                    arrays.bpm_timing.append(t)
+                    arrays.bpm.append(timeline.bpm)
+                if timeline.stop_length > 0:
+                    arrays.stop_timing.append(t)
+                    arrays.stop_duration.append(timeline.get_stop_duration())
+                if timeline.scroll_change:
+                    arrays.scroll_timing.append(t)
+                    arrays.scroll.append(timeline.scroll)
+                for note_lane, note in enumerate(timeline.notes):
+                    if note is not None:
+                        add(note, note_lane, NoteKindNormal, t, i)
+                for note_lane, note in enumerate(timeline.invisible_notes):
+                    if note is not None:
+                        add(note, note_lane, NoteKindInvisible, t, i)
+                for note_lane, note in enumerate(timeline.landmine_notes):
+                    if note is not None:
+                        add(note, note_lane, NoteKindLandmine, t, i)
+                for note in timeline.background_notes:
+                    add(note, -1, NoteKindBackground, t, i)
+        arrays.pair = pair = array.array('i', [-1]) * len(timing)
+        for note, row in long_rows.values():
+            other = long_rows.get(id(note.head if note.is_tail() else note.tail))
+            if other is not None:
+                pair[row] = other[1]
+        if use_numpy:
+            arrays.to_numpy()
+        return arrays
+    def to_events(self) -> EventStream:
+        # timelines are already in timing order, so the buffer is filled in one
+        # walk; events of a timeline go in Event* order (stops last)
+        stream = EventStream(self.meta.bpm)
+        append = stream.append
+        # id(long note) -> (note, row)
+        long_rows: dict[int, tuple] = {}
+        for measure in self.measures:
+            for timeline in measure.timelines:
+                t = timeline.timing
+                if timeline.bpm_change:
+                    append(t, EventBpm, value=timeline.bpm)
+                if timeline.scroll_change:
+                    append(t, EventScroll, value=timeline.scroll)
+                if timeline.bga_base != -1:
+                    append(t, EventBgaBase, id=timeline.bga_base)
+                if timeline.bga_layer != -1:
+                    append(t, EventBgaLayer, id=timeline.bga_layer)
+                if timeline.bga_poor != -1:
+                    append(t, EventBgaPoor, id=timeline.bga_poor)
+                for note_lane, note in enumerate(timeline.notes):
+                    if note is None:
+                        continue
+                    if note.is_landmine_note():
+                        append(t, EventLandmine, note_lane, value=note.damage) # type: ignore
+                    elif note.is_long_note():
+                        long_rows[id(note)] = (note, len(stream))
+                        append(t, EventLongTail if note.is_tail() else EventLongHead, note_lane, note.wav) # type: ignore
+                    else:
+                        append(t, EventNote, note_lane, note.wav)
+                for note_lane, note in enumerate(timeline.invisible_notes):
+                    if note is not None:
+                        append(t, EventInvisible, note_lane, note.wav)
+                for note_lane, note in enumerate(timeline.landmine_notes):
+                    if note is not None:
+                        append(t, EventLandmine, note_lane, value=note.damage)
+                for note in timeline.background_notes:
+                    append(t, EventBgm, id=note.wav)
+                if timeline.stop_length > 0:
+                    append(t, EventStop, value=timeline.get_stop_duration())
+        stream.pair = pair = array.array('i', [-1]) * len(stream)
+        for note, row in long_rows.values():
+            other = long_rows.get(id(note.head if note.is_tail() else note.tail))
+            if other is not None:
+                pair[row] = other[1]
+        return stream
     def __str__(self):
         return f"Chart: {self.meta.title} Meta: {self.meta}"
     def __repr__(self):
         return self.__str__()
+def resolve_channel(channel: int):
+    if channel >= P1KeyBase and channel < P1KeyBase + 9:
+        return P1KeyBase, Beat7[channel - P1KeyBase]
+    elif channel >= P2KeyBase and channel < P2KeyBase + 9:
+        return P1KeyBase, Beat7[channel - P2KeyBase + 9]
+    elif channel >= P1InvisibleKeyBase and channel < P1InvisibleKeyBase + 9:
+        return P1InvisibleKeyBase, Beat7[channel - P1InvisibleKeyBase]
+    elif channel >= P2InvisibleKeyBase and channel < P2InvisibleKeyBase + 9:
+        return P1InvisibleKeyBase, Beat7[channel - P2InvisibleKeyBase + 9]
+    elif channel >= P1LongKeyBase and channel < P1LongKeyBase + 9:
+        return P1LongKeyBase, Beat7[channel - P1LongKeyBase]
+    elif channel >= P2LongKeyBase and channel < P2LongKeyBase + 9:
+        return P1LongKeyBase, Beat7[channel - P2LongKeyBase + 9]
+    elif channel >= P1MineKeyBase and channel < P1MineKeyBase + 9:
+        return P1MineKeyBase, Beat7[channel - P1MineKeyBase]
+    elif channel >= P2MineKeyBase and channel < P2MineKeyBase + 9:
+        return P1MineKeyBase, Beat7[channel - P2MineKeyBase + 9]
+    return channel, 0
+
+# base36 channel id -> (normalized channel, lane); lane is -1 for unused key slots
+ChannelTable = [resolve_channel(channel) for channel in range(36 * 36)]
+
+# header -> (ChartMeta field, converter)
+MetaHeaders = {
+    "PLAYER": ("player", int),
+    "GENRE": ("genre", str),
+    "TITLE": ("title", str),
+    "SUBTITLE": ("subtitle", str),
+    "ARTIST": ("artist", str),
+    "SUBARTIST": ("subartist", str),
+    "DIFFICULTY": ("difficulty", int),
+    "PLAYLEVEL": ("play_level", int),
+    "RANK": ("rank", int),
+    "STAGEFILE": ("stage_file", str),
+    "BANNER": ("banner", str),
+    "BACKBMP": ("backbmp", str),
+    "PREVIEW": ("preview", str),
+    "LNMODE": ("lnmode", int),
+}
+
+# headers followed by a two-character index, keyed by their first three letters
+IndexedHeaders = {b"WAV": "WAV", b"BMP": "BMP", b"BPM": "BPM", b"STO": "STOP", b"SCR": "SCROLL"}
+
+ControlFlowHeaders = frozenset(("IF", "ELSE", "ELSEIF", "ENDIF", "RANDOM", "RONDAM", "SETRANDOM", "ENDRANDOM"))
+
+HeaderWord = re.compile(rb"#([A-Za-z]+)")
+# channel data every note pass decodes without raising; a trailing odd character is ignored
+ObjectData = re.compile(r"(?:[0-9A-Za-z]{2})*.?", re.S)
+HexData = re.compile(r"[0-9A-Fa-f]*")
+# channels whose object values the note passes read
+ObjectChannels = frozenset((LaneAutoplay, BpmChange, BgaPlay, PoorPlay, LayerPlay, BpmChangeExtend, Stop, Scroll,
+                            P1KeyBase, P1InvisibleKeyBase, P1LongKeyBase, P1MineKeyBase))
+
+Base36Digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+Base62Digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# two-character object -> id; base36 is case-insensitive like int(s, 36)
+Base36Pairs = {a + b: int(a + b, 36) for a in Base36Digits + Base36Digits.lower() for b in Base36Digits + Base36Digits.lower()}
+# every object digit to "1" and "0" to itself
+NonZeroDigits = str.maketrans({c: "1" for c in Base62Digits[1:]})
+Base62Pairs = {a + b: i * 62 + j for i, a in enumerate(Base62Digits) for j, b in enumerate(Base62Digits)}
+
+TokenHeader = 0
+TokenChannel = 1
+TokenControl = 2
+TokenInvalid = 3
+
+# candidates for text without a BOM, in order; cp932 and cp949 are the
+# Windows supersets of Shift_JIS and EUC-KR that charts are actually saved in
+DetectEncodings = ("utf-8", "cp932", "euc-kr", "cp949")
+
+def _japanese_score(text: str):
+    # kana, kanji and fullwidth forms; halfwidth katakana is what EUC-KR bytes
+    # mostly turn into when read as Shift_JIS
+    score = 0
+    for c in text:
+        o = ord(c)
+        if 0x3040 <= o <= 0x30FF or 0x4E00 <= o <= 0x9FFF or 0xFF01 <= o <= 0xFF5E:
+            score += 1
+        elif 0xFF61 <= o <= 0xFF9F:
+            score -= 2
+    return score
+
+def _korean_score(text: str):
+    return sum(1 for c in text if 0xAC00 <= ord(c) <= 0xD7A3 or 0x4E00 <= ord(c) <= 0x9FFF)
+
+def detect_encoding(data: bytes) -> Union[str, None]:
+    # None for ASCII, which every candidate decodes alike. Valid UTF-8 is
+    # taken as UTF-8 (legacy multibyte text almost never is); otherwise the
+    # Japanese and Korean readings are scored by script, ties going to cp932.
+    if data.startswith(codecs.BOM_UTF8):
+        return "utf-8"
+    if data.isascii():
+        return None
+    texts: dict[str, str] = {}
+    for encoding in DetectEncodings:
+        try:
+            texts[encoding] = data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        if encoding == "utf-8":
+            return encoding
+    japanese = texts.get("cp932")
+    korean = texts.get("euc-kr", texts.get("cp949"))
+    if japanese is not None and (korean is None or _japanese_score(japanese) >= _korean_score(korean)):
+        return "cp932"
+    if korean is not None:
+        return "cp949"
+    return "cp932"
+
+# line length -> its prime factors, for _reduce_bits
+PrimeFactors: dict[int, list[int]] = {}
+
+def _reduce_bits(bits: str):
+    # "10001000" -> "11": drop the zero padding a line was written with
+    primes = PrimeFactors.get(len(bits))
+    if primes is None:
+        primes = []
+        n = len(bits)
+        p = 2
+        while p * p <= n:
+            if n % p == 0:
+                primes.append(p)
+                while n % p == 0:
+                    n //= p
+            p += 1
+        if n > 1:
+            primes.append(n)
+        PrimeFactors[len(bits)] = primes
+    ones = bits.count("1")
+    for p in primes:
+        while len(bits) % p == 0 and bits[::p].count("1") == ones:
+            bits = bits[::p]
+    return bits
+
+class ParseStats:
+    # Wall time per parse phase (seconds) and parse counters, filled in by
+    # BmsParser(path, stats=...). Parsers without stats skip all of this.
+    # One instance may be shared by many parsers to aggregate a whole scan.
+    #   phases   tokenize, hash, line_loop, headers, control_flow, fingerprint,
+    #            key_mode, count_notes, expand, timing, timing_index
+    #   counters lines, headers, control_flow, channel_lines, channel_objects,
+    #            measures, timelines
+    def __init__(self):
+        self.charts = 0
+        self.phases: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+    def add_time(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+    def merge(self, other: 'ParseStats'):
+        self.charts += other.charts
+        for phase, seconds in other.phases.items():
+            self.add_time(phase, seconds)
+        for name, n in other.counters.items():
+            self.count(name, n)
+        return self
+    def total_time(self):
+        return sum(self.phases.values())
+    def as_dict(self):
+        return {"charts": self.charts, "phases": dict(self.phases), "counters": dict(self.counters)}
+    def __str__(self):
+        # one key=value line for logs
+        phases = " ".join(f"{phase}={seconds * 1000:.3f}ms" for phase, seconds in self.phases.items())
+        counters = " ".join(f"{name}={n}" for name, n in self.counters.items())
+        return f"charts={self.charts} {phases} {counters}"
+    def to_prometheus(self, prefix: str = "bmsparser"):
+        # Prometheus text exposition format
+        out = [f"# TYPE {prefix}_charts_total counter", f"{prefix}_charts_total {self.charts}",
+               f"# TYPE {prefix}_phase_seconds_total counter"]
+        out += [f'{prefix}_phase_seconds_total{{phase="{phase}"}} {seconds!r}' for phase, seconds in self.phases.items()]
+        for name, n in self.counters.items():
+            out += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {n}"]
+        return "\n".join(out) + "\n"
+
+class BmsTokenizer:
+    # Reads a chart in chunks and yields tokens lazily, hashing the raw bytes as
+    # they are read; sha256/md5 are complete once iteration finishes. The last
+    # item of every token is its 1-based line number.
+    #   (TokenHeader, command, index, raw value bytes, line)
+    #   (TokenChannel, measure, channel, data, line)
+    #   (TokenControl, command, argument, line)
+    #   (TokenInvalid, reason, raw line bytes, line)
+    # Header values stay undecoded so only the fields a consumer uses are decoded.
+    def __init__(self, path: str, chunk_size: int = 1 << 16):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        # detect_encoding() of the first chunk with non-ASCII lines (a UTF-8 BOM
+        # is skipped and counts as utf-8); None while everything read is ASCII
+        self.encoding: Union[str, None] = None
+        # kept per chunk, so they cost nothing noticeable when unused
+        self.line_count = 0
+        self.hash_seconds = 0.0
+    def lines(self):
+        rest = b""
+        with open(self.path, 'rb') as f:
+            first = True
+            while True:
+                chunk = f.read(self.chunk_size)
+                if len(chunk) == 0:
+                    break
+                started = time.perf_counter()
+                self.sha256.update(chunk)
+                self.md5.update(chunk)
+                self.hash_seconds += time.perf_counter() - started
+                if first:
+                    first = False
+                    if chunk.startswith(codecs.BOM_UTF8):
+                        chunk = chunk[len(codecs.BOM_UTF8):]
+                        self.encoding = "utf-8"
+                data = rest + chunk
+                lines = data.split(b"\n")
+                rest = lines.pop()
+                if self.encoding is None and not data.isascii():
+                    self.encoding = detect_encoding(b"\n".join(line for line in lines if not line.isascii()))
+                self.line_count += len(lines)
+                yield lines
+        if len(rest) > 0:
+            if self.encoding is None:
+                self.encoding = detect_encoding(rest)
+            self.line_count += 1
+            yield [rest]
+    def __iter__(self):
+        header_word = HeaderWord.match
+        # read line by line, accept both crlf and lf
+        for lines in self.lines():
+            number = self.line_count - len(lines)
+            for line in lines:
+                number += 1
+                if line.endswith(b"\r"):
+                    line = line[:-1]
+                if len(line) < 2 or line[0] != 35: # '#'
+                    continue
+                if len(line) >= 7 and line[6] == 58 and line[1:4].isdigit(): # ':'
+                    # channel ids are base36 regardless of #BASE
+                    try:
+                        channel = int(line[4:6], 36)
+                    except ValueError:
+                        yield (TokenInvalid, "bad channel id", line, number)
+                        continue
+                    yield (TokenChannel, int(line[1:4]), channel, line[7:].decode('latin-1'), number)
+                    continue
+                # #WAVxx and friends make up most header lines, so try them before the regex
+                cmd = IndexedHeaders.get(line[1:4].upper())
+                if cmd is not None and (len(cmd) == 3 or line[1:len(cmd)+1].upper() == cmd.encode()):
+                    n = len(cmd) + 1
+                    if cmd == "BPM" and line[n:n+1] == b" ":
+                        yield (TokenHeader, "BPM", "", line[n+1:], number)
+                    elif len(line) >= n + 3:
+                        yield (TokenHeader, cmd, line[n:n+2].decode('latin-1'), line[n+3:], number)
+                    continue
+                match = header_word(line)
+                if match is None:
+                    continue
+                word = match.group(1).decode('ascii').upper()
+                if word == "END" and line[4:].strip().upper() == b"IF":
+                    word = "ENDIF"
+                if word in ControlFlowHeaders:
+                    yield (TokenControl, word, line[len(word) + 1:].decode('latin-1'), number)
+                    continue
+                n = len(word) + 1
+                if line[n:n+1] != b" ":
+                    continue
+                yield (TokenHeader, word, "", line[n+1:], number)
+
+class LazyMeasures:
+    # Read-only sequence standing in for Chart.measures after a ParseLazy parse.
+    # A measure's timelines and notes are built the first time it is accessed,
+    # starting from the (time, bpm, visual, scroll) checkpoint recorded for it.
+    # Measures tied together by long notes are built as one group. With cache_size set, the
+    # least recently used groups are dropped once more than cache_size
+    # measures are held, and rebuilt as new objects when accessed again.
+    def __init__(self, parser: 'BmsParser', lines: dict[int, list[tuple[int, str]]],
+                 checkpoints: list[tuple[Fraction, float, float, float]], links: list[tuple[int, int]],
+                 cache_size: Union[int, None] = None):
+        self.parser = parser
+        self.lines = lines
+        self.checkpoints = checkpoints
+        self.cache_size = cache_size
+        self.cache: OrderedDict[int, list[Measure]] = OrderedDict()
+        self.cached = 0
+        # first and last measure of the group each measure is built with
+        self.group_start = list(range(len(checkpoints)))
+        self.group_end = list(range(len(checkpoints)))
+        groups: list[list[int]] = []
+        for first, last in sorted(links):
+            if len(groups) > 0 and first <= groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], last)
+            else:
+                groups.append([first, last])
+        for first, last in groups:
+            for i in range(first, last + 1):
+                self.group_start[i] = first
+                self.group_end[i] = last
+    def __len__(self):
+        return len(self.checkpoints)
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("measure index out of range")
+        start = self.group_start[index]
+        group = self.cache.get(start)
+        if group is None:
+            group = self.build(start, self.group_end[index])
+            self.cache[start] = group
+            self.cached += len(group)
+            self.evict()
+        else:
+            self.cache.move_to_end(start)
+        return group[index - start]
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def build(self, first: int, last: int):
+        last_note: list[Union[Note, None]] = [None] * 16
+        ln_start: list[Union[LongNote, None]] = [None] * 16
+        group: list[Measure] = []
+        for i in range(first, last + 1):
+            measure, _ = self.parser.expand_measure(self.lines.get(i, []), last_note, ln_start)
+            time_passed, bpm, visual, scroll = self.checkpoints[i]
+            self.parser.time_measure(measure, time_passed, bpm, visual, scroll)
+            group.append(measure)
+        return group
+    def evict(self):
+        if self.cache_size is None:
+            return
+        while self.cached > self.cache_size and len(self.cache) > 1:
+            _, group = self.cache.popitem(last=False)
+            self.cached -= len(group)
+
+class MeasureState:
+    # What is needed to resume building a chart at a measure: its channel lines,
+    # the LNOBJ/LNTYPE 1 state, (time, bpm, min bpm, max bpm, play length,
+    # visual, scroll) at its start and the note counts it added.
+    __slots__ = ('lines', 'last_note', 'ln_start', 'timing', 'counts')
+    def __init__(self, lines: list[tuple[int, str]], last_note: Iterable, ln_start: Iterable, timing: tuple):
+        self.lines = lines
+        self.last_note: tuple = tuple(last_note)
+        self.ln_start: tuple = tuple(ln_start)
+        self.timing = timing
+        self.counts = (0, 0, 0, 0)
+
 class BmsParser:
     no_wav = -1
-    def __init__(self, path):
+    def __init__(self, path, seed: Union[int, None] = None, random_selection: Union[list[int], None] = None,
+                 stats: Union[ParseStats, None] = None, measure_cache_size: Union[int, None] = None,
+                 encoding: Union[str, None] = None, lenient: bool = False, fingerprint: bool = False):
+        # random_selection fixes the values of the reachable #RANDOMs in the order
+        # they are met; any further #RANDOM is drawn from a PRNG seeded with seed.
+        # measure_cache_size bounds the measures kept by a ParseLazy chart.
+        # encoding=None detects the encoding of header values. lenient skips
+        # lines that would otherwise raise and records them as errors in
+        # chart.diagnostics instead. fingerprint fills meta.fingerprint and
+        # meta.minhash, an extra pass over the channel lines.
         self.path = path
         self.use_base62 = False
         self.chart = Chart()
@@ -243,7 +1102,38 @@ class BmsParser:
         self.lnobj = -1
         self.lntype = -1
         self.scroll_table: dict[int, float] = {}
+        self.unknown_headers: list[str] = []
+        self.encoding = encoding
+        # set by parse(); its detected encoding is used once a header needs one
+        self.tokenizer: Union[BmsTokenizer, None] = None
+        self.lenient = lenient
+        self.fingerprint = fingerprint
+        self.diagnostics = self.chart.diagnostics
+        # line of the header or control flow token being run
+        self.line = 0
+        self.random_stack: list[int] = []
+        # one [outer block skipped, branch already taken, skipping] frame per open #IF
+        self.if_stack: list[list[bool]] = []
+        self.prng = random.Random(seed)
+        self.random_selection = random_selection if random_selection is not None else []
+        # (range, value) of every reachable #RANDOM, in order
+        self.random_choices: list[tuple[int, int]] = []
+        # per-measure states, recorded by a full parse when set to a list
+        self.measure_states: Union[list[MeasureState], None] = None
+        self.exit_state: Union[MeasureState, None] = None
+        self.measure_cache_size = measure_cache_size
+        # (scale, resolution, bpm) -> exact us per tick, shared by the timing passes
+        self.tick_steps: dict[tuple[float, int, float], Fraction] = {}
+        # (measure lines, entry state) -> count_measure result, shared by the
+        # parsers of enumerate_random_branches; None counts every measure
+        self.measure_counts: Union[dict, None] = None
+        self.stats = stats
+        if stats is not None:
+            self.instrument(stats)
     def parse_int(self, s: str, force_base36: bool = False):
+        value = (Base36Pairs if force_base36 or not self.use_base62 else Base62Pairs).get(s)
+        if value is not None:
+            return value
         if force_base36 or not self.use_base62:
             return int(s, 36)
         result = 0
@@ -260,369 +1150,1242 @@ class BmsParser:
         return result
     def match_header(self, line: str, header: str):
         return line.upper().startswith(header)
-    def parse_header(self, cmd: str, xx: str, value: str):
-        if self.match_header(cmd, "BASE"):
-            if len(value) == 0: return
-            if value == "62":
-                self.use_base62 = True
-            else:
-                self.use_base62 = False
-        elif self.match_header(cmd, "PLAYER"):
-            self.chart.meta.player = int(value)
-        elif self.match_header(cmd, "GENRE"):
-            self.chart.meta.genre = value
-        elif self.match_header(cmd, "TITLE"):
-            self.chart.meta.title = value
-        elif self.match_header(cmd, "SUBTITLE"):
-            self.chart.meta.subtitle = value
-        elif self.match_header(cmd, "ARTIST"):
-            self.chart.meta.artist = value
-        elif self.match_header(cmd, "SUBARTIST"):
-            self.chart.meta.subartist = value
-        elif self.match_header(cmd, "DIFFICULTY"):
-            self.chart.meta.difficulty = int(value)
-        elif self.match_header(cmd, "BPM"):
-            if len(value) == 0: return
-            if len(xx) == 0:
-                self.chart.meta.bpm = float(value)
+    def parse_header(self, cmd: str, xx: str, value: Union[str, bytes]):
+        # raw values from the tokenizer are decoded only once the header is known
+        key = cmd.upper()
+        field = MetaHeaders.get(key)
+        handler = self.header_handlers.get(key) if field is None else None
+        if field is None and handler is None:
+            self.unknown_headers.append(cmd)
+            self.diagnose(SeverityInfo, "unknown-header", f"Unknown header #{cmd}")
+            return
+        if isinstance(value, bytes):
+            value = self.decode(value)
+        try:
+            if field is not None:
+                setattr(self.chart.meta, field[0], field[1](value))
             else:
-                id = self.parse_int(xx)
-                self.bpm_table[id] = float(value)
-        elif self.match_header(cmd, "STOP"):
-            if len(value) == 0 or len(xx) == 0: return
-            id = self.parse_int(xx)
-            self.stop_length_table[id] = float(value)
-        elif self.match_header(cmd, "PLAYLEVEL"):
-            self.chart.meta.play_level = int(value)
-        elif self.match_header(cmd, "RANK"):
-            self.chart.meta.rank = int(value)
-        elif self.match_header(cmd, "TOTAL"):
-            total = float(value)
-            if total > 0:
-                self.chart.meta.total = total
-        elif self.match_header(cmd, "STAGEFILE"):
-            self.chart.meta.stage_file = value
-        elif self.match_header(cmd, "BANNER"):
-            self.chart.meta.banner = value
-        elif self.match_header(cmd, "BACKBMP"):
-            self.chart.meta.backbmp = value
-        elif self.match_header(cmd, "PREVIEW"):
-            self.chart.meta.preview = value
-        elif self.match_header(cmd, "WAV"):
-            if len(value) == 0 or len(xx) == 0: return
-            id = self.parse_int(xx)
-            self.chart.wav_table[id] = value
-        elif self.match_header(cmd, "BMP"):
-            if len(value) == 0 or len(xx) == 0: return
-            id = self.parse_int(xx)
-            self.chart.bmp_table[id] = value
-            if xx == "00":
-                self.chart.meta.bga_poor_default = True
-        elif self.match_header(cmd, "LNOBJ"):
-            self.lnobj = self.parse_int(value)
-        elif self.match_header(cmd, "LNTYPE"):
-            self.lntype = int(value)
-        elif self.match_header(cmd, "LNMODE"):
-            self.chart.meta.lnmode = int(value)
-        elif self.match_header(cmd, "SCROLL"):
-            id = self.parse_int(xx)
-            self.scroll_table[id] = float(value)
+                handler(self, xx, value) # type: ignore
+        except ValueError as e:
+            self.fail("bad-header", f"#{cmd}{xx} {value.strip()!r}: {e}")
+    def diagnose(self, severity: int, code: str, message: str, line: Union[int, None] = None):
+        self.diagnostics.add(severity, self.line if line is None else line, code, message)
+    def fail(self, code: str, message: str, line: Union[int, None] = None):
+        # an error: raised as ValueError, or recorded when lenient
+        if line is None:
+            line = self.line
+        if not self.lenient:
+            raise ValueError(f"Line {line}: {message}")
+        self.diagnostics.add(SeverityError, line, code, message)
+    def copy_headers(self, other: 'BmsParser'):
+        # continue from the headers other has run; tables are copied, so
+        # headers run here do not change other
+        self.use_base62 = other.use_base62
+        self.lnobj = other.lnobj
+        self.lntype = other.lntype
+        self.bpm_table = dict(other.bpm_table)
+        self.stop_length_table = dict(other.stop_length_table)
+        self.scroll_table = dict(other.scroll_table)
+        self.unknown_headers = list(other.unknown_headers)
+        self.encoding = other.encoding
+        self.tick_steps = other.tick_steps
+        chart = self.chart
+        chart.meta = copy.copy(other.chart.meta)
+        chart.wav_table = dict(other.chart.wav_table)
+        chart.bmp_table = dict(other.chart.bmp_table)
+        chart.diagnostics = self.diagnostics = copy.deepcopy(other.diagnostics)
+    def decode(self, value: bytes):
+        # ASCII, i.e. numbers, ids and most file names, needs no encoding at all
+        if value.isascii():
+            return value.decode('ascii')
+        if self.encoding is None:
+            detected = self.tokenizer.encoding if self.tokenizer is not None else None
+            self.encoding = detected if detected is not None else detect_encoding(value)
+        try:
+            return value.decode(self.encoding) # type: ignore
+        except UnicodeDecodeError:
+            pass
+        # a line saved in another encoding than the rest of the file
+        for encoding in DetectEncodings:
+            try:
+                text = value.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+            self.diagnose(SeverityWarning, "encoding", f"Value decoded as {encoding} instead of {self.encoding}")
+            return text
+        self.diagnose(SeverityWarning, "encoding", f"Undecodable bytes in {self.encoding} value replaced")
+        return value.decode(self.encoding, 'replace') # type: ignore
+    def header_base(self, xx: str, value: str):
+        if len(value) == 0: return
+        self.use_base62 = value == "62"
+    def header_bpm(self, xx: str, value: str):
+        if len(value) == 0: return
+        bpm = float(value)
+        if not math.isfinite(bpm):
+            raise ValueError("BPM must be a finite number")
+        if bpm <= 0:
+            # negative BPMs are a known gimmick; a zero one fails where it is used
+            self.diagnose(SeverityWarning, "bad-header", f"#BPM{xx} {value.strip()!r} is not positive")
+        if len(xx) == 0:
+            self.chart.meta.bpm = bpm
         else:
-            print(f"Unknown header: {cmd}")
-    def gcd(self, a: int, b: int):
-        while b != 0:
-            a, b = b, a % b
-        return a
+            self.bpm_table[self.parse_int(xx)] = bpm
+    def header_stop(self, xx: str, value: str):
+        if len(value) == 0 or len(xx) == 0: return
+        stop = float(value)
+        if not math.isfinite(stop):
+            raise ValueError("STOP must be a finite number")
+        self.stop_length_table[self.parse_int(xx)] = stop
+    def header_total(self, xx: str, value: str):
+        total = float(value)
+        if total > 0:
+            self.chart.meta.total = total
+    def header_wav(self, xx: str, value: str):
+        if len(value) == 0 or len(xx) == 0: return
+        self.chart.wav_table[self.parse_int(xx)] = value
+    def header_bmp(self, xx: str, value: str):
+        if len(value) == 0 or len(xx) == 0: return
+        self.chart.bmp_table[self.parse_int(xx)] = value
+        if xx == "00":
+            self.chart.meta.bga_poor_default = True
+    def header_lnobj(self, xx: str, value: str):
+        self.lnobj = self.parse_int(value)
+    def header_lntype(self, xx: str, value: str):
+        self.lntype = int(value)
+    def header_scroll(self, xx: str, value: str):
+        self.scroll_table[self.parse_int(xx)] = float(value)
+    # headers that need more than storing a converted value on ChartMeta
+    header_handlers = {
+        "BASE": header_base,
+        "BPM": header_bpm,
+        "STOP": header_stop,
+        "TOTAL": header_total,
+        "WAV": header_wav,
+        "BMP": header_bmp,
+        "LNOBJ": header_lnobj,
+        "LNTYPE": header_lntype,
+        "SCROLL": header_scroll,
+    }
+    def instrument(self, stats: ParseStats):
+        # shadow the hot methods with counting/timing wrappers on this instance
+        # only, so uninstrumented parsers run the plain methods
+        parse_header = self.parse_header
+        control_flow = self.control_flow
+        counters = stats.counters
+        for name in ("headers", "control_flow"):
+            counters.setdefault(name, 0)
+        def timed_parse_header(cmd: str, xx: str, value: Union[str, bytes]):
+            started = time.perf_counter()
+            parse_header(cmd, xx, value)
+            stats.add_time("headers", time.perf_counter() - started)
+            counters["headers"] += 1
+        def timed_control_flow(word: str, arg: str):
+            started = time.perf_counter()
+            control_flow(word, arg)
+            stats.add_time("control_flow", time.perf_counter() - started)
+            counters["control_flow"] += 1
+        self.parse_header = timed_parse_header
+        self.control_flow = timed_control_flow
+    def update_key_mode(self, lane_number: int):
+        if lane_number == 5 or lane_number == 6 or lane_number == 13 or lane_number == 14:
+            if self.chart.meta.key_mode == 5:
+                self.chart.meta.key_mode = 7
+            elif self.chart.meta.key_mode == 10:
+                self.chart.meta.key_mode = 14
+        if lane_number >= 8:
+            if self.chart.meta.key_mode == 7:
+                self.chart.meta.key_mode = 14
+            elif self.chart.meta.key_mode == 5:
+                self.chart.meta.key_mode = 10
+            self.chart.meta.is_dp = True
+    def decode_ids(self, data: str):
+        # decode every two-character object of a channel line at once
+        table = Base62Pairs if self.use_base62 else Base36Pairs
+        try:
+            return [table[data[i:i+2]] for i in range(0, len(data) - 1, 2)]
+        except KeyError:
+            for i in range(0, len(data) - 1, 2):
+                if data[i:i+2] not in table:
+                    raise ValueError(f"Invalid {'base62' if self.use_base62 else 'base36'} object {data[i:i+2]!r} at column {i}") from None
+            raise
     def to_wave_id(self, wav: str):
         if len(wav) == 0: return self.no_wav
         decoded = self.parse_int(wav)
         if decoded in self.chart.wav_table:
             return decoded
         return self.no_wav
-    def parse(self):
-        # calculate sha256 hash
-        # read file
-        bytes = open(self.path, 'rb').read()
-        # calculate hash
-        
-        self.chart.meta.sha256 = hashlib.sha256(bytes).hexdigest()
-        self.chart.meta.md5 = hashlib.md5(bytes).hexdigest()
-        headerRegex = r"^#([A-Za-z]+?)(\\d\\d)? +?(.+)?"
-        last_measure = -1
-        measures: dict[int, list[tuple[int, str]]] = {}
-        content = bytes.decode('shift-jis')
-        random_stack: list[int] = []
-        skip_stack: list[bool] = []
-        prng = random.Random()
-        # read line by line, accept both crlf and lf
-        for line in content.split("\n"):
-            if line.endswith("\r"):
-                line = line[:-1]
-            if self.match_header(line, "#IF"):
-                if len(random_stack) == 0: continue
-                current_random = random_stack[-1]
-                n = int(line[4:])
-                skip_stack.append(current_random != n)
-                continue
-            if self.match_header(line, "#ELSE"):
-                if len(skip_stack) == 0: continue
-                current_skip = skip_stack[-1]
-                skip_stack.pop()
-                skip_stack.append(not current_skip)
-                continue
-            if self.match_header(line, "#ELSEIF"):
-                if len(skip_stack) == 0: continue
-                current_skip = skip_stack[-1]
-                n = int(line[8:])
-                skip_stack.pop()
-                skip_stack.append(current_skip and current_skip != n)
-                continue
-            if self.match_header(line, "#ENDIF") or self.match_header(line, "#END IF"):
-                if len(skip_stack) == 0: continue
-                skip_stack.pop()
-                continue
-            if self.match_header(line, "#RANDOM") or self.match_header(line, "#RONDAM"):
-                n = int(line[7:])
-                random_stack.append(prng.randint(1, n))
-                continue
-            if self.match_header(line, "#ENDRANDOM"):
-                if len(random_stack) == 0: continue
-                random_stack.pop()
-                continue
-            if len(line) >= 7 and line[1].isdigit() and line[2].isdigit() and line[3].isdigit() and line[6] == ":":
-                measure = int(line[1:4])
-                last_measure = max(last_measure, measure)
-                if measure not in measures:
-                    measures[measure] = []
-                channel = self.parse_int(line[4:6])
-                measures[measure].append((channel, line[7:]))
+    def skipping(self):
+        return len(self.if_stack) > 0 and self.if_stack[-1][2]
+    def choose_random(self, n: int):
+        k = len(self.random_choices)
+        if k < len(self.random_selection):
+            value = self.random_selection[k]
+            if value < 1 or value > n:
+                raise ValueError(f"Selection {value} for #RANDOM {n} is out of range")
+        else:
+            value = self.prng.randint(1, n)
+        self.random_choices.append((n, value))
+        return value
+    def control_value(self, word: str, arg: str):
+        # 0 for a bad value when lenient: it matches no #IF, so only #ELSE runs
+        try:
+            value = int(arg)
+        except ValueError:
+            value = -1
+        if value < 1 and (word == "RANDOM" or word == "RONDAM"):
+            self.fail("bad-control-flow", f"#{word} {arg.strip()!r} is not a positive number")
+            return 0
+        if value < 0:
+            self.fail("bad-control-flow", f"#{word} {arg.strip()!r} is not a number")
+            return 0
+        return value
+    def control_flow(self, word: str, arg: str):
+        if word == "IF":
+            # outside any #RANDOM an #IF is ignored and its whole body parsed,
+            # as it always was
+            if len(self.random_stack) == 0: return
+            outer = self.skipping()
+            taken = not outer and self.random_stack[-1] == self.control_value(word, arg)
+            self.if_stack.append([outer, taken, not taken])
+        elif word == "ELSEIF":
+            if len(self.if_stack) == 0: return
+            frame = self.if_stack[-1]
+            taken = (not frame[0] and not frame[1] and len(self.random_stack) > 0
+                     and self.random_stack[-1] == self.control_value(word, arg))
+            frame[1] = frame[1] or taken
+            frame[2] = not taken
+        elif word == "ELSE":
+            if len(self.if_stack) == 0: return
+            frame = self.if_stack[-1]
+            frame[2] = frame[0] or frame[1]
+            frame[1] = True
+        elif word == "ENDIF":
+            if len(self.if_stack) == 0: return
+            self.if_stack.pop()
+        elif word == "RANDOM" or word == "RONDAM" or word == "SETRANDOM":
+            if self.skipping():
+                # unreachable, keep the stack balanced without drawing a value
+                self.random_stack.append(0)
+            elif word == "SETRANDOM":
+                self.random_stack.append(self.control_value(word, arg))
             else:
-                if self.match_header(line, "#WAV"):
-                    if len(line) < 7: continue
-                    xx = line[4:6]
-                    value = line[7:]
-                    self.parse_header("WAV", xx, value)
-                elif self.match_header(line, "#BMP"):
-                    if len(line) < 7: continue
-                    xx = line[4:6]
-                    value = line[7:]
-                    self.parse_header("BMP", xx, value)
-                elif self.match_header(line, "#BPM"):
-                    if line[4:].startswith(" "):
-                        value = line[5:]
-                        self.parse_header("BPM", "", value)
-                    else:
-                        if len(line) < 7: continue
-                        xx = line[4:6]
-                        value = line[7:]
-                        self.parse_header("BPM", xx, value)
-                elif self.match_header(line, "#STOP"):
-                    if len(line) < 8: continue
-                    xx = line[5:7]
-                    value = line[8:]
-                    self.parse_header("STOP", xx, value)
-                elif self.match_header(line, "#SCROLL"):
-                    if len(line) < 10: continue
-                    xx = line[7:9]
-                    value = line[10:]
-                    self.parse_header("SCROLL", xx, value)
-                else:
-                    match = re.match(headerRegex, line)
-                    if match:
-                        cmd = match.group(1)
-                        xx = match.group(2)
-                        value = match.group(3)
-                        if value == None or len(value) == 0:
-                            value = xx
-                            xx = ""
-                        self.parse_header(cmd, xx, value)
-        time_passed = 0.0
+                n = self.control_value(word, arg)
+                self.random_stack.append(self.choose_random(n) if n > 0 else 0)
+        elif word == "ENDRANDOM":
+            if len(self.random_stack) == 0: return
+            self.random_stack.pop()
+    def count_notes(self, measures: dict[int, list[tuple[int, str]]], last_measure: int,
+                    checkpoints: Union[list[tuple[Fraction, float, float, float]], None] = None,
+                    links: Union[list[tuple[int, int]], None] = None):
+        # same walk as parse() in ParseFull mode, but without TimeLine/Note
+        # objects: only BPM changes, stops and the last object of a measure
+        # matter for its timing, and they are timed exactly like time_measure.
+        # checkpoints receives (time, bpm, visual, scroll) at the start of every measure and
+        # links the (first, last) measure of every long note spanning measures.
+        time_passed = Fraction(0)
         total_notes = 0
         total_long_notes = 0
         total_scratch_notes = 0
-        total_backspin_notes = 0
-        total_landmine_notes = 0
         current_bpm = self.chart.meta.bpm
         min_bpm = self.chart.meta.bpm
         max_bpm = self.chart.meta.bpm
-        last_note: list[Union[Note, None]] = [None] * 16
-        ln_start: list[Union[LongNote, None]] = [None] * 16
+        # measure of the lane's last note / open long note head, or -1
+        last_note = [-1] * 16
+        ln_start = [-1] * 16
+        # visual position, only tracked for checkpoints
+        visual = 0.0
+        current_scroll = 1.0
+        cache = self.measure_counts if checkpoints is None and links is None else None
+        for i in range(last_measure+1):
+            if checkpoints is not None:
+                checkpoints.append((time_passed, current_bpm, visual, current_scroll))
+            lines = measures.get(i, [])
+            if cache is None:
+                counted = self.count_measure(i, lines, current_bpm, last_note, ln_start, links, checkpoints is not None)
+            else:
+                # only whether a lane has a note or head open matters without links
+                key = (tuple(lines), current_bpm, tuple(k >= 0 for k in last_note), tuple(k >= 0 for k in ln_start))
+                cached = cache.get(key)
+                if cached is None:
+                    counted = self.count_measure(i, lines, current_bpm, last_note, ln_start, None, False)
+                    cache[key] = (counted, [k >= 0 for k in last_note], [k >= 0 for k in ln_start])
+                else:
+                    counted, open_notes, open_heads = cached
+                    for lane in counted[10]:
+                        self.update_key_mode(lane)
+                    last_note = [i if open else -1 for open in open_notes]
+                    ln_start = [i if open else -1 for open in open_heads]
+            (notes, long_notes, scratch_notes, elapsed, end, current_bpm, low_bpm, high_bpm,
+             scale, scrolls, _) = counted
+            total_notes += notes
+            total_long_notes += long_notes
+            total_scratch_notes += scratch_notes
+            min_bpm = min(min_bpm, low_bpm)
+            max_bpm = max(max_bpm, high_bpm)
+            if i == last_measure:
+                self.chart.meta.play_length = int(time_passed + end)
+            time_passed += elapsed
+            if checkpoints is not None:
+                # same float steps as time_measure, so lazy measures land on the same values
+                length = 4.0 * scale
+                segment = 0.0
+                for position in sorted(scrolls):
+                    visual += length * (float(position) - segment) * current_scroll
+                    segment = float(position)
+                    current_scroll = scrolls[position]
+                visual += length * (1.0 - segment) * current_scroll
+        self.chart.meta.total_notes = total_notes
+        self.chart.meta.total_long_notes = total_long_notes
+        self.chart.meta.total_scratch_notes = total_scratch_notes
+        self.chart.meta.total_length = int(time_passed)
+        self.chart.meta.min_bpm = min_bpm
+        self.chart.meta.max_bpm = max_bpm
+    def count_measure(self, i: int, lines: list[tuple[int, str]], current_bpm: float, last_note: list[int],
+                      ln_start: list[int], links: Union[list[tuple[int, int]], None], scroll: bool):
+        # One measure of count_notes, starting at current_bpm; last_note and
+        # ln_start are updated in place. Returns (notes, long notes, scratch
+        # notes, length in us, time of the last object, bpm at the end, lowest
+        # and highest bpm, scale, scroll changes, lanes seen).
+        total_notes = 0
+        total_long_notes = 0
+        total_scratch_notes = 0
+        min_bpm = current_bpm
+        max_bpm = current_bpm
+        steps = self.tick_steps
+        scale = 1.0
+        # last object of the measure as (index, line length); there is
+        # always a timeline at 0
+        end_j = 0
+        end_count = 1
+        # position -> [bpm_change, bpm, stop_length]
+        events: dict[Fraction, list] = {}
+        # position -> scroll speed
+        scrolls: dict[Fraction, float] = {}
+        lanes: set[int] = set()
+        for channel, data in lines:
+            if channel == SectionRate:
+                scale = float(data)
+                continue
+            channel, lane_number = ChannelTable[channel]
+            if lane_number == -1:
+                continue
+            self.update_key_mode(lane_number)
+            lanes.add(lane_number)
+            ids = self.decode_ids(data)
+            data_count = len(ids)
+            if data_count == 0:
+                continue
+            last = (len(data[:data_count*2].rstrip("0")) - 1) // 2
+            if last * end_count > end_j * data_count:
+                end_j = last
+                end_count = data_count
+            if channel == P1KeyBase:
+                is_scratch = lane_number == 7 or lane_number == 15
+                for id in ids:
+                    if id == 0:
+                        continue
+                    if id == self.lnobj and last_note[lane_number] >= 0:
+                        if is_scratch:
+                            total_scratch_notes += 1
+                        else:
+                            total_long_notes += 1
+                        if links is not None and last_note[lane_number] != i:
+                            links.append((last_note[lane_number], i))
+                        last_note[lane_number] = -1
+                    else:
+                        last_note[lane_number] = i
+                        total_notes += 1
+                        if is_scratch:
+                            total_scratch_notes += 1
+            elif channel == P1LongKeyBase and self.lntype == 1:
+                is_scratch = lane_number == 7 or lane_number == 15
+                for id in ids:
+                    if id == 0:
+                        continue
+                    if ln_start[lane_number] < 0:
+                        total_notes += 1
+                        if is_scratch:
+                            total_scratch_notes += 1
+                        else:
+                            total_long_notes += 1
+                        ln_start[lane_number] = i
+                    else:
+                        if links is not None and ln_start[lane_number] != i:
+                            links.append((ln_start[lane_number], i))
+                        ln_start[lane_number] = -1
+            elif channel == BpmChange or channel == BpmChangeExtend or channel == Stop:
+                for j, id in enumerate(ids):
+                    if id == 0:
+                        continue
+                    position = Fraction(j, data_count)
+                    event = events.get(position)
+                    if event is None:
+                        event = events[position] = [False, 0.0, 0.0]
+                    if channel == BpmChange:
+                        event[0] = True
+                        event[1] = int(data[j*2:j*2+2], 16)
+                    elif channel == BpmChangeExtend:
+                        event[0] = True
+                        event[1] = self.bpm_table.get(id, 0.0)
+                    else:
+                        event[2] = self.stop_length_table.get(id, 0.0)
+            elif channel == Scroll and scroll:
+                for j, id in enumerate(ids):
+                    if id != 0:
+                        scrolls[Fraction(j, data_count)] = self.scroll_table.get(id, 1.0)
+        # exact us per measure at the current bpm
+        step = steps.get((scale, 1, current_bpm))
+        if step is None:
+            step = steps[(scale, 1, current_bpm)] = Fraction(scale) * 240000000 / Fraction(current_bpm)
+        elapsed = Fraction(0)
+        last_position = 0
+        for position in sorted(events):
+            elapsed += step * (position - last_position)
+            event = events[position]
+            bpm = current_bpm
+            if event[0]:
+                bpm = current_bpm = event[1]
+                min_bpm = min(min_bpm, current_bpm)
+                max_bpm = max(max_bpm, current_bpm)
+                step = steps.get((scale, 1, current_bpm))
+                if step is None:
+                    step = steps[(scale, 1, current_bpm)] = Fraction(scale) * 240000000 / Fraction(current_bpm)
+            if event[2] != 0:
+                elapsed += Fraction(event[2]) * 1250000 / Fraction(bpm)
+            last_position = position
+        end = elapsed + step * (Fraction(end_j, end_count) - last_position)
+        elapsed += step * (1 - last_position)
+        return (total_notes, total_long_notes, total_scratch_notes, elapsed, end, current_bpm, min_bpm, max_bpm,
+                scale, scrolls, tuple(lanes))
+    def fingerprint_notes(self, measures: dict[int, list[tuple[int, str]]], last_measure: int):
+        # Fingerprint what is played rather than the file: per measure and lane,
+        # where notes are and of which kind, plus BPM/STOP/SCROLL values and
+        # measure lengths. Keysounds, BGM/BGA and all other headers are left out,
+        # and so are line order and zero padding. Each (measure, lane) group is
+        # also a shingle of a one-permutation MinHash with MinHashSize slots.
+        digest = hashlib.sha256(repr(self.chart.meta.bpm).encode())
+        slots: list[int] = [-1] * MinHashSize
+        lnobj_text = None
+        digits = Base62Digits if self.use_base62 else Base36Digits
+        if 0 < self.lnobj < len(digits) ** 2:
+            lnobj_text = digits[self.lnobj // len(digits)] + digits[self.lnobj % len(digits)]
         for i in range(last_measure+1):
-            if i not in measures:
-                measures[i] = []
-            measure = Measure()
-            timelines: OrderedDict[float, TimeLine] = OrderedDict()
-            for channel, data in measures[i]:
+            lines = measures.get(i)
+            if lines is None:
+                continue
+            # group -> tokens; lanes are 0-15, 16 holds timing events
+            groups: dict[int, list[str]] = {}
+            for channel, data in lines:
                 if channel == SectionRate:
-                    measure.scale = float(data)
+                    groups.setdefault(16, []).append("x" + repr(float(data)))
                     continue
-                lane_number = 0
-                if channel >= P1KeyBase and channel < P1KeyBase + 9:
-                    lane_number = Beat7[channel - P1KeyBase]
-                    channel = P1KeyBase
-                elif channel >= P2KeyBase and channel < P2KeyBase + 9:
-                    lane_number = Beat7[channel - P2KeyBase + 9]
-                    channel = P1KeyBase
-                elif channel >= P1InvisibleKeyBase and channel < P1InvisibleKeyBase + 9:
-                    lane_number = Beat7[channel - P1InvisibleKeyBase]
-                    channel = P1InvisibleKeyBase
-                elif channel >= P2InvisibleKeyBase and channel < P2InvisibleKeyBase + 9:
-                    lane_number = Beat7[channel - P2InvisibleKeyBase + 9]
-                    channel = P1InvisibleKeyBase
-                elif channel >= P1LongKeyBase and channel < P1LongKeyBase + 9:
-                    lane_number = Beat7[channel - P1LongKeyBase]
-                    channel = P1LongKeyBase
-                elif channel >= P2LongKeyBase and channel < P2LongKeyBase + 9:
-                    lane_number = Beat7[channel - P2LongKeyBase + 9]
-                    channel = P1LongKeyBase
-                elif channel >= P1MineKeyBase and channel < P1MineKeyBase + 9:
-                    lane_number = Beat7[channel - P1MineKeyBase]
-                    channel = P1MineKeyBase
-                elif channel >= P2MineKeyBase and channel < P2MineKeyBase + 9:
-                    lane_number = Beat7[channel - P2MineKeyBase + 9]
-                    channel = P1MineKeyBase
+                channel, lane_number = ChannelTable[channel]
                 if lane_number == -1:
                     continue
-                is_scratch = lane_number == 7 or lane_number == 15
-                if lane_number == 5 or lane_number == 6 or lane_number == 13 or lane_number == 14:
-                    if self.chart.meta.key_mode == 5:
-                        self.chart.meta.key_mode = 7
-                    elif self.chart.meta.key_mode == 10:
-                        self.chart.meta.key_mode = 14
-                if lane_number >= 8:
-                    if self.chart.meta.key_mode == 7:
-                        self.chart.meta.key_mode = 14
-                    elif self.chart.meta.key_mode == 5:
-                        self.chart.meta.key_mode = 10
-                    self.chart.meta.is_dp = True
-                data_count = len(data) // 2
-                for j in range(data_count):
-                    val = data[j*2:j*2+2]
-                    if val == "00":
-                        if len(timelines) == 0 and j == 0:
-                            timelines[0] = TimeLine() # ghost timeline
+                if channel == P1KeyBase or channel == P1InvisibleKeyBase or (channel == P1LongKeyBase and self.lntype == 1):
+                    # only which objects are non-zero matters, so the line becomes
+                    # a bit string with the zero padding divided out
+                    data_count = len(data) // 2
+                    if data_count == 0:
                         continue
-                    g = self.gcd(j, data_count)
-                    position = (j // g) / (data_count // g)
-
-                    if position not in timelines:
-                        timelines[position] = TimeLine()
-                    timeline = timelines[position]
-
-                    if channel == LaneAutoplay:
-                        if self.parse_int(val) != 0:
-                            bg_note = Note(self.to_wave_id(val))
-                            timeline.add_background_note(bg_note)
+                    data = data[:data_count*2]
+                    try:
+                        flags = data.translate(NonZeroDigits)
+                        bits = format(int(flags[0::2], 2) | int(flags[1::2], 2), f"0{data_count}b")
+                    except ValueError:
+                        self.decode_ids(data)
+                        raise
+                    if "1" not in bits:
+                        continue
+                    tokens = groups.setdefault(lane_number, [])
+                    kind = "n" if channel == P1KeyBase else "i" if channel == P1InvisibleKeyBase else "l"
+                    tokens.append(kind + _reduce_bits(bits))
+                    if channel == P1KeyBase and lnobj_text is not None:
+                        text = data if self.use_base62 else data.upper()
+                        j = text.find(lnobj_text)
+                        if j >= 0:
+                            tails = ["0"] * data_count
+                            while j >= 0:
+                                if j % 2 == 0:
+                                    tails[j // 2] = "1"
+                                j = text.find(lnobj_text, j + 1)
+                            tokens.append("e" + _reduce_bits("".join(tails)))
+                    continue
+                if channel == P1MineKeyBase:
+                    tokens = groups.setdefault(lane_number, [])
+                elif channel == BpmChange or channel == BpmChangeExtend or channel == Stop or channel == Scroll:
+                    tokens = groups.setdefault(16, [])
+                else:
+                    continue
+                ids = self.decode_ids(data)
+                data_count = len(ids)
+                for j, id in enumerate(ids):
+                    if id == 0:
+                        continue
+                    position = repr(j / data_count)
+                    if channel == P1MineKeyBase:
+                        tokens.append(f"m{data[j*2:j*2+2].upper()}@{position}")
                     elif channel == BpmChange:
-                        # hex to int
-                        bpm = int(val, 16)
-                        timeline.bpm = bpm
-                        timeline.bpm_change = True
-                    elif channel == BgaPlay:
-                        timeline.bga_base = self.parse_int(val)
-                    elif channel == PoorPlay:
-                        timeline.bga_poor = self.parse_int(val)
-                    elif channel == LayerPlay:
-                        timeline.bga_layer = self.parse_int(val)
+                        tokens.append(f"b{float(int(data[j*2:j*2+2], 16))!r}@{position}")
                     elif channel == BpmChangeExtend:
-                        id = self.parse_int(val)
-                        if id in self.bpm_table:
-                            timeline.bpm = self.bpm_table[id]
-                        else:
-                            timeline.bpm = 0.0
-                        timeline.bpm_change = True
-                    elif channel == Scroll:
-                        id = self.parse_int(val)
-                        if id in self.scroll_table:
-                            timeline.scroll = self.scroll_table[id]
-                        else:
-                            timeline.scroll = 1.0
+                        tokens.append(f"b{self.bpm_table.get(id, 0.0)!r}@{position}")
                     elif channel == Stop:
-                        id = self.parse_int(val)
-                        if id in self.stop_length_table:
-                            timeline.stop_length = self.stop_length_table[id]
+                        tokens.append(f"s{self.stop_length_table.get(id, 0.0)!r}@{position}")
+                    else:
+                        tokens.append(f"c{self.scroll_table.get(id, 1.0)!r}@{position}")
+            for group in sorted(groups):
+                tokens = groups[group]
+                tokens.sort()
+                data = f"{i}:{group}:{','.join(tokens)}\n".encode()
+                digest.update(data)
+                h = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+                slot = h % MinHashSize
+                value = h >> 32
+                if slots[slot] < 0 or value < slots[slot]:
+                    slots[slot] = value
+        self.chart.meta.fingerprint = digest.hexdigest()
+        filled = [slot for slot in range(MinHashSize) if slots[slot] >= 0]
+        if len(filled) == 0:
+            self.chart.meta.minhash = []
+            return
+        # empty slots borrow the next filled one so short charts still compare slot by slot
+        for slot in range(MinHashSize):
+            if slots[slot] < 0:
+                slots[slot] = slots[filled[bisect.bisect_left(filled, slot) % len(filled)]]
+        self.chart.meta.minhash = slots
+    def parse(self, mode: int = ParseFull):
+        # ParseHeaderOnly fills meta (key mode included), wav/bmp tables and hashes;
+        # ParseNoteStats additionally fills note counts, bpm range and lengths.
+        # Neither builds measures, timelines or notes. ParseLazy is ParseNoteStats
+        # plus a LazyMeasures that builds measures on access (no timing_index).
+        tokenizer = BmsTokenizer(self.path)
+        self.tokenizer = tokenizer
+        stats = self.stats
+        if stats is None:
+            self.parse_tokens(tokenizer, mode)
+        else:
+            # tokenize up front so reading and the line loop are timed apart
+            started = time.perf_counter()
+            tokens = list(tokenizer)
+            stats.add_time("tokenize", time.perf_counter() - started - tokenizer.hash_seconds)
+            stats.add_time("hash", tokenizer.hash_seconds)
+            stats.count("lines", tokenizer.line_count)
+            self.parse_tokens(tokens, mode)
+            stats.charts += 1
+        self.chart.meta.sha256 = tokenizer.sha256.hexdigest()
+        self.chart.meta.md5 = tokenizer.md5.hexdigest()
+        return self.chart
+    def collect_tokens(self, tokens: Iterable[tuple], mode: int = ParseFull,
+                       line_numbers: Union[dict[int, list[int]], None] = None):
+        # run headers and control flow, bucket the reachable channel lines by
+        # measure and fingerprint them if asked to; in ParseHeaderOnly only the
+        # set of channels is kept. line_numbers receives the line number of
+        # every kept channel line, per measure.
+        last_measure = -1
+        measures: dict[int, list[tuple[int, str]]] = {}
+        header_channels: set[int] = set()
+        # measure -> line numbers of its channel lines, kept to report bad ones
+        if line_numbers is None:
+            line_numbers = {}
+        stats = self.stats
+        if stats is not None:
+            started = time.perf_counter()
+            # headers and control flow time themselves; line_loop is the rest
+            nested = stats.phases.get("headers", 0.0) + stats.phases.get("control_flow", 0.0)
+        for token in tokens:
+            kind = token[0]
+            if kind == TokenControl:
+                self.line = token[3]
+                self.control_flow(token[1], token[2])
+                continue
+            if len(self.if_stack) > 0 and self.if_stack[-1][2]:
+                continue
+            if kind == TokenChannel:
+                _, measure, channel, data, line = token
+                if mode == ParseHeaderOnly:
+                    header_channels.add(channel)
+                    continue
+                last_measure = max(last_measure, measure)
+                if measure not in measures:
+                    measures[measure] = []
+                measures[measure].append((channel, data))
+                line_numbers.setdefault(measure, []).append(line)
+            elif kind == TokenHeader:
+                self.line = token[4]
+                self.parse_header(token[1], token[2], token[3])
+            else:
+                self.fail("bad-line", f"{token[1].capitalize()} in {token[2].decode('latin-1')!r}", token[3])
+        if stats is not None:
+            nested = stats.phases.get("headers", 0.0) + stats.phases.get("control_flow", 0.0) - nested
+            stats.add_time("line_loop", time.perf_counter() - started - nested)
+        encoding = self.encoding if self.encoding is not None else self.tokenizer.encoding if self.tokenizer is not None else None
+        self.chart.meta.encoding = encoding if encoding is not None else "ascii"
+        if mode != ParseHeaderOnly:
+            self.drop_bad_lines(measures, line_numbers)
+            if self.chart.meta.bpm == 0 and last_measure >= 0:
+                self.fail("bad-header", f"No usable #BPM, using {DefaultBpm}" if self.lenient else "No usable #BPM", 0)
+                self.chart.meta.bpm = DefaultBpm
+            elif self.chart.meta.bpm == 0:
+                # nothing to time
+                self.diagnose(SeverityWarning, "bad-header", "No #BPM", 0)
+            if self.fingerprint:
+                if stats is not None:
+                    started = time.perf_counter()
+                self.fingerprint_notes(measures, last_measure)
+                if stats is not None:
+                    stats.add_time("fingerprint", time.perf_counter() - started)
+        if stats is not None:
+            channel_lines = 0
+            channel_objects = 0
+            for lines in measures.values():
+                channel_lines += len(lines)
+                for _, data in lines:
+                    channel_objects += sum(1 for i in range(0, len(data) - 1, 2) if data[i:i+2] != "00")
+            stats.count("channel_lines", channel_lines)
+            stats.count("channel_objects", channel_objects)
+            stats.count("measures", last_measure + 1)
+        return measures, last_measure, header_channels
+    def drop_bad_lines(self, measures: dict[int, list[tuple[int, str]]], line_numbers: dict[int, list[int]]):
+        # Check the channel lines before the note passes see them: a bad line
+        # raises with its line number, or is removed when lenient. #xxx08
+        # objects without a usable #BPMxx are cleared and keep the current BPM.
+        # Channels whose objects are never read only need their positions, so
+        # undecodable objects there become 01 with a warning.
+        for measure, lines in measures.items():
+            bad = []
+            for k, (channel, data) in enumerate(lines):
+                try:
+                    if channel == SectionRate:
+                        if not math.isfinite(float(data)):
+                            raise ValueError(f"measure length {data!r} is not finite")
+                        continue
+                    kind, lane_number = ChannelTable[channel]
+                    if lane_number == -1:
+                        continue
+                    if ObjectData.fullmatch(data) is None:
+                        if kind not in ObjectChannels:
+                            table = Base62Pairs if self.use_base62 else Base36Pairs
+                            pairs = [data[i:i+2] for i in range(0, len(data) - 1, 2)]
+                            lines[k] = (channel, "".join(pair if pair in table else "01" for pair in pairs))
+                            self.diagnose(SeverityWarning, "bad-channel",
+                                          f"#{measure:03}{Base36Digits[channel // 36]}{Base36Digits[channel % 36]}: "
+                                          "undecodable objects on an unused channel", line_numbers[measure][k])
+                            continue
+                        self.decode_ids(data)
+                    if kind == BpmChange and len(data) > 0 and HexData.fullmatch(data) is None:
+                        int(data, 16)
+                except ValueError as e:
+                    bad.append(k)
+                    self.fail("bad-channel", f"#{measure:03}{Base36Digits[channel // 36]}{Base36Digits[channel % 36]}: {e}",
+                              line_numbers[measure][k])
+                    continue
+                if kind == BpmChangeExtend:
+                    ids = self.decode_ids(data)
+                    unknown = [j for j, id in enumerate(ids) if id != 0 and self.bpm_table.get(id, 0.0) == 0]
+                    if len(unknown) > 0:
+                        self.fail("bad-channel", f"#{measure:03}08: no usable #BPM{data[unknown[0]*2:unknown[0]*2+2]}",
+                                  line_numbers[measure][k])
+                        cleared = list(data)
+                        for j in unknown:
+                            cleared[j*2:j*2+2] = "00"
+                        lines[k] = (channel, "".join(cleared))
+            for k in reversed(bad):
+                del lines[k]
+                del line_numbers[measure][k]
+    def parse_tokens(self, tokens: Iterable[tuple], mode: int = ParseFull):
+        # parse already tokenized input; hashes are left to the caller
+        measures, last_measure, header_channels = self.collect_tokens(tokens, mode)
+        return self.parse_measures(measures, last_measure, header_channels, mode)
+    def parse_measures(self, measures: dict[int, list[tuple[int, str]]], last_measure: int,
+                       header_channels: set[int], mode: int = ParseFull):
+        # the rest of parse_tokens, on the output of collect_tokens
+        stats = self.stats
+        if stats is not None:
+            started = time.perf_counter()
+        if mode == ParseHeaderOnly:
+            self.update_key_modes(header_channels)
+            if stats is not None:
+                stats.add_time("key_mode", time.perf_counter() - started)
+            return self.chart
+        if mode == ParseNoteStats:
+            self.count_notes(measures, last_measure)
+            if stats is not None:
+                stats.add_time("count_notes", time.perf_counter() - started)
+            return self.chart
+        if mode == ParseLazy:
+            checkpoints: list[tuple[Fraction, float, float, float]] = []
+            links: list[tuple[int, int]] = []
+            self.count_notes(measures, last_measure, checkpoints, links)
+            self.chart.measures = LazyMeasures(self, measures, checkpoints, links, self.measure_cache_size) # type: ignore
+            if stats is not None:
+                stats.add_time("count_notes", time.perf_counter() - started)
+            return self.chart
+        return self.build_chart(measures, last_measure)
+    def update_key_modes(self, channels: Iterable[int]):
+        for channel in channels:
+            if channel == SectionRate: continue
+            _, lane_number = ChannelTable[channel]
+            if lane_number == -1: continue
+            self.update_key_mode(lane_number)
+    def expand_measure(self, lines: list[tuple[int, str]], last_note: list, ln_start: list):
+        # Build the timelines and notes of one measure, sorted by position.
+        # last_note/ln_start carry the LNOBJ and LNTYPE 1 state across measures
+        # and are updated in place. Returns the measure and its
+        # (notes, long notes, scratch notes, landmine notes) counts.
+        total_notes = 0
+        total_long_notes = 0
+        total_scratch_notes = 0
+        total_landmine_notes = 0
+        wav_table = self.chart.wav_table
+        measure = Measure()
+        decoded: list[tuple[int, int, str, list[int]]] = []
+        for channel, data in lines:
+            if channel == SectionRate:
+                measure.scale = float(data)
+                continue
+            channel, lane_number = ChannelTable[channel]
+            if lane_number == -1:
+                continue
+            self.update_key_mode(lane_number)
+            ids = self.decode_ids(data)
+            if len(ids) > 0:
+                decoded.append((channel, lane_number, data, ids))
+        # every line is put on the lcm of the line lengths, so positions are
+        # integer ticks of one resolution and equal positions meet exactly
+        resolution = math.lcm(*[len(line[3]) for line in decoded]) if len(decoded) > 0 else 1
+        measure.resolution = resolution
+        # tick -> timeline; a list indexed by tick keeps them sorted for free
+        # unless the resolution is too fine for that
+        bucketed = resolution <= MaxBucketResolution
+        timelines: Union[list[Union[TimeLine, None]], dict[int, TimeLine]] = [None] * resolution if bucketed else {}
+        # the first line of a measure always starts a timeline at 0, a ghost one if its first object is empty
+        timelines[0] = TimeLine()
+        for channel, lane_number, data, ids in decoded:
+            is_scratch = lane_number == 7 or lane_number == 15
+            step = resolution // len(ids)
+            for j, id in enumerate(ids):
+                if id == 0:
+                    continue
+                tick = j * step
+                timeline = timelines[tick] if bucketed else timelines.get(tick) # type: ignore
+                if timeline is None:
+                    timeline = timelines[tick] = TimeLine()
+                    timeline.tick = tick
+                    timeline.position = tick / resolution
+
+                if channel == P1KeyBase:
+                    if id == self.lnobj and last_note[lane_number] is not None:
+                        if is_scratch:
+                            total_scratch_notes += 1
                         else:
-                            timeline.stop_length = 0.0
-                    elif channel == P1KeyBase:
-                        ch = self.parse_int(val)
-                        if ch == self.lnobj and last_note[lane_number] is not None:
+                            total_long_notes += 1
+                        last = last_note[lane_number]
+                        last_note[lane_number] = None
+                        assert last is not None
+                        last_timeline = last.timeline
+                        assert last_timeline is not None
+                        ln = LongNote(last.wav)
+                        del last
+                        ln.tail = LongNote(self.no_wav)
+                        ln.tail.head = ln
+                        last_timeline.set_note(lane_number, ln)
+                        timeline.set_note(lane_number, ln.tail)
+                    else:
+                        note = Note(id if id in wav_table else self.no_wav)
+                        last_note[lane_number] = note
+                        total_notes += 1
+                        if is_scratch:
+                            total_scratch_notes += 1
+                        timeline.set_note(lane_number, note)
+                elif channel == LaneAutoplay:
+                    bg_note = Note(id if id in wav_table else self.no_wav)
+                    timeline.add_background_note(bg_note)
+                elif channel == BpmChange:
+                    # hex to int
+                    bpm = int(data[j*2:j*2+2], 16)
+                    timeline.bpm = bpm
+                    timeline.bpm_change = True
+                elif channel == BgaPlay:
+                    timeline.bga_base = id
+                elif channel == PoorPlay:
+                    timeline.bga_poor = id
+                elif channel == LayerPlay:
+                    timeline.bga_layer = id
+                elif channel == BpmChangeExtend:
+                    if id in self.bpm_table:
+                        timeline.bpm = self.bpm_table[id]
+                    else:
+                        timeline.bpm = 0.0
+                    timeline.bpm_change = True
+                elif channel == Scroll:
+                    timeline.scroll_change = True
+                    if id in self.scroll_table:
+                        timeline.scroll = self.scroll_table[id]
+                    else:
+                        timeline.scroll = 1.0
+                elif channel == Stop:
+                    if id in self.stop_length_table:
+                        timeline.stop_length = self.stop_length_table[id]
+                    else:
+                        timeline.stop_length = 0.0
+                elif channel == P1InvisibleKeyBase:
+                    invisible_note = Note(id if id in wav_table else self.no_wav)
+                    timeline.set_invisible_note(lane_number, invisible_note)
+                elif channel == P1LongKeyBase:
+                    if self.lntype == 1:
+                        if ln_start[lane_number] is None:
+                            total_notes += 1
                             if is_scratch:
                                 total_scratch_notes += 1
                             else:
                                 total_long_notes += 1
-                            last = last_note[lane_number]
-                            last_note[lane_number] = None
-                            assert last is not None
-                            last_timeline = last.timeline
-                            assert last_timeline is not None
-                            ln = LongNote(last.wav)
-                            del last
-                            ln.tail = LongNote(self.no_wav)
-                            ln.tail.head = ln
-                            last_timeline.set_note(lane_number, ln)
-                            timeline.set_note(lane_number, ln.tail)
+                            
+                            ln = LongNote(id if id in wav_table else self.no_wav)
+                            ln_start[lane_number] = ln
+                            timeline.set_note(lane_number, ln)
                         else:
-                            note = Note(self.to_wave_id(val))
-                            last_note[lane_number] = note
-                            total_notes += 1
-                            if is_scratch:
-                                total_scratch_notes += 1
-                            timeline.set_note(lane_number, note)
-                    elif channel == P1InvisibleKeyBase:
-                        invisible_note = Note(self.to_wave_id(val))
-                        timeline.set_invisible_note(lane_number, invisible_note)
-                    elif channel == P1LongKeyBase:
-                        if self.lntype == 1:
-                            if ln_start[lane_number] is None:
-                                total_notes += 1
-                                if is_scratch:
-                                    total_scratch_notes += 1
-                                else:
-                                    total_long_notes += 1
-                                
-                                ln = LongNote(self.to_wave_id(val))
-                                ln_start[lane_number] = ln
-                                timeline.set_note(lane_number, ln)
-                            else:
-                                tail = LongNote(self.no_wav)
-                                tail.head = ln_start[lane_number]
-                                assert tail.head is not None
-                                tail.head.tail = tail
-                                timeline.set_note(lane_number, tail)
-                                ln_start[lane_number] = None
-                    elif channel == P1MineKeyBase:
-                        total_landmine_notes += 1
-                        damage = self.parse_int(val, True) / 2.0
-                        timeline.set_note(lane_number, LandmineNote(damage))
-            self.chart.meta.total_notes = total_notes
-            self.chart.meta.total_long_notes = total_long_notes
-            self.chart.meta.total_scratch_notes = total_scratch_notes
-            self.chart.meta.total_backspin_notes = total_backspin_notes
-
-            last_position = 0.0
-            measure.timing = int(time_passed)
-            for position, timeline in sorted(timelines.items()):
-                interval = 240000000.0 * (position - last_position) * measure.scale / current_bpm
-                time_passed += interval
-                timeline.timing = int(time_passed)
-                if timeline.bpm_change:
-                    current_bpm = timeline.bpm
-                    min_bpm = min(min_bpm, current_bpm)
-                    max_bpm = max(max_bpm, current_bpm)
-                else:
-                    timeline.bpm = current_bpm
-                time_passed += timeline.get_stop_duration()
-                measure.timelines.append(timeline)
-                last_position = position
-            if len(measure.timelines) == 0:
-                timeline = TimeLine()
-                timeline.timing = int(time_passed)
+                            tail = LongNote(self.no_wav)
+                            tail.head = ln_start[lane_number]
+                            assert tail.head is not None
+                            tail.head.tail = tail
+                            timeline.set_note(lane_number, tail)
+                            ln_start[lane_number] = None
+                elif channel == P1MineKeyBase:
+                    total_landmine_notes += 1
+                    damage = (id if not self.use_base62 else int(data[j*2:j*2+2], 36)) / 2.0
+                    timeline.set_note(lane_number, LandmineNote(damage))
+        if bucketed:
+            measure.timelines = [timeline for timeline in timelines if timeline is not None] # type: ignore
+        else:
+            measure.timelines = [timelines[tick] for tick in sorted(timelines)] # type: ignore
+        return measure, (total_notes, total_long_notes, total_scratch_notes, total_landmine_notes)
+    def time_measure(self, measure: Measure, time_passed: Fraction, current_bpm: float,
+                     visual: float = 0.0, scroll: float = 1.0):
+        # Assign timings to an expanded measure starting at time_passed, the
+        # exact time in us. BPM, scale and stop values count at the exact value
+        # of their floats, so timings do not drift and are the same on every
+        # platform. Between BPM changes and stops a timeline's timing is one
+        # integer floor division. Visual positions start from visual with the
+        # scroll speed in effect. Returns the exact time at the end of the
+        # measure, the bpm in effect there, the time of its last timeline
+        # (play length so far) and the visual position and scroll at the end.
+        resolution = measure.resolution
+        length = 4.0 * measure.scale
+        # visual position and measure position of the last scroll change
+        segment_visual = visual
+        segment = 0.0
+        steps = self.tick_steps
+        measure.timing = int(time_passed)
+        # the time at tick t is (a + b * (t - base_tick)) / d
+        step = steps.get((measure.scale, resolution, current_bpm))
+        if step is None:
+            step = steps[(measure.scale, resolution, current_bpm)] = Fraction(measure.scale) * 240000000 / resolution / Fraction(current_bpm)
+        a = time_passed.numerator * step.denominator
+        b = step.numerator * time_passed.denominator
+        d = time_passed.denominator * step.denominator
+        base_tick = 0
+        for timeline in measure.timelines:
+            timeline.visual = segment_visual + length * (timeline.position - segment) * scroll
+            if timeline.scroll_change:
+                segment_visual = timeline.visual
+                segment = timeline.position
+                scroll = timeline.scroll
+            if not timeline.bpm_change and timeline.stop_length == 0:
+                timeline.timing = (a + b * (timeline.tick - base_tick)) // d
                 timeline.bpm = current_bpm
-                measure.timelines.append(timeline)
-            self.chart.meta.play_length = int(time_passed)
-            time_passed += 240000000.0 * (1 - last_position) * measure.scale / current_bpm
+                continue
+            base = Fraction(a + b * (timeline.tick - base_tick), d)
+            timeline.timing = int(base)
+            if timeline.bpm_change:
+                current_bpm = timeline.bpm
+            else:
+                timeline.bpm = current_bpm
+            if timeline.stop_length != 0:
+                base += Fraction(timeline.stop_length) * 1250000 / Fraction(timeline.bpm)
+            base_tick = timeline.tick
+            step = steps.get((measure.scale, resolution, current_bpm))
+            if step is None:
+                step = steps[(measure.scale, resolution, current_bpm)] = Fraction(measure.scale) * 240000000 / resolution / Fraction(current_bpm)
+            a = base.numerator * step.denominator
+            b = step.numerator * base.denominator
+            d = base.denominator * step.denominator
+        play_length = (a + b * (measure.timelines[-1].tick - base_tick)) // d
+        visual = segment_visual + length * (1.0 - segment) * scroll
+        return Fraction(a + b * (resolution - base_tick), d), current_bpm, play_length, visual, scroll
+    def build_chart(self, measures: dict[int, list[tuple[int, str]]], last_measure: int):
+        stats = self.stats
+        time_passed = Fraction(0)
+        total_notes = 0
+        total_long_notes = 0
+        total_scratch_notes = 0
+        current_bpm = self.chart.meta.bpm
+        min_bpm = self.chart.meta.bpm
+        max_bpm = self.chart.meta.bpm
+        visual = 0.0
+        scroll = 1.0
+        last_note: list[Union[Note, None]] = [None] * 16
+        ln_start: list[Union[LongNote, None]] = [None] * 16
+        states = self.measure_states
+        expand_seconds = 0.0
+        timing_seconds = 0.0
+        for i in range(last_measure+1):
+            if stats is not None:
+                started = time.perf_counter()
+            lines = measures.get(i, [])
+            if states is not None:
+                states.append(MeasureState(lines, last_note, ln_start, (time_passed, current_bpm, min_bpm, max_bpm,
+                                                                        self.chart.meta.play_length, visual, scroll)))
+            measure, counts = self.expand_measure(lines, last_note, ln_start)
+            total_notes += counts[0]
+            total_long_notes += counts[1]
+            total_scratch_notes += counts[2]
+            if states is not None:
+                states[-1].counts = counts
+            if stats is not None:
+                expanded = time.perf_counter()
+                expand_seconds += expanded - started
+            for timeline in measure.timelines:
+                if timeline.bpm_change:
+                    min_bpm = min(min_bpm, timeline.bpm)
+                    max_bpm = max(max_bpm, timeline.bpm)
+            time_passed, current_bpm, self.chart.meta.play_length, visual, scroll = self.time_measure(
+                measure, time_passed, current_bpm, visual, scroll)
             self.chart.measures.append(measure)
+            if stats is not None:
+                timing_seconds += time.perf_counter() - expanded
+        if states is not None:
+            self.exit_state = MeasureState([], last_note, ln_start, (time_passed, current_bpm, min_bpm, max_bpm,
+                                                                     self.chart.meta.play_length, visual, scroll))
+        self.chart.meta.total_notes = total_notes
+        self.chart.meta.total_long_notes = total_long_notes
+        self.chart.meta.total_scratch_notes = total_scratch_notes
         self.chart.meta.total_length = int(time_passed)
         self.chart.meta.min_bpm = min_bpm
         self.chart.meta.max_bpm = max_bpm
+        if stats is None:
+            self.chart.timing_index = TimingIndex(self.chart)
+        else:
+            stats.add_time("expand", expand_seconds)
+            stats.add_time("timing", timing_seconds)
+            stats.count("timelines", sum(len(measure.timelines) for measure in self.chart.measures))
+            started = time.perf_counter()
+            self.chart.timing_index = TimingIndex(self.chart)
+            stats.add_time("timing_index", time.perf_counter() - started)
+        return self.chart
+
+class _FirstBranch:
+    # stands in for random.Random so unselected #RANDOMs take their first value
+    def randint(self, a: int, b: int):
+        return a
+
+class RandomBranch:
+    def __init__(self, selection: list[int], chart: Chart):
+        self.selection = selection
+        self.chart = chart
+        self.meta = chart.meta
+    def __repr__(self):
+        return f"RandomBranch({self.selection}, notes={self.meta.total_notes})"
+
+class RandomBranches(list):
+    # list of RandomBranch; truncated when the limit stopped the enumeration
+    # with combinations left unparsed
+    def __init__(self, branches: Iterable[RandomBranch] = (), truncated: bool = False):
+        super().__init__(branches)
+        self.truncated = truncated
+
+# headers that change how channel lines are checked, counted or timed
+GraphHeaders = frozenset(("BASE", "BPM", "STOP", "SCROLL", "LNOBJ", "LNTYPE"))
+
+def _split_random_blocks(tokens: list[tuple]):
+    # Split tokens into those outside any #RANDOM/#IF and those inside one,
+    # tracking the stacks the way control_flow does. Returns (shared tokens,
+    # block tokens, whether the shared tokens can be run once ahead of the
+    # blocks): not when a block sets a graph header, or sets a header that a
+    # later shared line sets again.
+    shared: list[tuple] = []
+    blocks: list[tuple] = []
+    randoms = 0
+    ifs = 0
+    block_headers: set[tuple[str, str]] = set()
+    independent = True
+    for token in tokens:
+        kind = token[0]
+        if kind == TokenControl:
+            word = token[1]
+            opened = randoms + ifs > 0
+            if word == "IF":
+                if randoms > 0:
+                    ifs += 1
+            elif word == "ENDIF":
+                if ifs > 0:
+                    ifs -= 1
+            elif word == "RANDOM" or word == "RONDAM" or word == "SETRANDOM":
+                randoms += 1
+            elif word == "ENDRANDOM":
+                if randoms > 0:
+                    randoms -= 1
+            if opened or randoms + ifs > 0:
+                blocks.append(token)
+            continue
+        if randoms + ifs > 0:
+            blocks.append(token)
+            if kind == TokenHeader:
+                key = (token[1].upper(), token[2].upper())
+                independent = independent and key[0] not in GraphHeaders
+                block_headers.add(key)
+            continue
+        shared.append(token)
+        if kind == TokenHeader and len(blocks) > 0:
+            key = (token[1].upper(), token[2].upper())
+            independent = independent and key[0] != "BASE" and key not in block_headers
+    return shared, blocks, independent
+
+def enumerate_random_branches(path: str, mode: int = ParseNoteStats, limit: Union[int, None] = 4096) -> RandomBranches:
+    # Parse every reachable #RANDOM/#IF combination of a chart, ordered by selection.
+    # The file is read, hashed and tokenized once. Lines outside #RANDOM blocks
+    # are run once by a template parser whose headers and channel lines every
+    # combination starts from, so only the blocks are replayed, and note
+    # counting reuses the result of every measure seen before with the same
+    # lines and entry state. When a block sets a BPM/STOP/SCROLL/LN/#BASE header
+    # there is no template and measures are counted afresh for every
+    # combination, since their counts depend on those tables. Each run fixes a prefix of choices and lets the
+    # rest fall to value 1, then queues the sibling values of every choice it
+    # made itself. Past limit combinations the result is cut short and marked
+    # truncated.
+    tokenizer = BmsTokenizer(path)
+    tokens = list(tokenizer)
+    sha256 = tokenizer.sha256.hexdigest()
+    md5 = tokenizer.md5.hexdigest()
+    shared, blocks, independent = _split_random_blocks(tokens)
+    template: Union[BmsParser, None] = None
+    if independent:
+        template = BmsParser(path, encoding=tokenizer.encoding)
+        shared_numbers: dict[int, list[int]] = {}
+        shared_measures, shared_last, shared_channels = template.collect_tokens(shared, mode, shared_numbers)
+    counts: dict = {}
+    branches = RandomBranches()
+    pending: list[list[int]] = [[]]
+    while len(pending) > 0:
+        if limit is not None and len(branches) >= limit:
+            branches.truncated = True
+            break
+        prefix = pending.pop()
+        parser = BmsParser(path, random_selection=prefix, encoding=tokenizer.encoding)
+        parser.prng = _FirstBranch()
+        if template is None:
+            chart = parser.parse_tokens(tokens, mode)
+        else:
+            parser.copy_headers(template)
+            parser.measure_counts = counts
+            numbers: dict[int, list[int]] = {}
+            measures, last_measure, channels = parser.collect_tokens(blocks, mode, numbers)
+            for measure, lines in measures.items():
+                if measure in shared_measures:
+                    # back in file order
+                    merged = sorted(zip(shared_numbers[measure] + numbers[measure], shared_measures[measure] + lines))
+                    measures[measure] = [line for _, line in merged]
+            for measure, lines in shared_measures.items():
+                measures.setdefault(measure, lines)
+            chart = parser.parse_measures(measures, max(last_measure, shared_last), channels | shared_channels, mode)
+        chart.meta.sha256 = sha256
+        chart.meta.md5 = md5
+        selection = [value for _, value in parser.random_choices]
+        for k in range(len(prefix), len(selection)):
+            n = parser.random_choices[k][0]
+            for value in range(n, 1, -1):
+                pending.append(selection[:k] + [value])
+        branches.append(RandomBranch(selection, chart))
+    branches.sort(key=lambda branch: branch.selection)
+    return branches
+
+def _lanes_with_objects(lines: list[tuple[int, str]], kind: int):
+    # lanes that have a non-zero object in a channel of the given kind
+    lanes: set[int] = set()
+    for channel, data in lines:
+        if channel == SectionRate:
+            continue
+        channel_kind, lane_number = ChannelTable[channel]
+        if channel_kind == kind and lane_number != -1 and len(data.strip("0")) > 0:
+            lanes.add(lane_number)
+    return lanes
+
+def _lanes_opening_with(lines: list[tuple[int, str]], parser: 'BmsParser', object_id: int):
+    # key lanes whose first object in parse order is object_id, i.e. where an
+    # LNOBJ closes a note from an earlier measure
+    first: dict[int, int] = {}
+    for channel, data in lines:
+        if channel == SectionRate:
+            continue
+        channel_kind, lane_number = ChannelTable[channel]
+        if channel_kind != P1KeyBase or lane_number == -1 or lane_number in first:
+            continue
+        for id in parser.decode_ids(data):
+            if id != 0:
+                first[lane_number] = id
+                break
+    return [lane for lane, id in first.items() if id == object_id]
+
+class IncrementalParser:
+    # Re-parses a chart that is edited and saved repeatedly, e.g. by an editor
+    # with hot reload. reparse() diffs the new channel lines per measure against
+    # the previous parse, re-expands only the measures that changed (plus those
+    # whose long notes connect to a changed one), re-times from the first change
+    # until timing converges again, and reuses every other Measure object.
+    # Header-only edits keep the whole note graph. Reused measures are shared
+    # with the previous Chart, which must not be used after reparse().
+    def __init__(self, path: str, seed: Union[int, None] = None):
+        self.path = path
+        self.seed = seed
+        self.parser: Union[BmsParser, None] = None
+        self.chart: Union[Chart, None] = None
+        # measures expanded by the last parse()/reparse()
+        self.rebuilt = 0
+    def parse(self) -> Chart:
+        parser = BmsParser(self.path, seed=self.seed)
+        parser.measure_states = []
+        self.chart = parser.parse()
+        self.parser = parser
+        self.rebuilt = len(self.chart.measures)
         return self.chart
+    def reparse(self) -> Chart:
+        old = self.parser
+        if old is None or self.chart is None:
+            return self.parse()
+        tokenizer = BmsTokenizer(self.path)
+        tokens = list(tokenizer)
+        sha256 = tokenizer.sha256.hexdigest()
+        if sha256 == self.chart.meta.sha256:
+            self.rebuilt = 0
+            return self.chart
+        # keep the #RANDOM branches of the previous parse
+        parser = BmsParser(self.path, seed=self.seed, random_selection=[value for _, value in old.random_choices],
+                           encoding=tokenizer.encoding)
+        parser.measure_states = []
+        try:
+            measures, last_measure, _ = parser.collect_tokens(tokens)
+        except ValueError:
+            # the edit changed a #RANDOM range; start over
+            return self.parse()
+        if not self.same_graph_headers(old, parser):
+            parser.build_chart(measures, last_measure)
+            self.rebuilt = len(parser.chart.measures)
+        else:
+            self.update(old, parser, [measures.get(i, []) for i in range(last_measure + 1)])
+        parser.chart.meta.sha256 = sha256
+        parser.chart.meta.md5 = tokenizer.md5.hexdigest()
+        self.parser = parser
+        self.chart = parser.chart
+        return self.chart
+    def same_graph_headers(self, old: BmsParser, new: BmsParser):
+        # headers that change how channel data turns into notes and timings
+        return (old.use_base62 == new.use_base62 and old.lnobj == new.lnobj and old.lntype == new.lntype
+                and old.chart.meta.bpm == new.chart.meta.bpm and old.bpm_table == new.bpm_table
+                and old.stop_length_table == new.stop_length_table and old.scroll_table == new.scroll_table
+                and old.chart.wav_table.keys() == new.chart.wav_table.keys()
+                and old.random_choices == new.random_choices)
+    def unlink(self, old: BmsParser, old_state: MeasureState, old_measure: Measure):
+        # Undo what the old version of a measure being rebuilt did to notes of
+        # earlier measures: an LNOBJ turning the lane's previous note into a long
+        # note head, or an LNTYPE 1 tail closing a long note started earlier.
+        timelines = set(map(id, old_measure.timelines))
+        for note in old_state.last_note if old.lnobj != -1 else ():
+            if note is None or note.timeline is None:
+                continue
+            head = note.timeline.notes[note.lane]
+            if (head is not note and isinstance(head, LongNote) and head.wav == note.wav
+                    and head.tail is not None and id(head.tail.timeline) in timelines):
+                note.timeline.notes[note.lane] = note
+        for head in old_state.ln_start:
+            if head is not None and head.tail is not None and id(head.tail.timeline) in timelines:
+                head.tail = None
+    def update(self, old: BmsParser, parser: BmsParser, lines: list[list[tuple[int, str]]]):
+        chart = parser.chart
+        old_chart = old.chart
+        old_states = old.measure_states
+        assert old_states is not None and old.exit_state is not None
+        states: list[MeasureState] = []
+        parser.measure_states = states
+        count = len(lines)
+        old_count = len(old_states)
+        changed = [i for i in range(count) if i >= old_count or lines[i] != old_states[i].lines]
+        if len(changed) == 0 and count == old_count:
+            # header-only edit
+            chart.measures = old_chart.measures
+            chart.timing_index = old_chart.timing_index
+            for field in ("play_length", "total_length", "min_bpm", "max_bpm", "key_mode", "is_dp",
+                          "total_notes", "total_long_notes", "total_scratch_notes", "total_backspin_notes"):
+                setattr(chart.meta, field, getattr(old_chart.meta, field))
+            states += old_states
+            parser.exit_state = old.exit_state
+            self.rebuilt = 0
+            return
+        first = changed[0] if len(changed) > 0 else count
+        last_changed = changed[-1] if len(changed) > 0 else count - 1
+        start = min(first, old_count)
+        for i in range(count, old_count):
+            # measures cut off the end
+            self.unlink(old, old_states[i], old_chart.measures[i])
+        states += old_states[:start]
+        chart.measures = old_chart.measures[:start]
+        entry = old_states[start] if start < old_count else old.exit_state
+        last_note = list(entry.last_note)
+        ln_start = list(entry.ln_start)
+        time_passed, current_bpm, min_bpm, max_bpm, play_length, visual, scroll = entry.timing
+        rebuilt = 0
+        i = start
+        while i < count:
+            old_state = old_states[i] if i < old_count else None
+            timing = (time_passed, current_bpm, min_bpm, max_bpm, play_length, visual, scroll)
+            if (old_state is not None and i > last_changed and count == old_count and timing == old_state.timing
+                    and all(a is b for a, b in zip(last_note, old_state.last_note))
+                    and all(a is b for a, b in zip(ln_start, old_state.ln_start))):
+                # everything from here on is exactly as before
+                states += old_states[i:]
+                chart.measures += old_chart.measures[i:]
+                parser.exit_state = old.exit_state
+                time_passed, current_bpm, min_bpm, max_bpm, play_length, visual, scroll = old.exit_state.timing
+                break
+            state = MeasureState(lines[i], last_note, ln_start, timing)
+            reuse = old_state is not None and lines[i] == old_state.lines
+            if reuse and old.lnobj != -1:
+                # only an LNOBJ can reach back to the lane's note from before this measure
+                reuse = all(last_note[lane] is old_state.last_note[lane]
+                            for lane in _lanes_opening_with(lines[i], parser, old.lnobj))
+            if reuse and old.lntype == 1:
+                reuse = all(ln_start[lane] is old_state.ln_start[lane] for lane in _lanes_with_objects(lines[i], P1LongKeyBase))
+            if reuse:
+                assert old_state is not None
+                measure = old_chart.measures[i]
+                state.counts = old_state.counts
+                # lanes this measure touches leave it as they did before
+                old_exit = old_states[i + 1] if i + 1 < old_count else old.exit_state
+                for lane in _lanes_with_objects(lines[i], P1KeyBase):
+                    last_note[lane] = old_exit.last_note[lane]
+                for lane in _lanes_with_objects(lines[i], P1LongKeyBase):
+                    ln_start[lane] = old_exit.ln_start[lane]
+            else:
+                if old_state is not None:
+                    self.unlink(old, old_state, old_chart.measures[i])
+                measure, state.counts = parser.expand_measure(lines[i], last_note, ln_start)
+                rebuilt += 1
+            states.append(state)
+            for timeline in measure.timelines:
+                if timeline.bpm_change:
+                    min_bpm = min(min_bpm, timeline.bpm)
+                    max_bpm = max(max_bpm, timeline.bpm)
+            time_passed, current_bpm, play_length, visual, scroll = parser.time_measure(measure, time_passed, current_bpm, visual, scroll)
+            chart.measures.append(measure)
+            i += 1
+        else:
+            parser.exit_state = MeasureState([], last_note, ln_start, (time_passed, current_bpm, min_bpm, max_bpm, play_length, visual, scroll))
+        meta = chart.meta
+        meta.total_notes = sum(state.counts[0] for state in states)
+        meta.total_long_notes = sum(state.counts[1] for state in states)
+        meta.total_scratch_notes = sum(state.counts[2] for state in states)
+        meta.play_length = play_length
+        meta.total_length = int(time_passed)
+        meta.min_bpm = min_bpm
+        meta.max_bpm = max_bpm
+        parser.update_key_modes({channel for measure_lines in lines for channel, _ in measure_lines})
+        chart.timing_index = TimingIndex(chart)
+        self.rebuilt = rebuilt
@@ -0,0 +1,150 @@
+"""
+ * Copyright (C) 2024 VioletXF, khoeun03
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+from typing import Union
+from bmsparser import Chart
+
+# tried in order after the extension written in the chart
+AudioExtensions = (".wav", ".ogg", ".flac", ".mp3")
+ImageExtensions = (".bmp", ".png", ".jpg", ".jpeg", ".gif", ".mpg", ".mpeg", ".avi", ".mp4", ".wmv", ".webm", ".m4v")
+
+def normalize_name(name: str):
+    # chart references use either slash and any case
+    name = name.strip().replace("\\", "/")
+    while name.startswith("./"):
+        name = name[2:]
+    return name.lower()
+
+class FolderIndex:
+    # Names of one directory from a single scandir, keyed by lowercased stem and
+    # then extension. Subdirectories are matched case-insensitively as well and
+    # listed the first time a reference points into them.
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.mtime_ns = os.stat(folder).st_mtime_ns
+        self.entries: dict[str, dict[str, os.DirEntry]] = {}
+        # lowercased relative directory -> actual path, or None once listed
+        self.dirs: dict[str, Union[str, None]] = {"": folder}
+        self.list_dir("")
+    def list_dir(self, subdir: str):
+        # subdir is lowercased; parents are listed first to find its actual name
+        if subdir not in self.dirs:
+            parent = os.path.dirname(subdir)
+            if parent == subdir:
+                return
+            if self.dirs.get(parent, "") is not None:
+                self.list_dir(parent)
+            if subdir not in self.dirs:
+                return
+        path = self.dirs[subdir]
+        if path is None:
+            return
+        self.dirs[subdir] = None
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    name = entry.name.lower()
+                    key = subdir + "/" + name if subdir else name
+                    if entry.is_dir():
+                        self.dirs.setdefault(key, entry.path)
+                    stem, ext = os.path.splitext(key)
+                    self.entries.setdefault(stem, {})[ext] = entry
+        except OSError:
+            pass
+    def find(self, name: str, extensions: tuple) -> Union[os.DirEntry, None]:
+        name = normalize_name(name)
+        subdir = os.path.dirname(name)
+        if self.dirs.get(subdir, "") is not None:
+            self.list_dir(subdir)
+        stem, ext = os.path.splitext(name)
+        candidates = self.entries.get(stem)
+        if candidates is None:
+            return None
+        for candidate in (ext,) + extensions:
+            entry = candidates.get(candidate)
+            if entry is not None and entry.is_file():
+                return entry
+        return None
+
+class ResolvedResources:
+    def __init__(self):
+        # id -> absolute path on disk
+        self.wav: dict[int, str] = {}
+        self.bmp: dict[int, str] = {}
+        # id -> name as written in the chart
+        self.missing_wav: dict[int, str] = {}
+        self.missing_bmp: dict[int, str] = {}
+        self.wav_bytes = 0
+        self.bmp_bytes = 0
+    @property
+    def total_bytes(self):
+        return self.wav_bytes + self.bmp_bytes
+    @property
+    def missing(self):
+        return sorted(set(self.missing_wav.values()) | set(self.missing_bmp.values()))
+    def __str__(self):
+        return (f"ResolvedResources(wav={len(self.wav)}, bmp={len(self.bmp)}, missing={len(self.missing_wav) + len(self.missing_bmp)}, "
+                f"bytes={self.total_bytes})")
+
+class ResourceResolver:
+    # Resolves keysound and BGA references of charts against their folders.
+    # Each folder is listed once and its index is shared by every chart in it;
+    # an index is rebuilt when the folder's mtime changes. Sizes are read from
+    # the directory entries only for files that were actually resolved.
+    def __init__(self, audio_extensions: tuple = AudioExtensions, image_extensions: tuple = ImageExtensions):
+        self.audio_extensions = audio_extensions
+        self.image_extensions = image_extensions
+        self.indexes: dict[str, FolderIndex] = {}
+    def index(self, folder: str) -> FolderIndex:
+        key = os.path.normcase(os.path.abspath(folder))
+        index = self.indexes.get(key)
+        if index is None or os.stat(key).st_mtime_ns != index.mtime_ns:
+            index = self.indexes[key] = FolderIndex(key)
+        return index
+    def invalidate(self, folder: Union[str, None] = None):
+        if folder is None:
+            self.indexes.clear()
+        else:
+            self.indexes.pop(os.path.normcase(os.path.abspath(folder)), None)
+    def resolve(self, folder: str, name: str, extensions: Union[tuple, None] = None) -> Union[str, None]:
+        entry = self.index(folder).find(name, self.audio_extensions if extensions is None else extensions)
+        return None if entry is None else entry.path
+    def resolve_table(self, index: FolderIndex, table: dict[int, str], extensions: tuple,
+                      found: dict[int, str], missing: dict[int, str]):
+        size = 0
+        sized: set[str] = set()
+        for id, name in table.items():
+            entry = index.find(name, extensions)
+            if entry is None:
+                missing[id] = name
+                continue
+            found[id] = entry.path
+            if entry.path not in sized:
+                sized.add(entry.path)
+                size += entry.stat().st_size
+        return size
+    def resolve_chart(self, chart: Chart) -> ResolvedResources:
+        resolved = ResolvedResources()
+        try:
+            index = self.index(chart.meta.folder or ".")
+        except OSError:
+            resolved.missing_wav.update(chart.wav_table)
+            resolved.missing_bmp.update(chart.bmp_table)
+            return resolved
+        resolved.wav_bytes = self.resolve_table(index, chart.wav_table, self.audio_extensions, resolved.wav, resolved.missing_wav)
+        resolved.bmp_bytes = self.resolve_table(index, chart.bmp_table, self.image_extensions, resolved.bmp, resolved.missing_bmp)
+        return resolved
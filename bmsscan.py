@@ -0,0 +1,184 @@
+"""
+ * Copyright (C) 2024 VioletXF, khoeun03
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from typing import Callable, Iterator, Union
+from bmsparser import BmsParser, ChartMeta, ParseFull, ParseHeaderOnly, ParseNoteStats
+from bmscache import ParseCache
+
+ChartExtensions = (".bms", ".bme", ".bml", ".pms")
+
+ScanModes = {
+    "header": ParseHeaderOnly,
+    "stats": ParseNoteStats,
+    "full": ParseFull,
+}
+
+class ScanResult:
+    def __init__(self, path: str, meta: Union[ChartMeta, None] = None, error: Union[str, None] = None,
+                 stat: Union[tuple[int, int], None] = None, cached: bool = False,
+                 diagnostics: Union[dict, None] = None):
+        self.path = path
+        self.meta = meta
+        self.error = error
+        self.stat = stat
+        self.cached = cached
+        # Diagnostics.as_dict() of the parse, None if it had nothing to report
+        self.diagnostics = diagnostics
+    def ok(self):
+        return self.error is None
+    def to_dict(self):
+        result: dict = {"path": self.path}
+        if self.meta is not None:
+            result["meta"] = vars(self.meta)
+        if self.error is not None:
+            result["error"] = self.error
+        if self.diagnostics is not None:
+            result["diagnostics"] = self.diagnostics
+        return result
+
+class ScanProgress:
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.errors = 0
+        self.cached = 0
+        self.started = time.perf_counter()
+    def elapsed(self):
+        return time.perf_counter() - self.started
+    def charts_per_sec(self):
+        elapsed = self.elapsed()
+        return self.done / elapsed if elapsed > 0 else 0.0
+    def __str__(self):
+        return f"{self.done}/{self.total} charts, {self.charts_per_sec():.1f} charts/s, {self.cached} cached, {self.errors} errors"
+
+def find_charts(root: str) -> Iterator[str]:
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(ChartExtensions):
+                yield os.path.join(folder, name)
+
+def scan_file(path: str, mode: int = ParseNoteStats, lenient: bool = False, fingerprint: bool = False) -> ScanResult:
+    try:
+        st = os.stat(path)
+        chart = BmsParser(path, lenient=lenient, fingerprint=fingerprint).parse(mode)
+    except Exception as e:
+        return ScanResult(path, error=f"{type(e).__name__}: {e}")
+    diagnostics = chart.diagnostics.as_dict() if len(chart.diagnostics) > 0 else None
+    return ScanResult(path, chart.meta, stat=(st.st_mtime_ns, st.st_size), diagnostics=diagnostics)
+
+def _scan_task(task: tuple[str, int, bool, bool]):
+    return scan_file(*task)
+
+def scan_library(root: str, workers: Union[int, None] = None, mode: int = ParseNoteStats,
+                 chunksize: int = 16, progress: Union[Callable[[ScanProgress], None], None] = None,
+                 cache: Union[ParseCache, None] = None, lenient: bool = False,
+                 fingerprint: bool = False) -> Iterator[ScanResult]:
+    # results are yielded in completion order, not in path order;
+    # unchanged files found in the cache are yielded first without being parsed.
+    # The cache holds strict parses without diagnostics, so lenient scans skip it.
+    # fingerprint fills meta.fingerprint/minhash for bmsdedup (not in header mode).
+    if lenient:
+        cache = None
+    paths = list(find_charts(root))
+    state = ScanProgress(len(paths))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    tasks = []
+    for path in paths:
+        meta = cache.get_meta(path, mode) if cache is not None else None
+        if meta is not None and fingerprint and mode != ParseHeaderOnly and len(meta.fingerprint) == 0:
+            # cached by a scan that did not fingerprint
+            meta = None
+        if meta is None:
+            tasks.append((path, mode, lenient, fingerprint))
+            continue
+        state.done += 1
+        state.cached += 1
+        if progress is not None:
+            progress(state)
+        yield ScanResult(path, meta, cached=True)
+    if cache is not None:
+        cache.commit()
+    if len(tasks) == 0:
+        return
+    if workers <= 1:
+        results = map(_scan_task, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_scan_task, tasks, chunksize)
+    try:
+        for result in results:
+            state.done += 1
+            if result.error is not None:
+                state.errors += 1
+            elif cache is not None:
+                cache.put(result.path, result.meta, mode, stat=result.stat)
+            if progress is not None:
+                progress(state)
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if cache is not None:
+            cache.commit()
+
+def main(argv: Union[list[str], None] = None):
+    parser = argparse.ArgumentParser(description="Scan a BMS library and print chart metadata as JSON lines")
+    parser.add_argument("root", help="song folder to scan recursively")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("-m", "--mode", choices=list(ScanModes), default="stats", help="parse depth (default: stats)")
+    parser.add_argument("-o", "--output", default="-", help="output file (default: stdout)")
+    parser.add_argument("--chunksize", type=int, default=16, help="charts handed to a worker at once")
+    parser.add_argument("--cache", default=None, help="SQLite parse cache; unchanged files are not re-parsed")
+    parser.add_argument("--cache-max-entries", type=int, default=None, help="evict least recently used entries above this count")
+    parser.add_argument("--lenient", action="store_true", help="skip bad lines instead of failing the chart (bypasses --cache)")
+    parser.add_argument("--fingerprint", action="store_true", help="fill meta.fingerprint and meta.minhash for bmsdedup.py")
+    parser.add_argument("-q", "--quiet", action="store_true", help="do not report progress on stderr")
+    args = parser.parse_args(argv)
+
+    last_report = [0.0]
+    def report(state: ScanProgress):
+        now = time.perf_counter()
+        if now - last_report[0] >= 1.0 or state.done == state.total:
+            last_report[0] = now
+            print(f"\r{state}", end="", file=sys.stderr, flush=True)
+
+    cache = ParseCache(args.cache, args.cache_max_entries) if args.cache is not None else None
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        for result in scan_library(args.root, args.workers, ScanModes[args.mode], args.chunksize,
+                                   None if args.quiet else report, cache, args.lenient, args.fingerprint):
+            out.write(json.dumps(result.to_dict(), ensure_ascii=False) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if cache is not None:
+            cache.close()
+    if not args.quiet:
+        print(file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""
+ * Copyright (C) 2024 VioletXF, khoeun03
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import array
+from typing import Iterable, Union
+from bmsparser import Chart, ChartMeta, EventStream, EventNote, EventLongHead, EventLandmine
+
+JudgePGreat = 0
+JudgeGreat = 1
+JudgeGood = 2
+JudgeBad = 3
+JudgePoor = 4
+# a press that hit no note; not tied to a note id
+JudgeEmptyPoor = 5
+JudgeNames = ("pgreat", "great", "good", "bad", "poor", "empty_poor")
+
+# #RANK 0-3 (VERY HARD, HARD, NORMAL, EASY): PGREAT, GREAT and GOOD windows in ms
+RankWindows = ((8, 24, 40), (15, 30, 60), (18, 40, 100), (21, 60, 120))
+NoTail = -1
+# session time before the first input
+NoInput = -(1 << 62)
+
+class JudgeWindows:
+    # Half widths in microseconds: a press |delta| <= pgreat is a PGREAT and so
+    # on up to bad. A press that finds no note within bad but has one at most
+    # empty_poor ahead is an empty POOR.
+    def __init__(self, pgreat: int, great: int, good: int, bad: int = 200000, empty_poor: int = 500000):
+        self.pgreat = pgreat
+        self.great = great
+        self.good = good
+        self.bad = bad
+        self.empty_poor = empty_poor
+    def judge(self, delta: int):
+        delta = abs(delta)
+        if delta <= self.pgreat:
+            return JudgePGreat
+        if delta <= self.great:
+            return JudgeGreat
+        if delta <= self.good:
+            return JudgeGood
+        if delta <= self.bad:
+            return JudgeBad
+        return JudgePoor
+    def __str__(self):
+        return f"JudgeWindows({self.pgreat}, {self.great}, {self.good}, {self.bad}, {self.empty_poor})"
+
+def judge_windows(rank: int) -> JudgeWindows:
+    pgreat, great, good = RankWindows[min(max(rank, 0), len(RankWindows) - 1)]
+    return JudgeWindows(pgreat * 1000, great * 1000, good * 1000)
+
+class GaugeRules:
+    # Groove gauge in percent. PGREAT and GREAT add TOTAL / notes, GOOD half of
+    # that; the other judgements and landmines subtract.
+    def __init__(self, start: float = 20.0, clear: float = 80.0, floor: float = 2.0,
+                 bad: float = 2.0, poor: float = 6.0, empty_poor: float = 2.0):
+        self.start = start
+        self.clear = clear
+        self.floor = floor
+        self.bad = bad
+        self.poor = poor
+        self.empty_poor = empty_poor
+
+class ScoreResult:
+    def __init__(self, notes: int):
+        # JudgeNames order
+        self.counts = [0] * len(JudgeNames)
+        self.combo = 0
+        self.max_combo = 0
+        self.gauge = 0.0
+        self.landmines = 0
+        # presses before / after the note, PGREATs excluded
+        self.fast = 0
+        self.slow = 0
+        # per note id: Judge* (-1 never judged) and press offset in us
+        self.judgements = array.array('b', [-1]) * notes
+        self.offsets = array.array('i', [0]) * notes
+        self.cleared = False
+    @property
+    def ex_score(self):
+        return self.counts[JudgePGreat] * 2 + self.counts[JudgeGreat]
+    def as_dict(self):
+        result = {name: count for name, count in zip(JudgeNames, self.counts)}
+        result.update(ex_score=self.ex_score, max_combo=self.max_combo, gauge=self.gauge,
+                      cleared=self.cleared, landmines=self.landmines, fast=self.fast, slow=self.slow)
+        return result
+    def __str__(self):
+        counts = " ".join(f"{name}={count}" for name, count in zip(JudgeNames, self.counts))
+        return f"ScoreResult({counts} ex={self.ex_score} combo={self.max_combo} gauge={self.gauge:.2f})"
+
+class ScoringChart:
+    # Read-only note tables of one chart, built once and shared by every
+    # session. Note ids number the judged notes (normal notes and long note
+    # heads on playable lanes) in timing order; a long note is one note whose
+    # tail timing sits in tail_timing. The chart itself is never touched, so
+    # Note.play/press/release state stays free for a live player.
+    def __init__(self, chart: Union[Chart, EventStream], meta: Union[ChartMeta, None] = None,
+                 windows: Union[JudgeWindows, None] = None, gauge: Union[GaugeRules, None] = None):
+        if isinstance(chart, Chart):
+            meta = chart.meta if meta is None else meta
+            events = chart.to_events()
+        else:
+            events = chart
+        if meta is None:
+            meta = ChartMeta()
+        self.meta = meta
+        self.windows = judge_windows(meta.rank) if windows is None else windows
+        self.gauge = GaugeRules() if gauge is None else gauge
+        self.timing = array.array('q')
+        self.lane = array.array('b')
+        self.tail_timing = array.array('q')
+        # row in the EventStream, to map judgements back to events
+        self.row = array.array('i')
+        self.mine_timing = array.array('q')
+        self.mine_lane = array.array('b')
+        # gauge percent lost per landmine
+        self.mine_damage = array.array('d')
+        # per lane: note ids in timing order
+        self.lane_notes = [array.array('i') for _ in range(16)]
+        timing = events.timing
+        pair = events.pair
+        for row, (t, kind, note_lane) in enumerate(zip(timing, events.type, events.lane)):
+            if note_lane < 0:
+                continue
+            if kind == EventNote or kind == EventLongHead:
+                other = pair[row] if kind == EventLongHead else -1
+                self.lane_notes[note_lane].append(len(self.timing))
+                self.timing.append(t)
+                self.lane.append(note_lane)
+                self.tail_timing.append(timing[other] if other >= 0 else NoTail)
+                self.row.append(row)
+            elif kind == EventLandmine:
+                self.mine_timing.append(t)
+                self.mine_lane.append(note_lane)
+                self.mine_damage.append(events.value[row])
+        # long note ids ordered by tail timing, for tails passing while held
+        self.long_notes = array.array('i', sorted((i for i, t in enumerate(self.tail_timing) if t != NoTail),
+                                                  key=lambda i: self.tail_timing[i]))
+        # gauge gain of a PGREAT or GREAT
+        self.gain = meta.total / len(self.timing) if len(self.timing) > 0 else 0.0
+    def __len__(self):
+        return len(self.timing)
+    def session(self) -> 'ScoreSession':
+        return ScoreSession(self)
+    def score(self, log: Iterable[tuple[int, int, bool]]) -> ScoreResult:
+        session = ScoreSession(self)
+        session.feed(log)
+        return session.finish()
+    def score_many(self, logs: Iterable[Iterable[tuple[int, int, bool]]]):
+        # one result per input log; only the session arrays are allocated per log
+        for log in logs:
+            yield self.score(log)
+
+class ScoreSession:
+    # State of one play over a ScoringChart. Input events are (time_us, lane,
+    # pressed) and must come in time order across calls to feed; lanes use
+    # the chart's lane numbers (scratch on 7 and 15).
+    def __init__(self, chart: ScoringChart):
+        self.chart = chart
+        self.result = ScoreResult(len(chart))
+        self.result.gauge = chart.gauge.start
+        # per lane: position in chart.lane_notes of the first note not yet judged
+        self.next = [0] * 16
+        # per lane: long note id being held, -1 when none
+        self.holding = [-1] * 16
+        self.key_down = [False] * 16
+        # first note id whose late window has not passed yet
+        self.expired = 0
+        self.next_tail = 0
+        self.next_mine = 0
+        self.now = NoInput
+    def add_gauge(self, delta: float):
+        result = self.result
+        result.gauge = min(100.0, max(self.chart.gauge.floor, result.gauge + delta))
+    def record(self, note: int, judgement: int):
+        result = self.result
+        result.judgements[note] = judgement
+        result.counts[judgement] += 1
+        rules = self.chart.gauge
+        if judgement <= JudgeGood:
+            result.combo += 1
+            if result.combo > result.max_combo:
+                result.max_combo = result.combo
+            self.add_gauge(self.chart.gain if judgement <= JudgeGreat else self.chart.gain / 2)
+        else:
+            result.combo = 0
+            self.add_gauge(-rules.bad if judgement == JudgeBad else -rules.poor)
+    def advance(self, now: int):
+        # settle everything that happened before now: missed notes, long notes
+        # held past their tail and landmines passed with the key down
+        chart = self.chart
+        judgements = self.result.judgements
+        late = chart.windows.bad
+        timing = chart.timing
+        n = len(timing)
+        i = self.expired
+        while i < n and timing[i] + late < now:
+            if judgements[i] < 0:
+                self.record(i, JudgePoor)
+            i += 1
+        self.expired = i
+        long_notes = chart.long_notes
+        tail_timing = chart.tail_timing
+        i = self.next_tail
+        while i < len(long_notes) and tail_timing[long_notes[i]] <= now:
+            note = long_notes[i]
+            lane = chart.lane[note]
+            if self.holding[lane] == note:
+                self.holding[lane] = -1
+                self.record(note, judgements[note])
+            i += 1
+        self.next_tail = i
+        mine_timing = chart.mine_timing
+        i = self.next_mine
+        while i < len(mine_timing) and mine_timing[i] < now:
+            if self.key_down[chart.mine_lane[i]]:
+                self.result.landmines += 1
+                self.add_gauge(-chart.mine_damage[i])
+            i += 1
+        self.next_mine = i
+        self.now = now
+    def press(self, time: int, lane: int):
+        self.advance(time)
+        self.key_down[lane] = True
+        chart = self.chart
+        result = self.result
+        judgements = result.judgements
+        notes = chart.lane_notes[lane]
+        k = self.next[lane]
+        while k < len(notes) and judgements[notes[k]] >= 0:
+            k += 1
+        self.next[lane] = k
+        if k == len(notes):
+            return
+        note = notes[k]
+        delta = time - chart.timing[note]
+        windows = chart.windows
+        if delta < -windows.bad:
+            if delta >= -windows.empty_poor:
+                result.counts[JudgeEmptyPoor] += 1
+                self.add_gauge(-chart.gauge.empty_poor)
+            return
+        judgement = windows.judge(delta)
+        result.offsets[note] = delta
+        if judgement != JudgePGreat:
+            if delta < 0:
+                result.fast += 1
+            else:
+                result.slow += 1
+        self.next[lane] = k + 1
+        if chart.tail_timing[note] != NoTail:
+            # counted when the tail passes or the key is released
+            judgements[note] = judgement
+            self.holding[lane] = note
+        else:
+            self.record(note, judgement)
+    def release(self, time: int, lane: int):
+        self.advance(time)
+        self.key_down[lane] = False
+        note = self.holding[lane]
+        if note < 0:
+            return
+        self.holding[lane] = -1
+        chart = self.chart
+        judgement = self.result.judgements[note]
+        if time < chart.tail_timing[note] - chart.windows.good:
+            judgement = JudgePoor
+        self.record(note, judgement)
+    def feed(self, log: Iterable[tuple[int, int, bool]]):
+        for time, lane, pressed in log:
+            if time < self.now:
+                raise ValueError(f"Input at {time} us comes before {self.now} us")
+            if pressed:
+                self.press(time, lane)
+            else:
+                self.release(time, lane)
+    def finish(self) -> ScoreResult:
+        # everything left is missed; long notes still held end at their tail
+        chart = self.chart
+        end = max(chart.timing[-1] + chart.windows.bad + 1 if len(chart) > 0 else 0,
+                  max(chart.tail_timing, default=0) + 1, self.now)
+        self.advance(end)
+        result = self.result
+        result.cleared = result.gauge >= chart.gauge.clear
+        return result
+
+def score(chart: Union[Chart, ScoringChart], log: Iterable[tuple[int, int, bool]],
+          windows: Union[JudgeWindows, None] = None) -> ScoreResult:
+    if isinstance(chart, Chart):
+        chart = ScoringChart(chart, windows=windows)
+    return chart.score(log)
@@ -0,0 +1,281 @@
+"""
+ * Copyright (C) 2024 VioletXF, khoeun03
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import secrets
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Union
+from bmsbinary import CompiledChart, compile_chart
+from bmsparser import BmsParser, Chart
+
+# Catalog segment layout (little-endian):
+#   header  magic "BMSS", slot count u32, capacity in bytes u64
+#   slots   per slot: key (sha256 of the path), segment name (24 bytes, NUL padded),
+#           state u8, 3 bytes padding, loader pid u32, source mtime_ns i64,
+#           source size i64, segment size u64, references i64, last release time
+#           f64 (while loading: the time the load started)
+# Every read or write of the catalog happens under the store's lock.
+Magic = b"BMSS"
+CatalogHeader = struct.Struct("<4sIQ")
+SlotFormat = struct.Struct("<32s24sB3xIqqQqd")
+
+SlotEmpty = 0
+# a process is parsing the chart; others wait for it instead of parsing too,
+# unless it has exited or the load is older than their timeout
+SlotLoading = 1
+SlotReady = 2
+# the source changed while the chart was in use; unlinked with its last reference
+SlotStale = 3
+
+# _open_segment swaps out resource_tracker.register before 3.13; threads take
+# turns, and the function saved here is always the one put back
+TrackerLock = threading.Lock()
+TrackerRegister = resource_tracker.register
+
+def parse_chart(path: str) -> Chart:
+    return BmsParser(path).parse()
+
+def _process_alive(pid: int):
+    # signal 0 only probes on POSIX; on Windows it would send CTRL_C_EVENT,
+    # so there a load is only given up on once it is too old
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _open_segment(name: Union[str, None] = None, size: int = 0) -> shared_memory.SharedMemory:
+    # segments outlive the process that created or attached them; keep the
+    # resource tracker from unlinking them when that process exits
+    create = name is None
+    if create:
+        name = "bms_" + secrets.token_hex(8)
+    try:
+        return shared_memory.SharedMemory(name, create, size, track=False) # type: ignore
+    except TypeError:
+        pass
+    # no track argument before 3.13; registering and unregistering right away
+    # races with other processes attaching the same segment (the tracker keeps
+    # one entry per name), so the tracker is not told at all
+    with TrackerLock:
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name, create, size)
+        finally:
+            resource_tracker.register = TrackerRegister
+
+def _unlink_segment(name: str):
+    # a tracked handle, so the tracker's register and unregister stay paired
+    try:
+        with TrackerLock:
+            segment = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    segment.unlink()
+
+class SharedChart(CompiledChart):
+    # Read-only CompiledChart over a chart in the store. Holds one reference
+    # until close(); like MappedChart, column views must be dropped first.
+    def __init__(self, store: 'SharedChartStore', slot: int, segment: shared_memory.SharedMemory, as_numpy: bool = False):
+        self.store = store
+        self.slot = slot
+        self.segment = segment
+        super().__init__(segment.buf, as_numpy)
+    def close(self):
+        if self.segment is None:
+            return
+        self.release()
+        self.segment.close()
+        self.segment = None
+        self.store.unpin(self.slot)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+class SharedChartStore:
+    # Parses each chart once, compiles it with bmsbinary and keeps it in its
+    # own shared memory segment; a small catalog segment maps paths to
+    # segments and counts references. Create the store in the parent process
+    # and pass it to the workers (it pickles to a handle on the same catalog).
+    # The default multiprocessing.Lock only travels by inheritance, as
+    # Process(args=...); for Pool or ProcessPoolExecutor tasks pass
+    # lock=multiprocessing.Manager().Lock(), which pickles to a proxy.
+    # An entry stays valid while the file's mtime and size are unchanged. When
+    # a new chart does not fit in capacity bytes, charts nobody holds are
+    # unlinked, least recently released first; charts in use are never evicted,
+    # so capacity can be exceeded while they are held.
+    def __init__(self, capacity: int = 256 << 20, slots: int = 1024, lock=None,
+                 loader: Callable[[str], Chart] = parse_chart, catalog_name: Union[str, None] = None):
+        self.lock = multiprocessing.Lock() if lock is None else lock
+        self.loader = loader
+        self.owner = catalog_name is None
+        if self.owner:
+            self.catalog = _open_segment(size=CatalogHeader.size + SlotFormat.size * slots)
+            CatalogHeader.pack_into(self.catalog.buf, 0, Magic, slots, capacity)
+        else:
+            self.catalog = _open_segment(catalog_name)
+        magic, self.slots, self.capacity = CatalogHeader.unpack_from(self.catalog.buf, 0)
+        if magic != Magic:
+            raise ValueError(f"{self.catalog.name} is not a chart store catalog")
+        self.hits = 0
+        self.misses = 0
+    def __reduce__(self):
+        return (SharedChartStore, (self.capacity, self.slots, self.lock, self.loader, self.catalog.name))
+    def read_slot(self, slot: int):
+        key, name, state, loader, mtime_ns, size, nbytes, refs, last_used = SlotFormat.unpack_from(
+            self.catalog.buf, CatalogHeader.size + SlotFormat.size * slot)
+        return key, name.rstrip(b"\0").decode("ascii"), state, mtime_ns, size, nbytes, refs, last_used, loader
+    def write_slot(self, slot: int, key: bytes, name: str, state: int, mtime_ns: int, size: int,
+                   nbytes: int, refs: int, last_used: float, loader: int = 0):
+        SlotFormat.pack_into(self.catalog.buf, CatalogHeader.size + SlotFormat.size * slot,
+                             key, name.encode("ascii"), state, loader, mtime_ns, size, nbytes, refs, last_used)
+    def clear_slot(self, slot: int):
+        self.write_slot(slot, b"", "", SlotEmpty, 0, 0, 0, 0, 0.0)
+    def set_refs(self, slot: int, delta: int):
+        key, name, state, mtime_ns, size, nbytes, refs, last_used, _ = self.read_slot(slot)
+        refs += delta
+        if refs == 0 and state == SlotStale:
+            _unlink_segment(name)
+            self.clear_slot(slot)
+            return
+        self.write_slot(slot, key, name, state, mtime_ns, size, nbytes, refs, time.time() if delta < 0 else last_used)
+    def find(self, key: bytes):
+        for slot in range(self.slots):
+            slot_key, _, state, *_ = self.read_slot(slot)
+            if slot_key == key and (state == SlotLoading or state == SlotReady):
+                return slot
+        return None
+    def used_bytes(self):
+        return sum(self.read_slot(slot)[5] for slot in range(self.slots))
+    def evict(self, needed: int, keep: int = -1) -> int:
+        # unlink unreferenced charts until needed more bytes fit; returns a free slot or -1
+        idle = []
+        free = -1
+        for slot in range(self.slots):
+            _, name, state, _, _, nbytes, refs, last_used, _ = self.read_slot(slot)
+            if state == SlotEmpty:
+                free = slot if free < 0 else free
+            elif state == SlotReady and refs == 0 and slot != keep:
+                idle.append((last_used, slot, name, nbytes))
+        idle.sort()
+        used = self.used_bytes()
+        for _, slot, name, nbytes in idle:
+            if used + needed <= self.capacity and free >= 0:
+                break
+            _unlink_segment(name)
+            self.clear_slot(slot)
+            used -= nbytes
+            free = slot if free < 0 else free
+        return free
+    def get(self, path: str, as_numpy: bool = False, timeout: float = 60.0) -> SharedChart:
+        path = os.path.abspath(path)
+        key = hashlib.sha256(os.path.normcase(path).encode("utf-8")).digest()
+        st = os.stat(path)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                slot = self.find(key)
+                if slot is not None:
+                    _, name, state, mtime_ns, size, nbytes, refs, last_used, loader = self.read_slot(slot)
+                    if state == SlotLoading and (not _process_alive(loader) or time.time() - last_used > timeout):
+                        # the loading process died or hung; load it here instead
+                        self.clear_slot(slot)
+                        slot = None
+                    elif state == SlotReady and (mtime_ns, size) != (st.st_mtime_ns, st.st_size):
+                        # changed on disk: drop it now, or once the last holder lets go
+                        if refs == 0:
+                            _unlink_segment(name)
+                            self.clear_slot(slot)
+                        else:
+                            self.write_slot(slot, key, name, SlotStale, mtime_ns, size, nbytes, refs, last_used)
+                        slot = None
+                    elif state == SlotReady:
+                        self.write_slot(slot, key, name, state, mtime_ns, size, nbytes, refs + 1, last_used)
+                        self.hits += 1
+                        return SharedChart(self, slot, _open_segment(name), as_numpy)
+                if slot is None:
+                    slot = self.evict(0)
+                    if slot < 0:
+                        raise RuntimeError(f"All {self.slots} chart store slots are in use")
+                    started = time.time()
+                    self.write_slot(slot, key, "", SlotLoading, st.st_mtime_ns, st.st_size, 0, 1, started, os.getpid())
+                    break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for another process to load {path}")
+            time.sleep(0.005)
+        self.misses += 1
+        try:
+            data = compile_chart(self.loader(path))
+            segment = _open_segment(size=len(data))
+            segment.buf[:len(data)] = data
+        except BaseException:
+            with self.lock:
+                if self.loading(slot, key, started):
+                    self.clear_slot(slot)
+            raise
+        with self.lock:
+            owned = self.loading(slot, key, started)
+            if owned:
+                self.evict(segment.size, keep=slot)
+                self.write_slot(slot, key, segment.name, SlotReady, st.st_mtime_ns, st.st_size, segment.size, 1, time.time())
+        if not owned:
+            # taken over as hung while loading; use whatever the new loader makes
+            name = segment.name
+            segment.close()
+            _unlink_segment(name)
+            return self.get(path, as_numpy, max(deadline - time.monotonic(), 0.0))
+        return SharedChart(self, slot, segment, as_numpy)
+    def loading(self, slot: int, key: bytes, started: float):
+        # whether slot is still the load this process started at started
+        slot_key, _, state, _, _, _, _, last_used, loader = self.read_slot(slot)
+        return slot_key == key and state == SlotLoading and last_used == started and loader == os.getpid()
+    def unpin(self, slot: int):
+        with self.lock:
+            self.set_refs(slot, -1)
+    def __len__(self):
+        with self.lock:
+            return sum(1 for slot in range(self.slots) if self.read_slot(slot)[2] == SlotReady)
+    def close(self):
+        self.catalog.close()
+    def unlink(self):
+        # owner only, once every worker is done: removes all charts and the catalog
+        with self.lock:
+            for slot in range(self.slots):
+                _, name, state, *_ = self.read_slot(slot)
+                if len(name) > 0:
+                    _unlink_segment(name)
+                self.clear_slot(slot)
+        name = self.catalog.name
+        self.catalog.close()
+        _unlink_segment(name)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        if self.owner:
+            self.unlink()
+        else:
+            self.close()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+Root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, Root)
+sys.path.insert(0, os.path.join(Root, "benchmarks"))
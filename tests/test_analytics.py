@@ -0,0 +1,36 @@
+import pytest
+
+import bmsanalytics
+import bmsparser
+import synth
+
+UseNumpy = (False, True) if bmsparser.numpy is not None else (False,)
+
+@pytest.mark.parametrize("use_numpy", UseNumpy)
+@pytest.mark.parametrize("ln", ("none", "lntype", "lnobj"))
+@pytest.mark.parametrize("double", (False, True))
+def test_counts_match_meta(tmp_path, ln, double, use_numpy):
+    path = str(tmp_path / "chart.bms")
+    synth.write_chart(path, synth.ChartSpec(measures=60, ln=ln, ln_rate=0.3, double=double))
+    chart = bmsparser.BmsParser(path, seed=0).parse()
+    meta = chart.meta
+    features = bmsanalytics.analyze(chart, use_numpy=use_numpy)
+    assert features.notes == meta.total_notes
+    assert features.long_notes - features.scratch_long_notes == meta.total_long_notes
+    # #LNOBJ counts a scratch long note's end as another scratch note
+    scratch_ends = features.scratch_long_notes if ln == "lnobj" else 0
+    assert features.scratch_notes + scratch_ends == meta.total_scratch_notes
+    if ln != "none":
+        assert features.scratch_long_notes > 0
+
+def test_use_numpy_without_numpy(tmp_path, monkeypatch):
+    monkeypatch.setattr(bmsparser, "numpy", None)
+    monkeypatch.setattr(bmsanalytics, "numpy", None)
+    path = str(tmp_path / "chart.bms")
+    synth.write_chart(path, synth.ChartSpec(measures=4))
+    chart = bmsparser.BmsParser(path, seed=0).parse()
+    with pytest.raises(ImportError, match="use_numpy=True"):
+        chart.to_arrays(use_numpy=True)
+    with pytest.raises(ImportError, match="use_numpy=True"):
+        bmsanalytics.analyze(chart, use_numpy=True)
+    assert bmsanalytics.analyze(chart).notes == chart.meta.total_notes
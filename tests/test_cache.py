@@ -0,0 +1,33 @@
+import pytest
+
+import bmscache
+import bmsparser
+import synth
+
+@pytest.fixture
+def chart_path(tmp_path):
+    path = str(tmp_path / "chart.bms")
+    synth.write_chart(path, synth.ChartSpec(measures=8))
+    return path
+
+def test_lazy_parse_stores_note_stats(tmp_path, chart_path):
+    with bmscache.ParseCache(str(tmp_path / "cache.db")) as cache:
+        assert cache.get_meta(chart_path, bmsparser.ParseLazy) is None
+        chart = cache.parse(chart_path, bmsparser.ParseLazy)
+        assert len(chart.measures) == 8 and len(chart.measures[0].timelines) > 0
+        meta = cache.get_meta(chart_path, bmsparser.ParseNoteStats)
+        assert meta is not None and meta.total_notes == chart.meta.total_notes
+        # measures are built on access, so a lazy parse is never answered by the meta alone
+        again = cache.parse(chart_path, bmsparser.ParseLazy)
+        assert len(again.measures[0].timelines) > 0
+
+def test_lazy_meta_from_note_stats(tmp_path, chart_path):
+    with bmscache.ParseCache(str(tmp_path / "cache.db")) as cache:
+        stats = cache.parse(chart_path, bmsparser.ParseNoteStats)
+        meta = cache.get_meta(chart_path, bmsparser.ParseLazy)
+        assert meta is not None and meta.total_length == stats.meta.total_length
+
+def test_unknown_mode(tmp_path, chart_path):
+    with bmscache.ParseCache(str(tmp_path / "cache.db")) as cache:
+        with pytest.raises(ValueError, match="Unknown parse mode"):
+            cache.parse(chart_path, 99)
@@ -0,0 +1,43 @@
+import pytest
+
+import bmsparser
+
+def parse(tmp_path, text: str, mode: int = bmsparser.ParseFull, lenient: bool = False):
+    path = tmp_path / "chart.bms"
+    path.write_bytes(text.replace("\n", "\r\n").encode("ascii"))
+    return bmsparser.BmsParser(str(path), lenient=lenient).parse(mode)
+
+def codes(chart: bmsparser.Chart):
+    return [(d.severity, d.code) for d in chart.diagnostics]
+
+@pytest.mark.parametrize("mode", (bmsparser.ParseFull, bmsparser.ParseNoteStats))
+def test_negative_bpm_is_a_warning(tmp_path, mode):
+    chart = parse(tmp_path, "#BPM 120\n#BPM01 -120\n#00108:0001\n#00111:01010101\n#00211:01\n", mode)
+    assert (chart.meta.min_bpm, chart.meta.max_bpm, chart.meta.play_length) == (-120.0, 120.0, 2000000)
+    assert codes(chart) == [(bmsparser.SeverityWarning, "bad-header")]
+
+@pytest.mark.parametrize("text", ("", "#TITLE header only\n"))
+def test_chart_without_measures_needs_no_bpm(tmp_path, text):
+    chart = parse(tmp_path, text)
+    assert len(chart.measures) == 0
+    assert codes(chart) == [(bmsparser.SeverityWarning, "bad-header")]
+
+def test_undecodable_unused_channel_keeps_positions(tmp_path):
+    chart = parse(tmp_path, "#BPM 120\n#00199:hello.\n#00111:0101\n")
+    assert [timeline.timing for timeline in chart.measures[1].timelines] == [2000000, 2666666, 3000000, 3333333]
+    assert codes(chart) == [(bmsparser.SeverityWarning, "bad-channel")]
+
+@pytest.mark.parametrize("text, line", [
+    ("#BPM 120\n#00108:01\n", 2),
+    ("#BPM 120\n#BPM01 0\n#00108:01\n", 3),
+    ("#00111:01\n", 0),
+    ("#BPM 120\n#00111:0.\n", 2),
+])
+def test_unusable_values_raise_with_line(tmp_path, text, line):
+    with pytest.raises(ValueError, match=f"^Line {line}:"):
+        parse(tmp_path, text)
+
+def test_lenient_keeps_current_bpm(tmp_path):
+    chart = parse(tmp_path, "#BPM 120\n#BPM01 0\n#00108:0001\n#00111:01\n", lenient=True)
+    assert chart.meta.total_length == 4000000
+    assert chart.diagnostics.counts == {"bad-header": 1, "bad-channel": 1}
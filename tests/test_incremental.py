@@ -0,0 +1,110 @@
+import random
+
+import pytest
+
+import bmsparser
+import synth
+
+def note_state(note):
+    if note is None:
+        return None
+    state = [type(note).__name__, note.lane, getattr(note, "wav", None), note.timeline.timing, note.timeline.tick]
+    if isinstance(note, bmsparser.LongNote):
+        other = note.head if note.is_tail() else note.tail
+        state += [note.is_tail(), None if other is None else (other.timeline.timing, other.timeline.tick)]
+        if other is not None:
+            # both ends must point at each other, not at a note of the old graph
+            assert (other.tail if note.is_tail() else other.head) is note
+    return state
+
+def chart_state(chart: bmsparser.Chart):
+    measures = []
+    for measure in chart.measures:
+        timelines = [[timeline.timing, timeline.tick, timeline.position, timeline.bpm, timeline.bpm_change,
+                      timeline.stop_length, timeline.scroll, timeline.visual, timeline.bga_base,
+                      [note_state(note) for note in timeline.notes],
+                      [note_state(note) for note in timeline.invisible_notes],
+                      [note_state(note) for note in timeline.landmine_notes],
+                      [note_state(note) for note in timeline.background_notes]]
+                     for timeline in measure.timelines]
+        measures.append([measure.scale, measure.timing, measure.resolution, timelines])
+    meta = chart.meta
+    index = chart.timing_index
+    return {
+        "counts": (meta.total_notes, meta.total_long_notes, meta.total_scratch_notes, meta.play_length,
+                   meta.min_bpm, meta.max_bpm, meta.key_mode),
+        "measures": measures,
+        "index": [index.point_beat, index.point_time, index.note_time, [note_state(note) for note in index.notes]],
+    }
+
+def edit(lines: list[str], prng: random.Random):
+    # one random change to the channel lines: retype an object, drop a line
+    # or a whole measure, add a note/long note/BPM/STOP/measure length line,
+    # or move a line to another channel (notes to long notes and back)
+    channel_lines = [i for i, line in enumerate(lines) if len(line) > 7 and line[6] == ":" and line[1:4].isdigit()]
+    i = prng.choice(channel_lines)
+    line = lines[i]
+    op = prng.randrange(6)
+    if op == 0:
+        # the #LNOBJ id in the first slot closes a note of an earlier measure
+        ln_end = next((other[7:] for other in lines if other.startswith("#LNOBJ ")), "ZZ")
+        objects = [line[k:k + 2] for k in range(7, len(line), 2)]
+        slot = prng.choice([0, prng.randrange(len(objects))])
+        objects[slot] = prng.choice(["00", "01", "0A", ln_end])
+        lines[i] = line[:7] + "".join(objects)
+    elif op == 1:
+        del lines[i]
+    elif op == 2:
+        measure = prng.randrange(int(lines[channel_lines[-1]][1:4]) + 2)
+        channel = prng.choice(["11", "16", "51", "56", "08", "09", "02", "03"])
+        if channel == "02":
+            data = prng.choice(["0.5", "0.75", "1.5"])
+        elif channel == "03":
+            data = "00" + format(prng.randint(60, 250), "02X")
+        else:
+            data = "".join(prng.choice(["00", "01", "02", "ZZ"]) for _ in range(prng.choice([1, 2, 3, 4, 8])))
+        lines.insert(i, f"#{measure:03d}{channel}:{data}")
+    elif op == 3:
+        lines[i] = line[:4] + prng.choice(["11", "16", "51", "56"]) + line[6:]
+    elif op == 4:
+        lines[:] = [other for other in lines if other[:4] != line[:4]]
+    else:
+        lines.insert(i, line)
+
+def write(path: str, lines: list[str]):
+    with open(path, "w", encoding="ascii", newline="") as f:
+        f.write("\r\n".join(lines))
+
+Specs = [
+    synth.ChartSpec(measures=32, ln="lntype", ln_rate=0.3, bpm_changes=3, stops=2, scrolls=2),
+    synth.ChartSpec(measures=32, ln="lnobj", ln_rate=0.5, density=0.15, bpm_changes=2),
+    synth.ChartSpec(measures=32, ln="lnobj", ln_rate=0.5, base62=True),
+]
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("spec", Specs, ids=["lntype", "lnobj", "lnobj-base62"])
+def test_reparse_matches_fresh_parse(tmp_path, spec, seed):
+    prng = random.Random(seed)
+    path = str(tmp_path / "chart.bms")
+    lines = synth.generate(spec).split("\r\n")
+    write(path, lines)
+    incremental = bmsparser.IncrementalParser(path)
+    incremental.parse()
+    reused = 0
+    for _ in range(30):
+        saved = list(lines)
+        edit(lines, prng)
+        write(path, lines)
+        try:
+            fresh = bmsparser.BmsParser(path).parse()
+        except ValueError:
+            # e.g. a #xxx08 object without #BPMxx; strict parses reject it
+            lines = saved
+            write(path, lines)
+            fresh = bmsparser.BmsParser(path).parse()
+        chart = incremental.reparse()
+        assert chart_state(chart) == chart_state(fresh)
+        if incremental.rebuilt < len(chart.measures):
+            reused += 1
+    # most edits must have gone through the incremental path
+    assert reused > 15
@@ -0,0 +1,80 @@
+import pytest
+
+import bmsparser
+import synth
+
+def meta_state(meta: bmsparser.ChartMeta):
+    return (meta.total_notes, meta.total_long_notes, meta.total_scratch_notes, meta.total_length,
+            meta.play_length, meta.min_bpm, meta.max_bpm, meta.key_mode, meta.title)
+
+Charts = {
+    # timing tables differ per branch
+    "bpm-stop": """#BPM 120
+#RANDOM 2
+#IF 1
+#BPM01 240
+#STOP01 96
+#ENDIF
+#IF 2
+#BPM01 60
+#STOP01 192
+#ENDIF
+#ENDRANDOM
+#00108:01
+#00109:0001
+#00111:0101
+#00211:01
+""",
+    # long notes differ per branch
+    "lnobj": """#BPM 120
+#RANDOM 2
+#IF 1
+#LNOBJ ZZ
+#ENDIF
+#IF 2
+#LNOBJ YY
+#ENDIF
+#ENDRANDOM
+#00111:01ZZ01ZZ
+#00112:0101
+#00211:01YY0101
+""",
+    # blocks without graph headers share one template
+    "notes": """#BPM 150
+#TITLE shared
+#00111:0101
+#RANDOM 3
+#IF 1
+#00212:01010101
+#ENDIF
+#IF 2
+#00212:0101
+#TITLE second
+#ENDIF
+#ENDRANDOM
+#00311:01
+""",
+}
+
+@pytest.mark.parametrize("mode", (bmsparser.ParseHeaderOnly, bmsparser.ParseNoteStats, bmsparser.ParseFull))
+@pytest.mark.parametrize("name", sorted(Charts))
+def test_branches_match_direct_parse(tmp_path, name, mode):
+    path = str(tmp_path / "chart.bms")
+    with open(path, "w", encoding="ascii", newline="") as f:
+        f.write(Charts[name].replace("\n", "\r\n"))
+    branches = bmsparser.enumerate_random_branches(path, mode)
+    assert len(branches) > 1 and not branches.truncated
+    for branch in branches:
+        direct = bmsparser.BmsParser(path, random_selection=branch.selection).parse(mode)
+        assert meta_state(branch.chart.meta) == meta_state(direct.meta), branch.selection
+
+@pytest.mark.parametrize("mode", (bmsparser.ParseNoteStats, bmsparser.ParseFull))
+def test_synthetic_branches_match_direct_parse(tmp_path, mode):
+    path = str(tmp_path / "chart.bms")
+    synth.write_chart(path, synth.ChartSpec(measures=16, ln="lnobj", ln_rate=0.3, bpm_changes=2,
+                                            random_depth=2, random_range=2))
+    branches = bmsparser.enumerate_random_branches(path, mode)
+    assert len(branches) == 16
+    for branch in branches:
+        direct = bmsparser.BmsParser(path, random_selection=branch.selection).parse(mode)
+        assert meta_state(branch.chart.meta) == meta_state(direct.meta), branch.selection
@@ -0,0 +1,51 @@
+import hashlib
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import bmsshared
+import synth
+
+def dying_loader(path: str):
+    # exits mid-load, without the cleanup an exception would run
+    os._exit(1)
+
+@pytest.fixture
+def chart_path(tmp_path):
+    path = str(tmp_path / "chart.bms")
+    synth.write_chart(path, synth.ChartSpec(measures=8))
+    return path
+
+def loading_slot(store: bmsshared.SharedChartStore, path: str):
+    key = hashlib.sha256(os.path.normcase(os.path.abspath(path)).encode("utf-8")).digest()
+    slot = store.find(key)
+    return slot is not None and store.read_slot(slot)[2] == bmsshared.SlotLoading
+
+@pytest.mark.skipif(os.name == "nt", reason="dead loaders are only detected by pid on POSIX")
+def test_dead_loader_is_reclaimed(chart_path):
+    context = multiprocessing.get_context("fork" if hasattr(os, "fork") else "spawn")
+    with bmsshared.SharedChartStore(capacity=16 << 20, slots=8, lock=context.Lock()) as store:
+        dying = bmsshared.SharedChartStore(16 << 20, 8, store.lock, dying_loader, store.catalog.name)
+        process = context.Process(target=dying.get, args=(chart_path,))
+        process.start()
+        process.join()
+        dying.close()
+        assert loading_slot(store, chart_path)
+        started = time.monotonic()
+        with store.get(chart_path, timeout=5.0) as chart:
+            assert len(chart.note_timing) > 0
+        assert time.monotonic() - started < 5.0
+        assert len(store) == 1
+
+def test_hung_load_is_reclaimed(chart_path):
+    with bmsshared.SharedChartStore(capacity=16 << 20, slots=8) as store:
+        key = hashlib.sha256(os.path.normcase(os.path.abspath(chart_path)).encode("utf-8")).digest()
+        st = os.stat(chart_path)
+        # a live process that started loading long ago
+        store.write_slot(0, key, "", bmsshared.SlotLoading, st.st_mtime_ns, st.st_size, 0, 1, time.time() - 60,
+                         os.getpid())
+        with store.get(chart_path, timeout=1.0) as chart:
+            assert len(chart.note_timing) > 0
+        assert not loading_slot(store, chart_path)